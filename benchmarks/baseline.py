@@ -0,0 +1,87 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Storing benchmark results and comparing them with a baseline.
+
+Results are nested dictionaries saved as JSON.  A metric is named by
+its path of keys, such as "sync.tx_per_sec", or by a tuple of keys if
+they contain dots.
+'''
+
+import json
+import os
+import platform
+import resource
+import sys
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def peak_rss_mb():
+    '''The peak resident set size of this process in MB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def machine():
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'system': platform.system()}
+
+
+def metric_keys(metric):
+    return metric.split('.') if isinstance(metric, str) else metric
+
+
+def lookup(results, metric):
+    for key in metric_keys(metric):
+        results = results.get(key) if isinstance(results, dict) else None
+    return results
+
+
+def load(path):
+    '''Return the baseline results at path, or None if there are none.'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f'saved results to {path}')
+
+
+def compare(results, baseline, metrics, tolerance):
+    '''Print each metric against the baseline.  metrics is a list of
+    (metric, higher_is_better) pairs.  Return the metrics that are worse
+    than the baseline by more than tolerance, a fraction.'''
+    # As the params were when saved: JSON has no tuples
+    params = json.loads(json.dumps(results.get('params')))
+    if baseline.get('params') != params:
+        print('warning: the baseline was run with different parameters')
+    if baseline.get('machine') != results.get('machine'):
+        print('warning: the baseline was run on a different machine or Python')
+    regressions = []
+    names = ['.'.join(metric_keys(metric)) for metric, _ in metrics]
+    width = max(len(name) for name in names)
+    print(f'{"metric":<{width}}  {"baseline":>12}  {"now":>12}  change')
+    for name, (metric, higher_is_better) in zip(names, metrics):
+        old, new = lookup(baseline, metric), lookup(results, metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<{width}}  {old:>12,.3f}  {new:>12,.3f}  {change:+.1%}{flag}')
+    return regressions
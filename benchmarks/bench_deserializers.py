@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark of block deserialization for every coin family.
+
+Each block in tests/blocks is parsed repeatedly with Coin.block(), and
+the results are reported per DESERIALIZER class: blocks and transactions
+parsed per second, and the memory blocks allocated and kept per
+transaction by a parsed block, as counted by tracemalloc.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import baseline
+from electrumx.lib.coins import Coin
+
+BASELINE = os.path.join(baseline.BASELINE_DIR, 'deserializers.json')
+BLOCKS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'tests', 'blocks')
+
+
+def load_blocks(coin_filter):
+    '''Return a list of (name, coin, raw_block, height) of the test blocks.'''
+    blocks = []
+    for name in sorted(os.listdir(BLOCKS_DIR)):
+        coin_name, net = name.split('_')[:2]
+        if coin_filter and coin_filter.lower() not in coin_name.lower():
+            continue
+        coin = Coin.lookup_coin_class(coin_name, net)
+        with open(os.path.join(BLOCKS_DIR, name)) as f:
+            info = json.load(f)
+        blocks.append((name, coin, bytes.fromhex(info['block']), info['height']))
+    return blocks
+
+
+def time_block(coin, raw_block, height, min_time):
+    '''Return the mean seconds to parse the block, taking at least
+    min_time seconds in total.'''
+    parse = coin.block
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(10):
+            parse(raw_block, height)
+        count += 10
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / count
+
+
+def allocations(coin, raw_block, height):
+    '''Return the memory blocks allocated and kept by a parsed block.'''
+    tracemalloc.start()
+    try:
+        block = coin.block(raw_block, height)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del block
+    return sum(stat.count for stat in snapshot.statistics('filename'))
+
+
+def run(blocks, min_time):
+    totals = defaultdict(lambda: {'blocks': 0, 'txs': 0, 'seconds': 0.0, 'allocations': 0})
+    skipped = []
+    for name, coin, raw_block, height in blocks:
+        try:
+            tx_count = len(coin.block(raw_block, height).transactions)
+        except ImportError as e:
+            skipped.append(f'{name}: {e}')
+            continue
+        total = totals[coin.DESERIALIZER.__name__]
+        total['blocks'] += 1
+        total['txs'] += tx_count
+        total['seconds'] += time_block(coin, raw_block, height, min_time)
+        total['allocations'] += allocations(coin, raw_block, height)
+
+    results = {}
+    for name, total in sorted(totals.items()):
+        results[name] = {
+            'blocks': total['blocks'],
+            'txs': total['txs'],
+            'blocks_per_sec': round(total['blocks'] / total['seconds'], 1),
+            'tx_per_sec': round(total['txs'] / total['seconds'], 1),
+            'allocs_per_tx': round(total['allocations'] / total['txs'], 2),
+        }
+    return results, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--coin', default='',
+                        help='only blocks of coins whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds to spend parsing each block')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help=f'results to compare with (default: {BASELINE})')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional change counted as a regression')
+    args = parser.parse_args()
+
+    deserializers, skipped = run(load_blocks(args.coin), args.min_time)
+    for line in skipped:
+        print(f'skipped {line}')
+    width = max((len(name) for name in deserializers), default=0)
+    print(f'{"deserializer":<{width}}  {"blocks":>6}  {"txs":>6}  {"blocks/sec":>10}  '
+          f'{"tx/sec":>10}  allocs/tx')
+    for name, result in deserializers.items():
+        print(f'{name:<{width}}  {result["blocks"]:>6,d}  {result["txs"]:>6,d}  '
+              f'{result["blocks_per_sec"]:>10,.1f}  {result["tx_per_sec"]:>10,.1f}  '
+              f'{result["allocs_per_tx"]:.2f}')
+
+    results = {
+        'params': {'coin': args.coin, 'min_time': args.min_time},
+        'machine': baseline.machine(),
+        'deserializers': deserializers,
+    }
+    baseline_path = os.path.abspath(args.baseline)
+    if args.save:
+        baseline.save(results, baseline_path)
+        return
+    old = baseline.load(baseline_path)
+    if old:
+        metrics = []
+        for name in deserializers:
+            metrics.append((f'deserializers.{name}.tx_per_sec', True))
+            metrics.append((f'deserializers.{name}.allocs_per_tx', False))
+        if baseline.compare(results, old, metrics, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
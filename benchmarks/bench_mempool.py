@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark of mempool synchronization.
+
+MemPool is driven through a fake MemPoolAPI serving a synthetic
+mempool: transactions pay to addresses drawn with Zipf weights from a
+pool, so popular addresses are touched by many, and many spend outputs
+of other mempool transactions, forming deep unconfirmed chains.
+
+The cold sync of the whole mempool is timed first, then a run of
+steady-state refreshes: idle ones that find nothing new, ones that
+find new arrivals and evictions, and ones after a block confirms the
+oldest transactions.  Reported are the refresh times, the memory the
+mempool holds per transaction as counted by tracemalloc, the objects
+per transaction the garbage collector tracks, the sizes of the touched
+sets passed to on_mempool, and the time to compact the fee histogram.
+
+With --feed, the refreshes between blocks are given the changes since
+the previous refresh, as when following a ZMQ feed of the daemon's
+mempool, rather than all its hashes.  With --processes, the cold sync
+deserializes the transactions in that many processes.
+'''
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+import baseline
+from chain import COIN, INPUT_SCRIPT, p2pkh_script
+from electrumx.lib.hash import double_sha256, hash_to_hex_str, hex_str_to_hash
+from electrumx.lib.tx import Tx, TxInput, TxOutput, MINUS_1
+from electrumx.server.mempool import MemPool, MemPoolAPI
+
+BASELINE = os.path.join(baseline.BASELINE_DIR, 'mempool.json')
+METRICS = [
+    ('sync.seconds', False),
+    ('sync.bytes_per_tx', False),
+    ('sync.gc_objects_per_tx', False),
+    ('refreshes.idle.mean_seconds', False),
+    ('refreshes.churn.mean_seconds', False),
+    ('refreshes.block.mean_seconds', False),
+    ('histogram_seconds', False),
+]
+
+
+@dataclass
+class MempoolParams:
+    '''The shape of a synthetic mempool and its churn.'''
+    txs: int = 300_000
+    addresses: int = 100_000
+    # Exponent of the Zipf weights of addresses; higher values make a
+    # few addresses more popular
+    zipf: float = 1.0
+    # The chance an input spends an output of a mempool transaction,
+    # and the longest chain of unconfirmed ancestors
+    chained: float = 0.5
+    max_depth: int = 50
+    # Inputs and outputs per transaction are uniform over these ranges
+    inputs: tuple = (1, 3)
+    outputs: tuple = (1, 3)
+    # Refreshes after the cold sync; each finds arrivals new
+    # transactions and evictions fewer.  Every block_every refreshes a
+    # block confirms the oldest block_txs transactions
+    refreshes: int = 30
+    arrivals: int = 3000
+    evictions: int = 300
+    block_every: int = 10
+    block_txs: int = 30_000
+    seed: int = 0
+
+
+class MempoolGenerator:
+    '''Makes the transactions of a synthetic mempool and its churn, and
+    tracks the confirmed UTXO set the DB would have.'''
+
+    def __init__(self, params):
+        self.params = params
+        self.random = random.Random(params.seed)
+        self.scripts = [p2pkh_script(self.random.randbytes(20))
+                        for _ in range(params.addresses)]
+        self.cum_weights = []
+        total = 0
+        for rank in range(params.addresses):
+            total += 1 / (rank + 1) ** params.zipf
+            self.cum_weights.append(total)
+        # prevout -> (hashX, value) of confirmed unspent outputs
+        self.db_utxos = {}
+        # (prev_hash, prev_idx, value) of outputs available to spend:
+        # confirmed ones, and mempool ones in the order made
+        self.confirmed = []
+        self.unconfirmed = []
+        # tx_hash -> raw tx in arrival order, which is topological
+        self.raw_txs = {}
+        # tx_hash -> [prevouts spent, (hashX, value) outputs, depth,
+        # count of mempool spenders]
+        self.txs = {}
+        self.height = 1
+        # Confirmed outputs are never replenished, so seed enough for
+        # every input of every transaction made
+        arrivals = params.refreshes * params.arrivals
+        for _ in range((params.txs + arrivals) * params.inputs[1]):
+            prevout = (self.random.randbytes(32), self.random.randrange(4))
+            value = self.random.randrange(100_000_000, 1_000_000_000)
+            self.db_utxos[prevout] = (COIN.hashX_from_script(self.random.choice(self.scripts)),
+                                      value)
+            self.confirmed.append((*prevout, value))
+
+    def _pop(self, utxos, recent):
+        '''Remove a random one of the last recent UTXOs; return it.'''
+        if not utxos:
+            raise RuntimeError('no UTXOs left to spend')
+        n = len(utxos) - 1 - self.random.randrange(min(recent, len(utxos)))
+        utxos[n], utxos[-1] = utxos[-1], utxos[n]
+        return utxos.pop()
+
+    def _unconfirmed_input(self):
+        '''Return a mempool output to spend and its depth, or None.'''
+        while self.unconfirmed:
+            # Favouring recent outputs makes chains deep
+            utxo = self._pop(self.unconfirmed, 1000)
+            prev_hash = utxo[0]
+            parent = self.txs.get(prev_hash)
+            if parent:
+                if parent[2] < self.params.max_depth:
+                    parent[3] += 1
+                    return utxo, parent[2]
+            elif (prev_hash, utxo[1]) in self.db_utxos:
+                # The parent was confirmed
+                return utxo, 0
+        return None
+
+    def add_tx(self):
+        params = self.params
+        rand = self.random
+        spent = []
+        depth = 0
+        for _ in range(rand.randint(*params.inputs)):
+            utxo = None
+            if rand.random() < params.chained:
+                utxo = self._unconfirmed_input()
+            if utxo:
+                utxo, parent_depth = utxo
+                depth = max(depth, parent_depth)
+            else:
+                utxo = self._pop(self.confirmed, len(self.confirmed))
+            spent.append(utxo)
+        scripts = rand.choices(self.scripts, cum_weights=self.cum_weights,
+                               k=rand.randint(*params.outputs))
+        size = 10 + 148 * len(spent) + 34 * len(scripts)
+        value_in = sum(value for _, _, value in spent)
+        value = (value_in - min(value_in // 2, int(size * rand.lognormvariate(0, 1)))) \
+            // len(scripts)
+        tx = Tx(version=1,
+                inputs=[TxInput(prev_hash=prev_hash, prev_idx=prev_idx, script=INPUT_SCRIPT,
+                                sequence=MINUS_1) for prev_hash, prev_idx, _ in spent],
+                outputs=[TxOutput(value=value, pk_script=script) for script in scripts],
+                locktime=0, txid=None, wtxid=None)
+        raw_tx = tx.serialize()
+        tx_hash = double_sha256(raw_tx)
+        self.raw_txs[tx_hash] = raw_tx
+        self.txs[tx_hash] = [
+            [(prev_hash, prev_idx) for prev_hash, prev_idx, _ in spent],
+            [(COIN.hashX_from_script(script), value) for script in scripts],
+            depth + 1,
+            0,
+        ]
+        self.unconfirmed.extend((tx_hash, idx, value) for idx in range(len(scripts)))
+
+    def evict_tx(self):
+        '''Evict a random transaction with no mempool spenders.'''
+        for _ in range(100):
+            tx_hash = self.random.choice(self.unconfirmed)[0]
+            tx = self.txs.get(tx_hash)
+            if tx and not tx[3]:
+                break
+        else:
+            return
+        del self.raw_txs[tx_hash]
+        prevouts, out_pairs, _depth, _spenders = self.txs.pop(tx_hash)
+        # Its prevouts can be spent again; its outputs are skipped when
+        # next drawn
+        for prev_hash, prev_idx in prevouts:
+            parent = self.txs.get(prev_hash)
+            if parent:
+                parent[3] -= 1
+                value = parent[1][prev_idx][1]
+                self.unconfirmed.append((prev_hash, prev_idx, value))
+            else:
+                value = self.db_utxos[(prev_hash, prev_idx)][1]
+                self.confirmed.append((prev_hash, prev_idx, value))
+
+    def mine_block(self):
+        '''Confirm the oldest transactions.'''
+        self.height += 1
+        for tx_hash in list(self.raw_txs)[:self.params.block_txs]:
+            del self.raw_txs[tx_hash]
+            prevouts, out_pairs, _depth, _spenders = self.txs.pop(tx_hash)
+            for prevout in prevouts:
+                del self.db_utxos[prevout]
+            for idx, pair in enumerate(out_pairs):
+                self.db_utxos[(tx_hash, idx)] = pair
+
+
+class API(MemPoolAPI):
+    '''Serves the generator's mempool and confirmed UTXOs.'''
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.touched = []
+
+    async def height(self):
+        return self.generator.height
+
+    def cached_height(self):
+        return self.generator.height
+
+    def db_height(self):
+        return self.generator.height
+
+    async def mempool_hashes(self):
+        return [hash_to_hex_str(tx_hash) for tx_hash in self.generator.raw_txs]
+
+    async def raw_transactions(self, hex_hashes):
+        raw_txs = self.generator.raw_txs
+        return [raw_txs.get(hex_str_to_hash(hex_hash)) for hex_hash in hex_hashes]
+
+    async def lookup_utxos(self, prevouts):
+        db_utxos = self.generator.db_utxos
+        return [db_utxos.get(prevout) for prevout in prevouts]
+
+    async def on_mempool(self, touched, height):
+        self.touched.append(len(touched))
+
+
+async def refresh(mempool, api, feed_hashes=None):
+    '''Refresh the mempool as its refresh loop does; return the seconds
+    taken and the size of the touched set.
+
+    If feed_hashes is given, the refresh applies the changes to it that
+    a feed would give, and updates it.'''
+    changes = None
+    if feed_hashes is not None:
+        # Made by the daemon, so untimed
+        hashes = set(api.generator.raw_txs)
+        changes = (hashes - feed_hashes, feed_hashes - hashes)
+    start = time.perf_counter()
+    height = api.cached_height()
+    if changes is not None:
+        feed_hashes.difference_update(changes[1])
+        feed_hashes.update(changes[0])
+        hashes = feed_hashes
+    else:
+        hashes = {hex_str_to_hash(hex_hash) for hex_hash in await api.mempool_hashes()}
+    touched = set()
+    await mempool._process_mempool(hashes, touched, height, changes)
+    await api.on_mempool(touched, height)
+    return time.perf_counter() - start, len(touched)
+
+
+def summary(samples):
+    times = [elapsed for elapsed, _ in samples]
+    touched = [count for _, count in samples]
+    return {
+        'count': len(samples),
+        'mean_seconds': round(sum(times) / len(times), 4),
+        'max_seconds': round(max(times), 4),
+        'mean_touched': round(sum(touched) / len(touched), 1),
+        'max_touched': max(touched),
+    }
+
+
+async def run(params, feed, processes):
+    print('generating the mempool...')
+    generator = MempoolGenerator(params)
+    for _ in range(params.txs):
+        generator.add_tx()
+    depths = [tx[2] for tx in generator.txs.values()]
+    api = API(generator)
+
+    print(f'syncing {params.txs:,d} transactions...')
+    mempool = MemPool(COIN, api, processes=processes)
+    mempool._start_processes()
+    sync_seconds, sync_touched = await refresh(mempool, api)
+    mempool._stop_processes()
+
+    # Sync again, traced, for the memory and GC-tracked objects held;
+    # the API's own allocations predate tracing
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    try:
+        traced = MemPool(COIN, api)
+        await refresh(traced, api)
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    gc_objects = len(gc.get_objects()) - objects
+    del traced
+
+    start = time.perf_counter()
+    mempool._update_histogram(COIN.MEMPOOL_COMPACT_HISTOGRAM_BINSIZE)
+    histogram_seconds = time.perf_counter() - start
+
+    print(f'running {params.refreshes:,d} refreshes...')
+    refreshes = {'idle': [], 'churn': [], 'block': []}
+    feed_hashes = set(generator.raw_txs) if feed else None
+    for n in range(1, params.refreshes + 1):
+        refreshes['idle'].append(await refresh(mempool, api, feed_hashes))
+        if n % params.block_every:
+            for _ in range(params.evictions):
+                generator.evict_tx()
+            for _ in range(params.arrivals):
+                generator.add_tx()
+            refreshes['churn'].append(await refresh(mempool, api, feed_hashes))
+        else:
+            # A feed resyncs after a block
+            generator.mine_block()
+            refreshes['block'].append(await refresh(mempool, api))
+            if feed:
+                feed_hashes = set(generator.raw_txs)
+    if len(mempool.txs) != len(generator.raw_txs):
+        print(f'warning: the mempool has {len(mempool.txs):,d} txs; '
+              f'the daemon {len(generator.raw_txs):,d}')
+
+    return {
+        'mempool': {
+            'txs': len(depths),
+            'mean_depth': round(sum(depths) / len(depths), 2),
+            'max_depth': max(depths),
+            'addresses_touched': len(mempool.hashXs),
+        },
+        'sync': {
+            'seconds': round(sync_seconds, 3),
+            'tx_per_sec': round(len(depths) / sync_seconds, 1),
+            'touched': sync_touched,
+            'bytes_per_tx': round(held / len(depths), 1),
+            'gc_objects_per_tx': round(gc_objects / len(depths), 2),
+        },
+        'refreshes': {kind: summary(samples) for kind, samples in refreshes.items()
+                      if samples},
+        'histogram_seconds': round(histogram_seconds, 4),
+        'peak_rss_mb': round(baseline.peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = MempoolParams()
+    for name in ('txs', 'addresses', 'max_depth', 'refreshes', 'arrivals', 'evictions',
+                 'block_every', 'block_txs', 'seed'):
+        parser.add_argument(f'--{name.replace("_", "-")}', type=int,
+                            default=getattr(defaults, name))
+    parser.add_argument('--zipf', type=float, default=defaults.zipf)
+    parser.add_argument('--chained', type=float, default=defaults.chained)
+    parser.add_argument('--feed', action='store_true',
+                        help='refresh from the changes a ZMQ feed would give')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='processes to deserialize transactions in for the cold sync')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help=f'results to compare with (default: {BASELINE})')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional change counted as a regression')
+    args = vars(parser.parse_args())
+    baseline_path = os.path.abspath(args.pop('baseline'))
+    save, tolerance = args.pop('save'), args.pop('tolerance')
+    feed = args.pop('feed')
+    processes = args.pop('processes')
+    params = MempoolParams(**args)
+
+    results = asyncio.run(run(params, feed, processes))
+    stats, sync = results['mempool'], results['sync']
+    print(f'{stats["txs"]:,d} txs touching {stats["addresses_touched"]:,d} addresses, '
+          f'chain depth mean {stats["mean_depth"]:.2f} max {stats["max_depth"]:,d}')
+    print(f'cold sync: {sync["seconds"]:,.2f}s, {sync["tx_per_sec"]:,.0f} tx/sec, '
+          f'{sync["bytes_per_tx"]:,.0f} bytes/tx, {sync["touched"]:,d} touched')
+    print(f'{"refresh":<8} {"count":>6} {"mean s":>8} {"max s":>8} {"mean touched":>13} '
+          f'{"max touched":>12}')
+    for kind, stats in results['refreshes'].items():
+        print(f'{kind:<8} {stats["count"]:>6,d} {stats["mean_seconds"]:>8.4f} '
+              f'{stats["max_seconds"]:>8.4f} {stats["mean_touched"]:>13,.1f} '
+              f'{stats["max_touched"]:>12,d}')
+    print(f'fee histogram: {results["histogram_seconds"]:.4f}s')
+    print(f'GC: {sync["gc_objects_per_tx"]:,.2f} tracked objects/tx')
+    print(f'peak RSS: {results["peak_rss_mb"]:,.1f}MB')
+
+    results = {'params': {**asdict(params), 'feed': feed, 'processes': processes},
+               'machine': baseline.machine(),
+               **results}
+    if save:
+        baseline.save(results, baseline_path)
+        return
+    old = baseline.load(baseline_path)
+    if old and baseline.compare(results, old, METRICS, tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
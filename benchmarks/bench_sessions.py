@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark of serving wallet sessions.
+
+A local ElectrumX server syncs a synthetic chain from a fake daemon,
+and electrumx_loadtest then runs wallet sessions against it using the
+chain's scripthashes.  Reported are the requests served per second,
+the latency percentiles and errors of each method, and the peak RSS
+of the server.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from dataclasses import asdict
+
+import baseline
+from chain import ChainParams
+from fake_daemon import DaemonProcess, chain_daemon
+from electrumx.cli.electrumx_loadtest import LoadParams, LoadTest, print_results
+
+BASELINE = os.path.join(baseline.BASELINE_DIR, 'sessions.json')
+
+
+def daemon_request(url, method, *params):
+    # urllib does not take credentials in URLs; the fake daemon needs none
+    request = urllib.request.Request(
+        url.replace('user:pass@', ''),
+        data=json.dumps({'method': method, 'params': params, 'id': 0}).encode())
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)['result']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb(pid):
+    '''The peak RSS of a process in MB, if the OS tells us.'''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def wait_for_server(process, port, timeout, log_path):
+    '''Wait for the server to sync and listen on port.'''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    with open(log_path) as f:
+        sys.stderr.write(f.read()[-5000:])
+    raise RuntimeError('the server did not start serving')
+
+
+def server_environ(args, daemon_url, db_dir, port):
+    environ = dict(os.environ)
+    environ.update({
+        'COIN': 'BitcoinSV',
+        'NET': 'regtest',
+        'DAEMON_URL': daemon_url,
+        'DB_DIRECTORY': db_dir,
+        'DB_ENGINE': args.db_engine,
+        'SERVICES': f'{args.protocol}://127.0.0.1:{port},rpc://127.0.0.1:{free_port()}',
+        'PEER_DISCOVERY': 'off',
+        'PEER_ANNOUNCE': '',
+        # The sessions all come from one address
+        'COST_SOFT_LIMIT': '0',
+        'COST_HARD_LIMIT': '0',
+        'MAX_SESSIONS': str(args.sessions * 2),
+        'QUERY_WORKERS': str(args.query_workers),
+        # So the server imports the ElectrumX we do
+        'PYTHONPATH': os.pathsep.join(path for path in sys.path if path),
+    })
+    return environ
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load_defaults = LoadParams()
+    parser.add_argument('--blocks', type=int, default=300)
+    parser.add_argument('--txs-per-block', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=500)
+    parser.add_argument('--ramp', type=float, default=10.0)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--addresses', type=int, default=load_defaults.addresses)
+    parser.add_argument('--history-rate', type=float, default=30.0)
+    parser.add_argument('--listunspent-rate', type=float, default=30.0)
+    parser.add_argument('--merkle-rate', type=float, default=15.0)
+    parser.add_argument('--protocol', choices=('tcp', 'ws'), default='ws',
+                        help='tcp replies are padded and can be held back for up '
+                        'to a second, so their latencies hide the server\'s work')
+    parser.add_argument('--db-engine', default='leveldb')
+    parser.add_argument('--query-workers', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE,
+                        help=f'results to compare with (default: {BASELINE})')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional change counted as a regression')
+    args = parser.parse_args()
+
+    chain_params = ChainParams(blocks=args.blocks, txs_per_block=args.txs_per_block,
+                               reorgs=0)
+    load_params = LoadParams(host='127.0.0.1', port=free_port(), protocol=args.protocol,
+                             sessions=args.sessions,
+                             ramp=args.ramp, duration=args.duration,
+                             addresses=args.addresses, history_rate=args.history_rate,
+                             listunspent_rate=args.listunspent_rate,
+                             merkle_rate=args.merkle_rate)
+
+    print('generating the chain...')
+    with DaemonProcess(chain_daemon, chain_params) as daemon_process, \
+            tempfile.TemporaryDirectory() as db_dir:
+        scripthashes = daemon_request(daemon_process.url, 'bench_scripthashes')
+        log_path = os.path.join(db_dir, 'server.log')
+        print('syncing the server...')
+        with open(log_path, 'w') as log:
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'electrumx.cli.electrumx_server'], stdout=log,
+                stderr=subprocess.STDOUT,
+                env=server_environ(args, daemon_process.url, db_dir, load_params.port))
+        try:
+            wait_for_server(server, load_params.port, 600, log_path)
+            print(f'running {args.sessions:,d} sessions...')
+            results = asyncio.run(LoadTest(load_params, scripthashes).run())
+            server_rss = peak_rss_mb(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print_results(results)
+    if server_rss:
+        print(f'server peak RSS: {server_rss:,.1f}MB')
+    params = asdict(load_params)
+    del params['port']
+    results = {
+        'params': {**asdict(chain_params), **params, 'db_engine': args.db_engine,
+                   'query_workers': args.query_workers},
+        'machine': baseline.machine(),
+        'load': results,
+        'server_peak_rss_mb': server_rss,
+    }
+    baseline_path = os.path.abspath(args.baseline)
+    if args.save:
+        baseline.save(results, baseline_path)
+        return
+    old = baseline.load(baseline_path)
+    if old:
+        metrics = [('load.requests_per_sec', True), ('server_peak_rss_mb', False)]
+        for method in results['load']['methods']:
+            metrics.append((('load', 'methods', method, 'p50_ms'), False))
+            metrics.append((('load', 'methods', method, 'p99_ms'), False))
+        if baseline.compare(results, old, metrics, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
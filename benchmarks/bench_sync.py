@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark of block processing: an initial sync and reorgs.
+
+A fake daemon in a child process serves a synthetic chain.  The block
+processor syncs it into a new DB, and then follows some reorgs of its
+tip.  Reported are transactions processed per second, flush times,
+peak RSS and the time spent in each phase of processing.  Fetching
+from the daemon overlaps the other phases; processing includes
+indexing and the flushes made when the cache fills.
+'''
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import asdict
+from functools import wraps
+
+import baseline
+from chain import ChainParams
+from fake_daemon import DaemonProcess, chain_daemon
+from electrumx.lib.hash import hex_str_to_hash
+from electrumx.server.db import DB
+from electrumx.server.env import Env
+
+BASELINE = os.path.join(baseline.BASELINE_DIR, 'sync.json')
+METRICS = [
+    ('sync.tx_per_sec', True),
+    ('sync.seconds', False),
+    ('flushes.utxo.seconds', False),
+    ('flushes.history.seconds', False),
+    ('phases.process', False),
+    ('phases.index', False),
+    ('reorgs.mean_seconds', False),
+    ('peak_rss_mb', False),
+]
+
+
+class Timings:
+    '''Accumulates the time spent in the methods it instruments.'''
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.flushes = {'utxo': [], 'history': []}
+
+    def add(self, phase, func):
+        '''Time calls of func against phase.'''
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.phases[phase] += time.perf_counter() - start
+        else:
+            @wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.phases[phase] += time.perf_counter() - start
+        return timed
+
+    def instrument(self, bp):
+        daemon, db = bp.daemon, bp.db
+        daemon.block_hex_hashes = self.add('fetch', daemon.block_hex_hashes)
+        daemon.raw_blocks = self.add('fetch', daemon.raw_blocks)
+        bp.check_and_advance_blocks = self.add('process', bp.check_and_advance_blocks)
+        bp.advance_blocks = self.add('index', bp.advance_blocks)
+        bp.backup_blocks = self.add('backup', bp.backup_blocks)
+        db.flush_backup = self.add('backup', db.flush_backup)
+        flush_dbs = db.flush_dbs
+
+        def timed_flush(flush_data, flush_utxos, estimate_txs_remaining):
+            start = time.perf_counter()
+            flush_dbs(flush_data, flush_utxos, estimate_txs_remaining)
+            kind = 'utxo' if flush_utxos else 'history'
+            self.flushes[kind].append(time.perf_counter() - start)
+
+        db.flush_dbs = timed_flush
+
+    def results(self):
+        return {
+            'phases': {phase: round(secs, 3) for phase, secs in self.phases.items()},
+            'flushes': {kind: {'count': len(times), 'seconds': round(sum(times), 3),
+                               'max_seconds': round(max(times, default=0), 3)}
+                        for kind, times in self.flushes.items()},
+        }
+
+
+class Notifications:
+
+    async def on_block(self, touched, height):
+        pass
+
+
+async def wait_or_fail(task, coro):
+    '''Wait for coro, raising the exception of task if it finishes first.'''
+    waiter = asyncio.ensure_future(coro)
+    await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+    if not waiter.done():
+        waiter.cancel()
+        task.result()
+        raise RuntimeError('block processor stopped')
+    return waiter.result()
+
+
+async def wait_for_tip(bp, hex_hash):
+    tip = hex_str_to_hash(hex_hash)
+    while bp.tip != tip:
+        await asyncio.sleep(0.005)
+
+
+async def run(params):
+    env = Env()
+    timings = Timings()
+    async with env.coin.DAEMON(env.coin, env.daemon_url) as daemon:
+        db = DB(env)
+        bp = env.coin.BLOCK_PROCESSOR(env, db, daemon, Notifications())
+        timings.instrument(bp)
+
+        caught_up_event = asyncio.Event()
+        start = time.perf_counter()
+        task = asyncio.ensure_future(bp.fetch_and_process_blocks(caught_up_event))
+        await wait_or_fail(task, caught_up_event.wait())
+        sync_secs = time.perf_counter() - start
+        tx_count, height = bp.tx_count, bp.height
+
+        # Each reorg is a switch to a branch, then to a longer one
+        reorg_times = []
+        for index in range(1, 2 * params.reorgs + 1):
+            status = await daemon._send_single('bench_switch', (index, ))
+            start = time.perf_counter()
+            await wait_or_fail(task, wait_for_tip(bp, status['tip']))
+            if index % 2 == 0:
+                reorg_times.append(time.perf_counter() - start)
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        db.utxo_db.close()
+        db.history.close_db()
+
+    results = {
+        'params': {**asdict(params), 'cache_mb': env.cache_MB, 'db_engine': env.db_engine,
+                   'sync_processes': env.sync_processes},
+        'machine': baseline.machine(),
+        'sync': {'blocks': height, 'txs': tx_count, 'seconds': round(sync_secs, 3),
+                 'tx_per_sec': round(tx_count / sync_secs, 1)},
+        'reorgs': {'count': len(reorg_times),
+                   'mean_seconds': round(sum(reorg_times) / max(len(reorg_times), 1), 3)},
+        'peak_rss_mb': round(baseline.peak_rss_mb(), 1),
+    }
+    results.update(timings.results())
+    return results
+
+
+def print_results(results):
+    sync = results['sync']
+    print(f'synced {sync["blocks"]:,d} blocks, {sync["txs"]:,d} txs in '
+          f'{sync["seconds"]:.1f}s: {sync["tx_per_sec"]:,.0f} tx/sec')
+    for kind, flushes in results['flushes'].items():
+        print(f'{kind} flushes: {flushes["count"]:,d} taking {flushes["seconds"]:.2f}s, '
+              f'longest {flushes["max_seconds"]:.2f}s')
+    for phase, secs in sorted(results['phases'].items()):
+        print(f'{phase}: {secs:.2f}s')
+    reorgs = results['reorgs']
+    print(f'reorgs: {reorgs["count"]:,d} taking {reorgs["mean_seconds"]:.3f}s on average')
+    print(f'peak RSS: {results["peak_rss_mb"]:,.1f}MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = ChainParams()
+    parser.add_argument('--blocks', type=int, default=defaults.blocks)
+    parser.add_argument('--txs-per-block', type=int, default=defaults.txs_per_block)
+    parser.add_argument('--inputs', type=int, nargs=2, default=defaults.inputs,
+                        metavar=('MIN', 'MAX'), help='inputs per transaction')
+    parser.add_argument('--outputs', type=int, nargs=2, default=defaults.outputs,
+                        metavar=('MIN', 'MAX'), help='outputs per transaction')
+    parser.add_argument('--address-reuse', type=float, default=defaults.address_reuse,
+                        help='chance an output pays to an address already used')
+    parser.add_argument('--reorgs', type=int, default=defaults.reorgs)
+    parser.add_argument('--reorg-depth', type=int, default=defaults.reorg_depth)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--cache-mb', type=int, default=100)
+    parser.add_argument('--db-engine', default='leveldb')
+    parser.add_argument('--sync-processes', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE,
+                        help=f'results to compare with (default: {BASELINE})')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional change counted as a regression')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the log of the block processor')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s:%(name)s:%(message)s')
+    params = ChainParams(blocks=args.blocks, txs_per_block=args.txs_per_block,
+                         inputs=tuple(args.inputs), outputs=tuple(args.outputs),
+                         address_reuse=args.address_reuse, reorgs=args.reorgs,
+                         reorg_depth=args.reorg_depth, seed=args.seed)
+    baseline_path = os.path.abspath(args.baseline)
+    cwd = os.getcwd()
+
+    print('generating the chain...')
+    with DaemonProcess(chain_daemon, params) as daemon_process, \
+            tempfile.TemporaryDirectory() as db_dir:
+        os.environ.update({
+            'COIN': 'BitcoinSV',
+            'NET': 'regtest',
+            'DAEMON_URL': daemon_process.url,
+            'DB_DIRECTORY': db_dir,
+            'DB_ENGINE': args.db_engine,
+            'CACHE_MB': str(args.cache_mb),
+            'SYNC_PROCESSES': str(args.sync_processes),
+            'DAEMON_POLL_INTERVAL_BLOCKS': '50',
+        })
+        try:
+            results = asyncio.run(run(params))
+        finally:
+            # The DB changes directory into db_dir
+            os.chdir(cwd)
+
+    print_results(results)
+    if args.save:
+        baseline.save(results, baseline_path)
+        return
+    old = baseline.load(baseline_path)
+    if old and baseline.compare(results, old, METRICS, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Synthetic chain generation for the benchmarks.
+
+Blocks are BitcoinSV regtest blocks, starting from its genesis block,
+and are random but deterministic for a given seed.  Their transactions
+spend outputs of earlier blocks and pay to P2PKH scripts.
+'''
+
+import random
+from dataclasses import dataclass
+
+from electrumx.lib.coins import BitcoinSVRegtest
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.merkle import Merkle
+from electrumx.lib.tx import Tx, TxInput, TxOutput, ZERO, MINUS_1
+from electrumx.lib.util import pack_le_uint32, pack_varint
+
+COIN = BitcoinSVRegtest
+GENESIS_HEADER = bytes.fromhex(
+    '0100000000000000000000000000000000000000000000000000000000000000'
+    '000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa'
+    '4b1e5e4adae5494dffff7f2002000000')
+# About the size of a signature and public key
+INPUT_SCRIPT = bytes(107)
+
+
+@dataclass
+class ChainParams:
+    '''The shape of a synthetic chain.'''
+    blocks: int = 1000
+    txs_per_block: int = 200
+    # Inputs and outputs per transaction are uniform over these ranges
+    inputs: tuple = (1, 3)
+    outputs: tuple = (1, 3)
+    # The chance an output pays to an address already used
+    address_reuse: float = 0.3
+    # Reorgs after the initial sync, and the blocks each replaces
+    reorgs: int = 3
+    reorg_depth: int = 3
+    seed: int = 0
+
+
+def p2pkh_script(hash160):
+    return b'\x76\xa9\x14' + hash160 + b'\x88\xac'
+
+
+class ChainGenerator:
+    '''Makes the raw blocks of a chain.  Branches for reorgs are made from
+    copies of the generator.'''
+
+    merkle = Merkle()
+
+    def __init__(self, params):
+        self.params = params
+        self.random = random.Random(params.seed)
+        self.addresses = []
+        # (tx_hash, idx, value) of the outputs available to spend
+        self.utxos = []
+        self.height = 0
+        self.tip = COIN.header_hash(GENESIS_HEADER)
+
+    def copy(self, seed):
+        '''Return a copy of the generator making different blocks.'''
+        result = ChainGenerator.__new__(ChainGenerator)
+        result.params = self.params
+        result.random = random.Random(seed)
+        result.addresses = list(self.addresses)
+        result.utxos = list(self.utxos)
+        result.height = self.height
+        result.tip = self.tip
+        return result
+
+    def genesis_block(self):
+        # ElectrumX replaces the genesis block with its header
+        return GENESIS_HEADER + b'\0'
+
+    def _pk_script(self):
+        if self.addresses and self.random.random() < self.params.address_reuse:
+            hash160 = self.random.choice(self.addresses)
+        else:
+            hash160 = self.random.randbytes(20)
+            self.addresses.append(hash160)
+        return p2pkh_script(hash160)
+
+    def _tx(self, inputs, value):
+        count = self.random.randint(*self.params.outputs)
+        outputs = [TxOutput(value=value // count, pk_script=self._pk_script())
+                   for _ in range(count)]
+        tx = Tx(version=1, inputs=inputs, outputs=outputs, locktime=0, txid=None, wtxid=None)
+        raw_tx = tx.serialize()
+        return raw_tx, double_sha256(raw_tx), outputs
+
+    def _spend(self, count):
+        '''Remove count random UTXOs from those available; return them.'''
+        utxos = self.utxos
+        result = []
+        for _ in range(count):
+            n = self.random.randrange(len(utxos))
+            utxos[n], utxos[-1] = utxos[-1], utxos[n]
+            result.append(utxos.pop())
+        return result
+
+    def next_block(self):
+        '''Return the next raw block.'''
+        self.height += 1
+        coinbase_input = TxInput(prev_hash=ZERO, prev_idx=MINUS_1,
+                                 script=pack_le_uint32(self.height), sequence=MINUS_1)
+        txs = [self._tx([coinbase_input], 50 * 100_000_000)]
+        for _ in range(self.params.txs_per_block - 1):
+            count = min(self.random.randint(*self.params.inputs), len(self.utxos))
+            if not count:
+                break
+            spent = self._spend(count)
+            inputs = [TxInput(prev_hash=tx_hash, prev_idx=idx, script=INPUT_SCRIPT,
+                              sequence=MINUS_1) for tx_hash, idx, _value in spent]
+            txs.append(self._tx(inputs, sum(value for _, _, value in spent)))
+        # Outputs are spendable from the next block
+        for _raw_tx, tx_hash, outputs in txs:
+            self.utxos.extend((tx_hash, idx, output.value) for idx, output in enumerate(outputs))
+
+        root = self.merkle.root([tx_hash for _, tx_hash, _ in txs])
+        header = b''.join((pack_le_uint32(1), self.tip, root,
+                           pack_le_uint32(1_600_000_000 + self.height * 600),
+                           pack_le_uint32(0x207fffff), pack_le_uint32(self.height)))
+        self.tip = COIN.header_hash(header)
+        return header + pack_varint(len(txs)) + b''.join(raw_tx for raw_tx, _, _ in txs)
+
+
+def make_chains(params):
+    '''Return a list of chains for a daemon to serve in turn, each a list of
+    raw blocks by height.
+
+    The first is the chain to sync.  Each reorg is then a pair: the
+    chain extended by a branch of reorg_depth blocks, and the chain
+    extended instead by a branch one block longer.
+    '''
+    generator = ChainGenerator(params)
+    chain = [generator.genesis_block()]
+    chain.extend(generator.next_block() for _ in range(params.blocks))
+    chains = [chain]
+    for n in range(params.reorgs):
+        stale = generator.copy(seed=f'{params.seed}-{n}')
+        chains.append(chain + [stale.next_block() for _ in range(params.reorg_depth)])
+        chain = chain + [generator.next_block() for _ in range(params.reorg_depth + 1)]
+        chains.append(chain)
+    return chains
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Script to load-test an ElectrumX server with simulated wallet sessions.'''
+
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import ssl
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+from aiorpcx import RPCError, RPCSession, TaskTimeout, connect_rs, connect_ws
+
+
+@dataclass
+class LoadParams:
+    '''The load of a test.'''
+    host: str = 'localhost'
+    port: int = 50001
+    protocol: str = 'tcp'
+    sessions: int = 100
+    # Seconds over which sessions are opened
+    ramp: float = 10.0
+    # Seconds sessions stay open for after the last is opened
+    duration: float = 60.0
+    # The mean number of scripthashes a wallet subscribes to
+    addresses: int = 20
+    # Scripthashes are drawn from the pool with Zipf weights of this
+    # exponent; higher values share a few scripthashes between more wallets
+    zipf: float = 0.8
+    # Calls per session per minute
+    history_rate: float = 2.0
+    listunspent_rate: float = 2.0
+    merkle_rate: float = 1.0
+    seed: int = 0
+
+
+class Stats:
+    '''Latencies and errors by method.'''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.notifications = 0
+        self.open_sessions = 0
+        self.max_sessions = 0
+
+    def report(self, elapsed):
+        def percentile(values, fraction):
+            return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+        result = {}
+        for method in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[method])
+            count = len(latencies)
+            errors = self.errors[method]
+            result[method] = {
+                'count': count,
+                'errors': errors,
+                'error_rate': round(errors / (count + errors), 4),
+                'per_sec': round(count / elapsed, 1),
+            }
+            if latencies:
+                result[method].update({
+                    f'p{n}_ms': round(percentile(latencies, n / 100), 2)
+                    for n in (50, 90, 99)})
+                result[method]['max_ms'] = round(latencies[-1] * 1000, 2)
+        return result
+
+
+class Disconnected(Exception):
+    '''Raised when the server closes a session.'''
+
+
+class WalletSession(RPCSession):
+    '''A client session that counts the server's notifications.'''
+
+    stats = None
+
+    async def handle_request(self, request):
+        self.stats.notifications += 1
+
+
+class LoadTest:
+    '''Runs simulated wallet sessions against a server.
+
+    Each session negotiates the protocol version, subscribes to headers
+    and to its scripthashes, and then calls get_history, listunspent
+    and get_merkle at random with the configured mean rates.
+    '''
+
+    def __init__(self, params, scripthashes):
+        self.params = params
+        self.random = random.Random(params.seed)
+        if not scripthashes:
+            # Unknown to the server, so with empty histories
+            scripthashes = [self.random.randbytes(32).hex() for _ in range(100_000)]
+        self.scripthashes = scripthashes
+        weights = [1 / (rank + 1) ** params.zipf for rank in range(len(scripthashes))]
+        self.cum_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+        self.stats = Stats()
+        self.deadline = None
+
+    def wallet_scripthashes(self):
+        '''Return the scripthashes of a new wallet.'''
+        count = max(1, round(self.random.expovariate(1 / self.params.addresses)))
+        total = self.cum_weights[-1]
+        indices = {bisect.bisect(self.cum_weights, self.random.random() * total)
+                   for _ in range(count)}
+        return [self.scripthashes[min(index, len(self.scripthashes) - 1)]
+                for index in indices]
+
+    def connect(self):
+        params = self.params
+        session_factory = type('Session', (WalletSession, ), {'stats': self.stats})
+        context = None
+        if params.protocol in ('ssl', 'wss'):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if params.protocol in ('ws', 'wss'):
+            return connect_ws(f'{params.protocol}://{params.host}:{params.port}',
+                              ssl=context, session_factory=session_factory)
+        return connect_rs(params.host, params.port, ssl=context,
+                          session_factory=session_factory)
+
+    async def call(self, session, method, *args):
+        if session.is_closing():
+            raise Disconnected
+        start = time.perf_counter()
+        try:
+            result = await session.send_request(method, args)
+        except (RPCError, TaskTimeout):
+            self.stats.errors[method] += 1
+            return None
+        except asyncio.CancelledError:
+            # Pending requests are cancelled if the server disconnects
+            if session.is_closing():
+                self.stats.errors[method] += 1
+                raise Disconnected from None
+            raise
+        self.stats.latencies[method].append(time.perf_counter() - start)
+        return result
+
+    async def wallet(self):
+        params = self.params
+        stats = self.stats
+        scripthashes = self.wallet_scripthashes()
+        rates = {
+            'blockchain.scripthash.get_history': params.history_rate,
+            'blockchain.scripthash.listunspent': params.listunspent_rate,
+            'blockchain.transaction.get_merkle': params.merkle_rate,
+        }
+        total_rate = sum(rates.values()) / 60
+        methods, weights = list(rates), list(rates.values())
+        # Confirmed (tx_hash, height) pairs, for get_merkle
+        confirmed = []
+
+        try:
+            async with self.connect() as session:
+                session.sent_request_timeout = 60
+                stats.open_sessions += 1
+                stats.max_sessions = max(stats.max_sessions, stats.open_sessions)
+                try:
+                    await self.call(session, 'server.version', 'electrumx_loadtest', '1.4')
+                    await self.call(session, 'blockchain.headers.subscribe')
+                    for scripthash in scripthashes:
+                        await self.call(session, 'blockchain.scripthash.subscribe', scripthash)
+                    while total_rate:
+                        delay = self.random.expovariate(total_rate)
+                        if time.monotonic() + delay > self.deadline:
+                            break
+                        await asyncio.sleep(delay)
+                        method = self.random.choices(methods, weights)[0]
+                        if method == 'blockchain.transaction.get_merkle':
+                            if confirmed:
+                                tx_hash, height = self.random.choice(confirmed)
+                                await self.call(session, method, tx_hash, height)
+                            continue
+                        result = await self.call(session, method,
+                                                 self.random.choice(scripthashes))
+                        if method == 'blockchain.scripthash.get_history' and result:
+                            confirmed.extend((item['tx_hash'], item['height'])
+                                             for item in result if item['height'] > 0)
+                    await asyncio.sleep(max(0, self.deadline - time.monotonic()))
+                finally:
+                    stats.open_sessions -= 1
+        except OSError:
+            stats.errors['connect'] += 1
+        except Disconnected:
+            stats.errors['disconnect'] += 1
+
+    async def run(self):
+        '''Run the test and return its results.'''
+        params = self.params
+        start = time.monotonic()
+        self.deadline = start + params.ramp + params.duration
+        interval = params.ramp / params.sessions
+        tasks = []
+        for n in range(params.sessions):
+            tasks.append(asyncio.create_task(self.wallet()))
+            await asyncio.sleep(max(0, start + (n + 1) * interval - time.monotonic()))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+        methods = self.stats.report(elapsed)
+        return {
+            'sessions': params.sessions,
+            'max_open_sessions': self.stats.max_sessions,
+            'seconds': round(elapsed, 1),
+            'requests_per_sec': round(sum(method['count'] for method in methods.values())
+                                      / elapsed, 1),
+            'notifications': self.stats.notifications,
+            'methods': methods,
+        }
+
+
+def print_results(results):
+    print(f'{results["sessions"]:,d} sessions ({results["max_open_sessions"]:,d} open at '
+          f'once) for {results["seconds"]:,.1f}s: {results["requests_per_sec"]:,.1f} '
+          f'requests/sec, {results["notifications"]:,d} notifications')
+    print(f'{"method":<34} {"count":>8} {"errors":>7} {"per sec":>8} {"p50 ms":>8} '
+          f'{"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for method, stats in results['methods'].items():
+        latencies = ''.join(f' {stats.get(key, 0):>8,.1f}'
+                            for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        print(f'{method:<34} {stats["count"]:>8,d} {stats["errors"]:>7,d} '
+              f'{stats["per_sec"]:>8,.1f}{latencies}')
+
+
+def main():
+    '''Load-test a server and print the results.'''
+    defaults = LoadParams()
+    parser = argparse.ArgumentParser(
+        'electrumx_loadtest',
+        description='Load-test an ElectrumX server with simulated wallet sessions'
+    )
+    parser.add_argument('--host', default=defaults.host)
+    parser.add_argument('-p', '--port', type=int, default=defaults.port)
+    parser.add_argument('--protocol', choices=('tcp', 'ssl', 'ws', 'wss'),
+                        default=defaults.protocol)
+    parser.add_argument('--sessions', type=int, default=defaults.sessions,
+                        help='number of wallet sessions')
+    parser.add_argument('--ramp', type=float, default=defaults.ramp,
+                        help='seconds over which to open the sessions')
+    parser.add_argument('--duration', type=float, default=defaults.duration,
+                        help='seconds to keep the sessions open once all are open')
+    parser.add_argument('--scripthashes', metavar='FILE',
+                        help='file of scripthashes for wallets to use, one per line '
+                        'in decreasing order of popularity; random ones if not given')
+    parser.add_argument('--addresses', type=int, default=defaults.addresses,
+                        help='mean number of scripthashes per wallet')
+    parser.add_argument('--zipf', type=float, default=defaults.zipf,
+                        help='exponent of the popularity of scripthashes')
+    parser.add_argument('--history-rate', type=float, default=defaults.history_rate,
+                        help='get_history calls per session per minute')
+    parser.add_argument('--listunspent-rate', type=float, default=defaults.listunspent_rate,
+                        help='listunspent calls per session per minute')
+    parser.add_argument('--merkle-rate', type=float, default=defaults.merkle_rate,
+                        help='get_merkle calls per session per minute')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = vars(parser.parse_args())
+
+    scripthashes = []
+    path = args.pop('scripthashes')
+    if path:
+        with open(path) as f:
+            scripthashes = [line.strip() for line in f if line.strip()]
+    as_json = args.pop('json')
+    results = asyncio.run(LoadTest(LoadParams(**args), scripthashes).run())
+    if as_json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+    errors = sum(stats['errors'] for stats in results['methods'].values())
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,14 @@ other_commands = {
             'help': 'e.g. "a.domain.name s995 t"',
         },
     ),
+    'checkpoint': (
+        'write a consistent copy of the databases while serving',
+        [], {
+            'type': str,
+            'dest': 'path',
+            'help': 'new directory, relative to DB_DIRECTORY if not absolute',
+        },
+    ),
     'daemon_url': (
         "replace the daemon's URL at run-time, and forecefully rotate "
         " to the first URL in the list",
@@ -16,6 +16,7 @@ import sys
 import electrumx
 from electrumx import Controller, Env
 from electrumx.lib.util import CompactFormatter, make_logger
+from electrumx.server.workers import QueryWorker
 
 
 def main():
@@ -34,8 +35,11 @@ def main():
         env = Env()
         logger.info(f'logging level: {env.log_level}')
         logger.setLevel(env.log_level)
-        controller = Controller(env)
-        asyncio.run(controller.run())
+        if env.query_worker_id is None:
+            server = Controller(env)
+        else:
+            server = QueryWorker(env)
+        asyncio.run(server.run())
     except Exception:
         logger.exception('ElectrumX server terminated abnormally')
     else:
@@ -100,7 +100,6 @@ class Coin:
     DEFAULT_MAX_SEND = 8_100_000
     DEFAULT_MAX_RECV = 1_000_000
 
-    MEMPOOL_HISTOGRAM_REFRESH_SECS = 500
     # first bin size in vbytes. smaller bins mean more precision but also bandwidth:
     MEMPOOL_COMPACT_HISTOGRAM_BINSIZE = 30_000
 
@@ -302,7 +301,6 @@ class BitcoinMixin:
 class Bitcoin(BitcoinMixin, Coin):
     NAME = "Bitcoin"
     DESERIALIZER = lib_tx.DeserializerSegWit
-    MEMPOOL_HISTOGRAM_REFRESH_SECS = 120
     TX_COUNT = 565436782
     TX_COUNT_HEIGHT = 646855
     TX_PER_BLOCK = 2200
@@ -32,6 +32,8 @@ import asyncio
 import inspect
 from ipaddress import ip_address
 import logging
+import os
+import shutil
 import sys
 from collections.abc import Container, Mapping
 from struct import Struct
@@ -220,6 +222,40 @@ class LogicalFile:
                 size -= len(part)
         return b''.join(parts)
 
+    def read_records(self, starts, size):
+        '''Return a list of the size-byte records at each offset in starts.
+
+        Offsets should be in increasing order so that each underlying
+        file is opened once.  Records not fully on disk are returned
+        short, possibly empty.'''
+        records = []
+        f = None
+        file_num = None
+        try:
+            for start in starts:
+                num, offset = divmod(start, self.file_size)
+                if offset + size > self.file_size:
+                    # Spans two files; rare so take the slow path
+                    records.append(self.read(start, size))
+                    continue
+                if num != file_num:
+                    if f:
+                        f.close()
+                    file_num = num
+                    try:
+                        f = open_file(self.filename_fmt.format(num))
+                    except FileNotFoundError:
+                        f = None
+                if f:
+                    f.seek(offset)
+                    records.append(f.read(size))
+                else:
+                    records.append(b'')
+        finally:
+            if f:
+                f.close()
+        return records
+
     def write(self, start, b):
         '''Write the bytes-like object, b, to the underlying virtual file.'''
         while b:
@@ -229,6 +265,24 @@ class LogicalFile:
             b = b[size:]
             start += size
 
+    def checkpoint(self, directory, size, fixed_size=0):
+        '''Save a copy of the first size bytes of the virtual file under
+        directory.
+
+        Underlying files wholly before offset fixed_size, which must
+        never be written again, are hard-linked rather than copied.
+        '''
+        for file_num in range((size + self.file_size - 1) // self.file_size):
+            filename = self.filename_fmt.format(file_num)
+            dest = os.path.join(directory, filename)
+            start = file_num * self.file_size
+            end = start + self.file_size
+            if end <= fixed_size:
+                link_or_copy(filename, dest)
+            else:
+                with open(dest, 'wb') as f:
+                    f.write(self.read(start, min(end, size) - start))
+
     def open_file(self, start, create):
         '''Open the virtual file and seek to start.  Return a file handle.
         Raise FileNotFoundError if the file does not exist and create
@@ -256,6 +310,15 @@ def open_truncate(filename):
     return open(filename, 'wb+')
 
 
+def link_or_copy(src, dest):
+    '''Hard-link src to dest, or copy it if they are on different
+    filesystems.'''
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
 def address_string(address):
     '''Return an address as a correctly formatted string.'''
     host, port = address
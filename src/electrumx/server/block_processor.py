@@ -10,10 +10,13 @@
 
 
 import asyncio
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from typing import Sequence, Tuple, List, Callable, Optional, TYPE_CHECKING, Type
 
-from aiorpcx import run_in_thread, CancelledError
+from aiorpcx import run_in_thread, CancelledError, ignore_after
 
 import electrumx
 from electrumx.server.daemon import DaemonError, Daemon
@@ -25,6 +28,7 @@ from electrumx.lib.util import (
 from electrumx.lib.tx import Tx
 from electrumx.server.db import FlushData, COMP_TXID_LEN, DB
 from electrumx.server.history import TXNUM_LEN
+from electrumx.server.zmq_feed import ZMQSubscriber
 
 if TYPE_CHECKING:
     from electrumx.lib.coins import Coin, Block
@@ -60,6 +64,8 @@ class Prefetcher:
         # This makes the first fetch be 10 blocks
         self.ave_size = self.min_cache_size // 10
         self.polling_delay = polling_delay_secs
+        # Set when the daemon announces a new block, to poll at once
+        self.new_block_event = asyncio.Event()
 
     async def main_loop(self, bp_height):
         '''Loop forever polling for more blocks.'''
@@ -69,7 +75,9 @@ class Prefetcher:
                 # Sleep a while if there is nothing to prefetch
                 await self.refill_event.wait()
                 if not await self._prefetch_blocks():
-                    await asyncio.sleep(self.polling_delay)
+                    async with ignore_after(self.polling_delay):
+                        await self.new_block_event.wait()
+                    self.new_block_event.clear()
             except DaemonError as e:
                 self.logger.info(f'ignoring daemon error: {e}')
             except asyncio.CancelledError as e:
@@ -78,6 +86,17 @@ class Prefetcher:
             except Exception:
                 self.logger.exception(f'ignoring unexpected exception')
 
+    async def follow_block_announcements(self, url):
+        '''Poll for blocks as soon as the daemon announces one on its ZMQ
+        "hashblock" topic at url, rather than after the polling delay.'''
+        subscriber = ZMQSubscriber(url, b'hashblock')
+        try:
+            while True:
+                await subscriber.receive()
+                self.new_block_event.set()
+        finally:
+            subscriber.close()
+
     def get_prefetched_blocks(self) -> Sequence[bytes]:
         '''Called by block processor when it is processing queued blocks.'''
         blocks = self.blocks
@@ -158,6 +177,47 @@ class Prefetcher:
         return True
 
 
+@dataclass(slots=True)
+class PreparedBlock:
+    '''A block as returned by prepare_blocks().'''
+    raw: bytes
+    header: bytes
+    # (txid, [(prev_hash, prev_idx) of inputs], [(idx, hashX, value) of outputs])
+    # with generation inputs and unspendable outputs left out
+    transactions: List[Tuple[bytes, List[Tuple[bytes, int]], List[Tuple[int, bytes, int]]]]
+
+
+def prepare_txs(txs, is_unspendable, script_hashX):
+    '''Return the transactions of a block in the form of the transactions
+    of a PreparedBlock.'''
+    return [(tx.txid,
+             [(txin.prev_hash, txin.prev_idx) for txin in tx.inputs
+              if not txin.is_generation()],
+             [(idx, script_hashX(txout.pk_script), txout.value)
+              for idx, txout in enumerate(tx.outputs)
+              if not is_unspendable(txout.pk_script)])
+            for tx in txs]
+
+
+def prepare_blocks(coin, raw_blocks, first_height):
+    '''Deserialize blocks and compute their txids and output hashXs.
+
+    This is the bulk of the work of indexing a block that does not
+    depend on the chain state, so the blocks of disjoint height ranges
+    can be prepared in parallel by separate processes.  The raw blocks
+    are not returned.
+    '''
+    script_hashX = coin.hashX_from_script
+    blocks = []
+    for height, raw_block in enumerate(raw_blocks, start=first_height):
+        block = coin.block(raw_block, height)
+        is_unspendable = (is_unspendable_genesis if height >= coin.GENESIS_ACTIVATION
+                          else is_unspendable_legacy)
+        txs = prepare_txs(block.transactions, is_unspendable, script_hashX)
+        blocks.append(PreparedBlock(b'', block.header, txs))
+    return blocks
+
+
 class ChainError(Exception):
     '''Raised on error processing blocks.'''
 
@@ -202,6 +262,9 @@ class BlockProcessor:
         # UTXO cache
         self.utxo_cache = {}
         self.db_deletes = []
+        # hashX -> [value_sats, utxo_count] of flushed UTXOs spent since
+        # the last flush; debited from the balance table when flushing
+        self.balance_spends = {}
 
         # If the lock is successfully acquired, in-memory chain state
         # is consistent with self.height
@@ -210,6 +273,12 @@ class BlockProcessor:
         # Signalled after backing up during a reorg
         self.backed_up_event = asyncio.Event()
 
+        # Processes preparing blocks during initial sync, if any
+        self.sync_executor = None
+
+        # The mempool, if it is to drop the txs of new blocks at once
+        self.mempool = None
+
     async def run_in_thread_with_lock(self, func, *args):
         # Run in a thread to prevent blocking.  Shielded so that
         # cancellations from shutdown don't lose work - when the task
@@ -228,8 +297,11 @@ class BlockProcessor:
         if not raw_blocks:
             return
         first = self.height + 1
-        blocks = [self.coin.block(raw_block, first + n)
-                  for n, raw_block in enumerate(raw_blocks)]
+        if self.sync_executor:
+            blocks = await self.prepare_in_processes(raw_blocks, first)
+        else:
+            blocks = [self.coin.block(raw_block, first + n)
+                      for n, raw_block in enumerate(raw_blocks)]
         headers = [block.header for block in blocks]
         hprevs = [self.coin.header_prevhash(h) for h in headers]
         chain = [self.tip] + [self.coin.header_hash(h) for h in headers[:-1]]
@@ -245,6 +317,10 @@ class BlockProcessor:
                                  f'in {time.monotonic() - start:.1f}s')
             if self._caught_up_event.is_set():
                 await self.notifications.on_block(self.touched, self.height)
+                if self.mempool:
+                    tx_hashes, spends = self.block_spends(blocks)
+                    await self.mempool.remove_confirmed(tx_hashes, spends, self.touched,
+                                                        self.height)
             self.touched = set()
         elif hprevs[0] != chain[0]:
             await self.reorg_chain()
@@ -258,6 +334,24 @@ class BlockProcessor:
                                 'resetting the prefetcher')
             await self.prefetcher.reset_height(self.height)
 
+    @staticmethod
+    def block_spends(blocks):
+        '''Return the set of hashes of the txs of the blocks, and the set of
+        (prev_hash, prev_idx) outpoints they spend.'''
+        tx_hashes = set()
+        spends = set()
+        for block in blocks:
+            if isinstance(block, PreparedBlock):
+                for tx_hash, prevouts, _outputs in block.transactions:
+                    tx_hashes.add(tx_hash)
+                    spends.update(prevouts)
+            else:
+                for tx in block.transactions:
+                    tx_hashes.add(tx.txid)
+                    spends.update((txin.prev_hash, txin.prev_idx) for txin in tx.inputs
+                                  if not txin.is_generation())
+        return tx_hashes, spends
+
     async def reorg_chain(self, count=None):
         '''Handle a chain reorganisation.
 
@@ -359,7 +453,7 @@ class BlockProcessor:
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
                          self.tx_hashes, self.undo_infos, self.utxo_cache,
-                         self.db_deletes, self.tip)
+                         self.db_deletes, self.balance_spends, self.tip)
 
     async def flush(self, flush_utxos):
         def flush():
@@ -384,7 +478,8 @@ class BlockProcessor:
         # requesting size from Python (see deep_getsizeof).
         one_MB = 1000*1000
         utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
+        db_deletes_size = (len(self.db_deletes) * 57
+                           + len(self.balance_spends) * 180)
         hist_cache_size = self.db.history.unflushed_memsize()
         # Roughly ntxs * 32 + nblocks * 42
         tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
@@ -416,7 +511,10 @@ class BlockProcessor:
             height += 1
             is_unspendable = (is_unspendable_genesis if height >= genesis_activation
                               else is_unspendable_legacy)
-            undo_info = self.advance_txs(block.transactions, is_unspendable)
+            if isinstance(block, PreparedBlock):
+                undo_info = self.advance_prepared_txs(block.transactions)
+            else:
+                undo_info = self.advance_txs(block.transactions, is_unspendable)
             if height >= min_height:
                 self.undo_infos.append((undo_info, height))
                 self.db.write_raw_block(block.raw, height)
@@ -433,12 +531,17 @@ class BlockProcessor:
             txs: Sequence[Tx],
             is_unspendable: Callable[[bytes], bool],
     ) -> Sequence[bytes]:
-        self.tx_hashes.append(b''.join(tx.txid for tx in txs))
+        return self.advance_prepared_txs(
+            prepare_txs(txs, is_unspendable, self.coin.hashX_from_script))
+
+    def advance_prepared_txs(self, txs) -> Sequence[bytes]:
+        '''Advance the transactions of a block, in the form of the
+        transactions of a PreparedBlock, and return its undo info.'''
+        self.tx_hashes.append(b''.join(txid for txid, _, _ in txs))
 
         # Use local vars for speed in the loops
         undo_info = []
         tx_num = self.tx_count
-        script_hashX = self.coin.hashX_from_script
         put_utxo = self.utxo_cache.__setitem__
         spend_utxo = self.spend_utxo
         undo_info_append = undo_info.append
@@ -448,31 +551,22 @@ class BlockProcessor:
         to_le_uint32 = pack_le_uint32
         to_le_uint64 = pack_le_uint64
 
-        for tx in txs:
-            tx_hash = tx.txid
+        for tx_hash, prevouts, outputs in txs:
             hashXs = []
             append_hashX = hashXs.append
             tx_numb = to_le_uint64(tx_num)[:TXNUM_LEN]
 
             # Spend the inputs
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
+            for prev_hash, prev_idx in prevouts:
+                cache_value = spend_utxo(prev_hash, prev_idx)
                 undo_info_append(cache_value)
                 append_hashX(cache_value[:HASHX_LEN])
 
             # Add the new UTXOs
-            for idx, txout in enumerate(tx.outputs):
-                # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
-                    continue
-
-                # Get the hashX
-                hashX = script_hashX(txout.pk_script)
+            for idx, hashX, value in outputs:
                 append_hashX(hashX)
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -485,6 +579,37 @@ class BlockProcessor:
 
         return undo_info
 
+    async def prepare_in_processes(self, raw_blocks, first_height):
+        '''Prepare blocks in the sync processes, each taking a contiguous
+        range of heights.'''
+        loop = asyncio.get_running_loop()
+        size = -(-len(raw_blocks) // self.env.sync_processes)
+        jobs = [loop.run_in_executor(self.sync_executor, prepare_blocks, self.coin,
+                                     raw_blocks[start:start + size], first_height + start)
+                for start in range(0, len(raw_blocks), size)]
+        blocks = [block for part in await asyncio.gather(*jobs) for block in part]
+        for block, raw_block in zip(blocks, raw_blocks):
+            block.raw = raw_block
+        return blocks
+
+    def _start_sync_processes(self):
+        if not self.env.sync_processes:
+            return
+        # Other block processors index more than advance_txs() does
+        if type(self).advance_txs is not BlockProcessor.advance_txs:
+            self.logger.warning(f'SYNC_PROCESSES is not supported for {self.coin.NAME}')
+            return
+        self.logger.info(f'preparing blocks in {self.env.sync_processes:,d} processes '
+                         f'until caught up')
+        self.sync_executor = ProcessPoolExecutor(
+            self.env.sync_processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def _stop_sync_processes(self):
+        if self.sync_executor:
+            # Waiting for the processes to exit would block the event loop
+            self.sync_executor.shutdown(wait=False, cancel_futures=True)
+            self.sync_executor = None
+
     def backup_blocks(self, raw_blocks: Sequence[bytes]):
         '''Backup the raw blocks and flush.
 
@@ -605,6 +730,10 @@ class BlockProcessor:
       2.  Key: b'h' + compressed_tx_hash + tx_idx + tx_num
           Value: hashX
 
+    A third table, b'b' + address_hashX, holds the confirmed balance
+    and UTXO count of each address so that balance queries are a single
+    read.  It is derived from the other two when flushing.
+
     The compressed tx hash is just the first few bytes of the hash of
     the tx in which the UTXO was created.  As this is not unique there
     will be potential collisions so tx_num is also in the key.  When
@@ -653,6 +782,14 @@ class BlockProcessor:
                 # Remove both entries for this UTXO
                 self.db_deletes.append(hdb_key)
                 self.db_deletes.append(udb_key)
+                # And debit its confirmed balance
+                value, = unpack_le_uint64(utxo_value_packed)
+                spent = self.balance_spends.get(hashX)
+                if spent:
+                    spent[0] += value
+                    spent[1] += 1
+                else:
+                    self.balance_spends[hashX] = [value, 1]
                 return hashX + tx_num_packed + utxo_value_packed
 
         raise ChainError(f'UTXO {hash_to_hex_str(tx_hash)} / {tx_idx:,d} not '
@@ -677,6 +814,7 @@ class BlockProcessor:
     async def _first_caught_up(self):
         self.logger.info(f'caught up to height {self.height}')
         # Flush everything but with first_sync->False state.
+        self._stop_sync_processes()
         first_sync = self.db.first_sync
         self.db.first_sync = False
         await self.flush(True)
@@ -708,15 +846,21 @@ class BlockProcessor:
         '''
         self._caught_up_event = caught_up_event
         await self._first_open_dbs()
+        self._start_sync_processes()
         try:
             async with OldTaskGroup() as group:
                 await group.spawn(self.prefetcher.main_loop(self.height))
+                if self.env.daemon_zmq_hashblock_url:
+                    url = self.env.daemon_zmq_hashblock_url
+                    await group.spawn(self.prefetcher.follow_block_announcements(url))
                 await group.spawn(self._process_prefetched_blocks())
         # Don't flush for arbitrary exceptions as they might be a cause or consequence of
         # corrupted data
         except CancelledError:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.flush(True)
+        finally:
+            self._stop_sync_processes()
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
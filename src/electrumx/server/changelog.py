@@ -0,0 +1,331 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''The change log: an ordered record of a server's flushes.
+
+A primary server with CHANGE_LOG set appends each of its flushes to the
+log - headers, tx hashes, history, UTXO adds and spends, undo
+information and backups.  Followers apply the log to their own copy of
+the databases instead of indexing blocks from a daemon.
+
+The log is a directory of append-only segment files.  Each record holds
+the flushes committed together with one UTXO flush, and is headed by
+the chain states before and after it.  A follower applies the record
+that starts from its own state, so it can start from any copy of the
+primary's databases.
+'''
+
+import os
+from glob import glob
+from struct import Struct
+from typing import Dict, List, Optional, Sequence
+
+import attr
+
+import electrumx.lib.util as util
+from electrumx.lib.hash import HASHX_LEN, hash_to_hex_str
+from electrumx.lib.util import pack_byte, pack_varbytes, pack_varint
+from electrumx.server.db import FlushData
+
+
+# Payload length, prior height and tip, height and tip
+RECORD_HEADER = Struct('<Ii32si32s')
+FLUSH, BACKUP = b'f', b'b'
+
+
+class ChangeLogError(Exception):
+    '''Raised when a change log does not continue from a DB's state.'''
+
+
+@attr.s(slots=True)
+class FlushStep:
+    '''A call of DB.flush_dbs().'''
+    flush_data = attr.ib()  # type: FlushData
+    flush_utxos = attr.ib()  # type: bool
+    tx_counts = attr.ib()  # type: List[int]  # of the new blocks
+    history = attr.ib()  # type: Dict[bytes, bytes]  # hashX -> packed tx nums
+
+
+@attr.s(slots=True)
+class BackupStep:
+    '''A call of DB.flush_backup().'''
+    flush_data = attr.ib()  # type: FlushData
+    touched = attr.ib()  # type: Sequence[bytes]
+
+
+@attr.s(slots=True)
+class Record:
+    prev_height = attr.ib()
+    prev_tip = attr.ib()
+    height = attr.ib()
+    tip = attr.ib()
+    steps = attr.ib()  # type: List[object]
+
+
+def segment_paths(directory):
+    return sorted(glob(os.path.join(directory, '[0-9]*.log')))
+
+
+def _pack_bytes_list(items):
+    return pack_varint(len(items)) + b''.join(pack_varbytes(item) for item in items)
+
+
+def _pack_utxo_changes(flush_data):
+    parts = [pack_varint(len(flush_data.undo_infos))]
+    parts.extend(pack_varint(height) + pack_varbytes(b''.join(undo_info))
+                 for undo_info, height in flush_data.undo_infos)
+    parts.append(pack_varint(len(flush_data.adds)))
+    parts.extend(pack_varbytes(key) + pack_varbytes(value)
+                 for key, value in flush_data.adds.items())
+    parts.append(_pack_bytes_list(flush_data.deletes))
+    parts.append(pack_varint(len(flush_data.balance_spends)))
+    parts.extend(hashX + pack_varint(value) + pack_varint(count)
+                 for hashX, (value, count) in flush_data.balance_spends.items())
+    return b''.join(parts)
+
+
+def _pack_chain_state(flush_data):
+    return (pack_varint(flush_data.height) + pack_varint(flush_data.tx_count)
+            + flush_data.tip)
+
+
+def pack_flush(flush_data, flush_utxos, tx_counts, history):
+    '''Return the encoding of a flush step.  Call before flushing as that
+    empties flush_data and history.'''
+    parts = [FLUSH, pack_byte(flush_utxos), _pack_chain_state(flush_data),
+             pack_varint(len(tx_counts))]
+    parts.extend(pack_varint(tx_count) for tx_count in tx_counts)
+    parts.append(_pack_bytes_list(flush_data.headers))
+    parts.append(_pack_bytes_list(flush_data.block_tx_hashes))
+    parts.append(pack_varint(len(history)))
+    parts.extend(hashX + pack_varbytes(bytes(tx_nums)) for hashX, tx_nums in history.items())
+    if flush_utxos:
+        parts.append(_pack_utxo_changes(flush_data))
+    return b''.join(parts)
+
+
+def pack_backup(flush_data, touched):
+    '''Return the encoding of a backup step.'''
+    return b''.join((BACKUP, _pack_chain_state(flush_data), _pack_utxo_changes(flush_data),
+                     _pack_bytes_list(sorted(touched))))
+
+
+class _Reader:
+    '''Reads the fields of a record payload.'''
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.cursor = 0
+
+    def nbytes(self, n):
+        start = self.cursor
+        self.cursor += n
+        if self.cursor > len(self.payload):
+            raise ChangeLogError('truncated change log record')
+        return self.payload[start:self.cursor]
+
+    def varint(self):
+        n = self.nbytes(1)[0]
+        if n < 253:
+            return n
+        size = {253: 2, 254: 4, 255: 8}[n]
+        return int.from_bytes(self.nbytes(size), 'little')
+
+    def varbytes(self):
+        return self.nbytes(self.varint())
+
+    def bytes_list(self):
+        return [self.varbytes() for _ in range(self.varint())]
+
+    def chain_state(self):
+        height = self.varint()
+        tx_count = self.varint()
+        tip = self.nbytes(32)
+        return FlushData(height, tx_count, [], [], [], {}, [], {}, tip)
+
+    def utxo_changes(self, flush_data):
+        undo_infos = flush_data.undo_infos
+        for _ in range(self.varint()):
+            height = self.varint()
+            undo_infos.append(([self.varbytes()], height))
+        flush_data.adds = {self.varbytes(): self.varbytes() for _ in range(self.varint())}
+        flush_data.deletes = self.bytes_list()
+        flush_data.balance_spends = {self.nbytes(HASHX_LEN): [self.varint(), self.varint()]
+                                     for _ in range(self.varint())}
+
+    def step(self):
+        kind = self.nbytes(1)
+        if kind == FLUSH:
+            flush_utxos = bool(self.nbytes(1)[0])
+            flush_data = self.chain_state()
+            tx_counts = [self.varint() for _ in range(self.varint())]
+            flush_data.headers = self.bytes_list()
+            flush_data.block_tx_hashes = self.bytes_list()
+            history = {self.nbytes(HASHX_LEN): self.varbytes() for _ in range(self.varint())}
+            if flush_utxos:
+                self.utxo_changes(flush_data)
+            return FlushStep(flush_data, flush_utxos, tx_counts, history)
+        if kind == BACKUP:
+            flush_data = self.chain_state()
+            self.utxo_changes(flush_data)
+            return BackupStep(flush_data, self.bytes_list())
+        raise ChangeLogError(f'unknown change log step {kind!r}')
+
+
+def unpack_record(header, payload):
+    _size, prev_height, prev_tip, height, tip = RECORD_HEADER.unpack(header)
+    reader = _Reader(payload)
+    steps = [reader.step() for _ in range(reader.varint())]
+    return Record(prev_height, prev_tip, height, tip, steps)
+
+
+def read_headers(path):
+    '''Return a list of (offset, header) pairs of the complete records of
+    a segment file.'''
+    result = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            header = f.read(RECORD_HEADER.size)
+            end = offset + RECORD_HEADER.size + RECORD_HEADER.unpack(header)[0]
+            if end > size:
+                break
+            result.append((offset, header))
+            offset = end
+            f.seek(offset)
+    return result
+
+
+class ChangeLog:
+    '''Writes the flushes of a DB to a change log directory.
+
+    Steps are encoded as they are flushed, and written as one record with
+    the UTXO flush that commits them.  History-only flushes are undone
+    by the DB if it is not shut down cleanly, so their steps must not
+    reach the log before then.
+    '''
+
+    SEGMENT_SIZE = 128 * 1024 * 1024
+
+    def __init__(self, directory):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.directory = directory
+        self.steps = []
+        self.file = None
+        self.height = -1
+        self.tip = None
+
+    def open(self, height, tip):
+        '''Start a segment for records following the chain state height and
+        tip.  Does nothing if the log is already open.
+
+        Raises ChangeLogError if the log stops at another chain state, for
+        example if the server crashed after committing a flush to the DB
+        but before logging it.'''
+        if self.file:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        paths = segment_paths(self.directory)
+        # Segments are started on opening, so the last ones can be empty
+        for path in reversed(paths):
+            headers = read_headers(path)
+            if headers:
+                _, _, _, last_height, last_tip = RECORD_HEADER.unpack(headers[-1][1])
+                if (last_height, last_tip) != (height, tip):
+                    raise ChangeLogError(
+                        f'the change log in {self.directory} stops at height '
+                        f'{last_height:,d} tip {hash_to_hex_str(last_tip)} but the DB '
+                        f'is at height {height:,d}; move the change log aside to start '
+                        f'a new one, and restart followers from a copy of the databases')
+                break
+        self.height, self.tip = height, tip
+        self._new_segment(paths)
+
+    def _new_segment(self, paths):
+        if self.file:
+            self.file.close()
+        number = int(os.path.basename(paths[-1])[:-4]) + 1 if paths else 0
+        path = os.path.join(self.directory, f'{number:08d}.log')
+        self.file = open(path, 'ab')
+        self.logger.info(f'writing change log segment {path}')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def add_flush(self, flush_data, flush_utxos, tx_counts, history):
+        self.steps.append(pack_flush(flush_data, flush_utxos, tx_counts, history))
+
+    def add_backup(self, flush_data, touched):
+        self.steps.append(pack_backup(flush_data, touched))
+
+    def commit(self, height, tip):
+        '''Write the steps since the last commit, which bring the chain state
+        to height and tip.  Call once they are committed to the DB.'''
+        payload = pack_varint(len(self.steps)) + b''.join(self.steps)
+        header = RECORD_HEADER.pack(len(payload), self.height, self.tip, height, tip)
+        self.file.write(header + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.steps.clear()
+        self.height, self.tip = height, tip
+        if self.file.tell() >= self.SEGMENT_SIZE:
+            self._new_segment(segment_paths(self.directory))
+
+
+class ChangeLogReader:
+    '''Reads the records of a change log in order, as they are written.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.offset = 0
+
+    def locate(self, height, tip):
+        '''Position the reader at the record following the chain state height
+        and tip, or after the last record if that is where the log stops.
+        Return False if no record follows the state.'''
+        for path in reversed(segment_paths(self.directory)):
+            for offset, header in reversed(read_headers(path)):
+                size, prev_height, prev_tip, last_height, last_tip = RECORD_HEADER.unpack(header)
+                if (last_height, last_tip) == (height, tip):
+                    self.path, self.offset = path, offset + RECORD_HEADER.size + size
+                    return True
+                if (prev_height, prev_tip) == (height, tip):
+                    self.path, self.offset = path, offset
+                    return True
+        return False
+
+    def _read_at(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return None
+            payload = f.read(RECORD_HEADER.unpack(header)[0])
+            if len(payload) < RECORD_HEADER.unpack(header)[0]:
+                return None
+        self.offset += len(header) + len(payload)
+        return unpack_record(header, payload)
+
+    def read(self) -> Optional[Record]:
+        '''Return the next complete record, or None if there is none yet.'''
+        while True:
+            record = self._read_at()
+            if record:
+                return record
+            later = [path for path in segment_paths(self.directory) if path > self.path]
+            if not later:
+                return None
+            # The writer moves to a new segment only after completing a
+            # record, so a partial record that remains was torn by a crash
+            record = self._read_at()
+            if record:
+                return record
+            self.path, self.offset = later[0], 0
@@ -12,9 +12,13 @@ from aiorpcx import _version as aiorpcx_version
 import electrumx
 from electrumx.lib.server_base import ServerBase
 from electrumx.lib.util import version_string, OldTaskGroup
+from electrumx.server.changelog import ChangeLog
 from electrumx.server.db import DB
+from electrumx.server.follower import Follower
 from electrumx.server.mempool import MemPool, MemPoolAPI
 from electrumx.server.session import SessionManager
+from electrumx.server.workers import Indexer
+from electrumx.server.zmq_feed import MempoolFeed
 
 
 class Notifications:
@@ -34,6 +38,7 @@ class Notifications:
         self._touched_mp = {}
         self._touched_bp = {}
         self._highest_block = -1
+        self._listeners = []
 
     async def _maybe_notify(self):
         tmp, tbp = self._touched_mp, self._touched_bp
@@ -53,10 +58,17 @@ class Notifications:
         for old in [h for h in tbp if h <= height]:
             touched.update(tbp.pop(old))
         await self.notify(height, touched)
+        for listener in self._listeners:
+            await listener(height, touched)
 
     async def notify(self, height, touched):
         pass
 
+    def add_listener(self, listener):
+        '''Also pass notifications to the async function listener once
+        started.'''
+        self._listeners.append(listener)
+
     async def start(self, height, notify_func):
         self._highest_block = height
         self.notify = notify_func
@@ -96,10 +108,15 @@ class Controller(ServerBase):
 
         notifications = Notifications()
         Daemon = env.coin.DAEMON
-        BlockProcessor = env.coin.BLOCK_PROCESSOR
+        if env.follow:
+            BlockProcessor = Follower
+        else:
+            BlockProcessor = env.coin.BLOCK_PROCESSOR
 
         async with Daemon(env.coin, env.daemon_url) as daemon:
             db = DB(env)
+            if env.change_log:
+                db.change_log = ChangeLog(env.change_log)
             bp = BlockProcessor(env, db, daemon, notifications)
 
             # Set notifications up to implement the MemPoolAPI
@@ -112,10 +129,19 @@ class Controller(ServerBase):
             notifications.raw_transactions = daemon.getrawtransactions
             notifications.lookup_utxos = db.lookup_utxos
             MemPoolAPI.register(Notifications)
+            feed = None
+            if env.daemon_zmq_url:
+                feed = MempoolFeed(env.daemon_zmq_url, daemon.mempool_sequence)
             mempool = MemPool(
                 env.coin, notifications,
                 refresh_secs=env.daemon_poll_interval_mempool_msec/1000,
+                feed=feed,
+                # Relative to the DB directory, which is the current directory
+                state_file=env.mempool_state_file or None,
+                processes=env.mempool_processes,
             )
+            if not env.follow:
+                bp.mempool = mempool
 
             session_mgr = SessionManager(
                 env=env,
@@ -126,6 +152,13 @@ class Controller(ServerBase):
                 shutdown_event=shutdown_event,
             )
 
+            if env.query_workers:
+                # Workers serve the clients; only admin RPC is served here
+                env.services = [service for service in env.services
+                                if service.protocol == 'rpc']
+                indexer = Indexer(env, mempool, session_mgr.peer_mgr)
+                notifications.add_listener(indexer.notify)
+
             # Test daemon authentication, and also ensure it has a cached
             # height. Do this before entering the task group.
             await daemon.height()
@@ -140,6 +173,9 @@ class Controller(ServerBase):
                 await caught_up_event.wait()
                 await group.spawn(db.populate_header_merkle_cache())
                 await group.spawn(mempool.keep_synchronized(mempool_event))
+                if env.query_workers:
+                    await mempool_event.wait()
+                    await group.spawn(indexer.serve())
 
             async with OldTaskGroup() as group:
                 await group.spawn(session_mgr.serve(notifications, mempool_event))
@@ -278,6 +278,12 @@ class Daemon:
         '''Update our record of the daemon's mempool hashes.'''
         return await self._send_single('getrawmempool')
 
+    async def mempool_sequence(self):
+        '''Return the hashes of the daemon's mempool and its sequence
+        number, as for ZMQ "sequence" notifications.'''
+        result = await self._send_single('getrawmempool', (False, True))
+        return result['txids'], result['mempool_sequence']
+
     async def estimatefee(self, block_count, estimate_mode=None):
         '''Return the fee estimate for the block count.  Units are whole
         currency units per KB, e.g. 0.00000995, or -1 if no estimate
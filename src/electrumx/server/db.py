@@ -12,6 +12,7 @@
 from array import array
 import ast
 import os
+import shutil
 import time
 from bisect import bisect_right
 from dataclasses import dataclass
@@ -19,7 +20,7 @@ from glob import glob
 from typing import Dict, List, Sequence, Tuple, Optional, TYPE_CHECKING
 
 import attr
-from aiorpcx import run_in_thread, sleep
+from aiorpcx import run_in_thread
 
 import electrumx.lib.util as util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
@@ -28,7 +29,7 @@ from electrumx.lib.util import (
     formatted_time, pack_be_uint16, pack_be_uint32, pack_le_uint64, pack_le_uint32,
     unpack_le_uint32, unpack_be_uint32, unpack_le_uint64
 )
-from electrumx.server.storage import db_class, Storage
+from electrumx.server.storage import db_class, Storage, Table
 from electrumx.server.history import History, TXNUM_LEN
 
 if TYPE_CHECKING:
@@ -54,11 +55,50 @@ class FlushData:
     undo_infos = attr.ib()  # type: List[Tuple[Sequence[bytes], int]]
     adds = attr.ib()  # type: Dict[bytes, bytes]  # txid+out_idx -> hashX+tx_num+value_sats
     deletes = attr.ib()  # type: List[bytes]  # b'h' db keys, and b'u' db keys
+    balance_spends = attr.ib()  # type: Dict[bytes, List[int]]  # hashX -> [value_sats, utxo_count]
     tip = attr.ib()
 
 
+@attr.s(slots=True)
+class ReadView:
+    '''A consistent view of the databases for queries, taken after a flush.
+
+    The history and UTXO DBs are storage snapshots and tx_counts is a
+    copy, so a query reading through one view never sees half a flush.
+    Tx hashes are read from the hashes file, which only changes beyond
+    db_height until a reorg.
+    '''
+    utxo_db = attr.ib()
+    hist_db = attr.ib()
+    tx_counts = attr.ib()  # type: array
+    db_height = attr.ib()
+
+    @property
+    def tx_count(self):
+        return self.tx_counts[-1] if self.tx_counts else 0
+
+
 COMP_TXID_LEN = 4
 
+# The tables of the UTXO DB
+UTXO_TABLES = (
+    Table(b'u'),
+    Table(b'h', point_lookups=False),
+    Table(b'U'),
+    Table(b'b'),
+)
+
+
+def pack_balance(value, count):
+    return pack_le_uint64(value) + pack_le_uint32(count)
+
+
+def unpack_balance(packed):
+    '''Return a (value_sats, utxo_count) pair.'''
+    value, = unpack_le_uint64(packed[:8])
+    count, = unpack_le_uint32(packed[8:])
+    return value, count
+
 
 class DB:
     '''Simple wrapper of the backend database for querying.
@@ -67,7 +107,7 @@ class DB:
     it was shutdown uncleanly.
     '''
 
-    DB_VERSIONS = (6, 7, 8)
+    DB_VERSIONS = (6, 7, 8, 9)
 
     utxo_db: Optional['Storage']
 
@@ -104,7 +144,15 @@ class DB:
         # Key: b'U' + block_height
         # Value: byte-concat list of (hashX + tx_num + value_sats)
         # "undo data: list of UTXOs spent at block height"
+        # ---
+        # Key: b'b' + address_hashX
+        # Value: confirmed balance (64-bit) + UTXO count (32-bit)
+        # "the UTXOs at address sum to value"
         self.utxo_db = None
+        # The view of the DBs queries read from; see refresh_read_view()
+        self.read_view = None  # type: Optional[ReadView]
+        # If set, flushes are also written to this ChangeLog for followers
+        self.change_log = None
 
         self.utxo_flush_count = 0
         self.fs_height = -1
@@ -135,8 +183,16 @@ class DB:
             self.headers_offsets_file = util.LogicalFile(
                 'meta/headers_offsets', 2, 16000000)
 
-    async def _read_tx_counts(self):
+    async def _read_tx_counts(self, extend=False):
         if self.tx_counts is not None:
+            if not extend:
+                return
+            # Read those of blocks flushed by another process
+            start = len(self.tx_counts)
+            size = (self.db_height + 1 - start) * 8
+            tx_counts = self.tx_counts_file.read(start * 8, size)
+            assert len(tx_counts) == size
+            self.tx_counts.frombytes(tx_counts)
             return
         # tx_counts[N] has the cumulative number of txs at the end of
         # height N.  So tx_counts[0] is 1 - the genesis coinbase
@@ -153,7 +209,7 @@ class DB:
         assert self.utxo_db is None
 
         # First UTXO DB
-        self.utxo_db = self.db_class('utxo', for_sync)
+        self.utxo_db = self.db_class('utxo', for_sync, UTXO_TABLES)
         if self.utxo_db.is_new:
             self.logger.info('created new database')
             self.logger.info('creating metadata directory')
@@ -175,6 +231,9 @@ class DB:
 
         # Read TX counts (requires meta directory)
         await self._read_tx_counts()
+        self.refresh_read_view()
+        if self.change_log:
+            self.change_log.open(self.db_height, self.db_tip)
 
     async def open_for_compacting(self):
         await self._open_dbs(True, True)
@@ -194,11 +253,60 @@ class DB:
         '''
         if self.utxo_db:
             self.logger.info('closing DBs to re-open for serving')
+            self.read_view = None
             self.utxo_db.close()
             self.history.close_db()
             self.utxo_db = None
         await self._open_dbs(False, False)
 
+    async def open_for_reading(self):
+        '''Open the databases read-only, to serve queries while an indexer
+        in another process writes them.  Call catch_up() after each of
+        its flushes.'''
+        assert self.utxo_db is None
+        self.utxo_db = self.db_class('utxo', False, UTXO_TABLES, read_only=True)
+        self.read_utxo_state()
+        self.history.open_db(self.db_class, False, self.utxo_flush_count, False,
+                             read_only=True)
+        await self._read_tx_counts()
+        self.refresh_read_view()
+
+    async def catch_up(self):
+        '''Catch up with flushes made by the indexer process since the last
+        call.  Return True if the chain was reorganised meanwhile.'''
+        def catch_up():
+            old_height, old_tip = self.db_height, self.db_tip
+            # Read the state from the snapshot queries will use, so they
+            # never see UTXOs beyond its height
+            utxo_snapshot = self.utxo_db.snapshot()
+            self.read_utxo_state(utxo_snapshot)
+            reorged = self.db_height < old_height or (
+                old_height >= 0 and self.read_block_hash(old_height) != old_tip)
+            if reorged:
+                self.logger.info(f'chain reorganised below height {old_height:,d}')
+                self.tx_counts = None
+                self.header_mc.truncate(max(1, min(old_height, self.db_height)
+                                            - self.env.reorg_limit))
+            return utxo_snapshot, reorged
+
+        utxo_snapshot, reorged = await run_in_thread(catch_up)
+        await self._read_tx_counts(extend=True)
+        self.refresh_read_view(utxo_snapshot)
+        return reorged
+
+    def read_block_hash(self, height):
+        '''Return the hash of the block header on disk at height.'''
+        offset = self.header_offset(height)
+        header = self.headers_file.read(offset, self.header_len(height))
+        return self.coin.header_hash(header)
+
+    def refresh_read_view(self, utxo_snapshot=None):
+        '''Point queries at the current state of the databases.  Call with
+        the UTXO DB flushed, i.e. with db_height up to date.'''
+        self.read_view = ReadView(utxo_snapshot or self.utxo_db.snapshot(),
+                                  self.history.db.snapshot(),
+                                  self.tx_counts[:self.db_height + 1], self.db_height)
+
     # Header merkle cache
 
     async def populate_header_merkle_cache(self):
@@ -222,6 +330,7 @@ class DB:
         assert not flush_data.block_tx_hashes
         assert not flush_data.adds
         assert not flush_data.deletes
+        assert not flush_data.balance_spends
         assert not flush_data.undo_infos
         self.history.assert_flushed()
 
@@ -235,6 +344,10 @@ class DB:
         start_time = time.time()
         prior_flush = self.last_flush
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
+        if self.change_log:
+            self.change_log.add_flush(flush_data, flush_utxos,
+                                      self.tx_counts[self.fs_height + 1:],
+                                      self.history.unflushed)
 
         # Flush to file system
         self.flush_fs(flush_data)
@@ -251,6 +364,12 @@ class DB:
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
         self.flush_state(self.utxo_db)
+        # Also after history-only flushes: queries skip history beyond the
+        # view's tx count, and LMDB snapshots taken before a commit
+        # serialize their readers
+        self.refresh_read_view()
+        if flush_utxos and self.change_log:
+            self.change_log.commit(self.db_height, self.db_tip)
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'flush #{self.history.flush_count:,d} took '
@@ -326,6 +445,11 @@ class DB:
             batch_delete(key)
         flush_data.deletes.clear()
 
+        # Net balance changes, starting with the spends
+        balance_deltas = {hashX: [-value, -count] for hashX, (value, count)
+                          in flush_data.balance_spends.items()}
+        flush_data.balance_spends.clear()
+
         # New UTXOs
         batch_put = batch.put
         for key, value in flush_data.adds.items():
@@ -337,8 +461,17 @@ class DB:
             suffix = txout_idx + tx_num
             batch_put(b'h' + key[:COMP_TXID_LEN] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value_sats)
+            value, = unpack_le_uint64(value_sats)
+            delta = balance_deltas.get(hashX)
+            if delta:
+                delta[0] += value
+                delta[1] += 1
+            else:
+                balance_deltas[hashX] = [value, 1]
         flush_data.adds.clear()
 
+        self.flush_balances(batch, balance_deltas)
+
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
         flush_data.undo_infos.clear()
@@ -357,6 +490,27 @@ class DB:
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
 
+    def flush_balances(self, batch, balance_deltas):
+        '''Apply the net [value_sats, utxo_count] changes of a flush to the
+        balance table.'''
+        utxo_db_get = self.utxo_db.get
+        for hashX in sorted(balance_deltas):
+            value_delta, count_delta = balance_deltas[hashX]
+            if not count_delta and not value_delta:
+                continue
+            key = b'b' + hashX
+            packed = utxo_db_get(key)
+            value, count = unpack_balance(packed) if packed else (0, 0)
+            value += value_delta
+            count += count_delta
+            if value < 0 or count < 0:
+                raise self.DBError(f'negative balance {value:,d} in {count:,d} '
+                                   f'UTXOs for hashX {hashX.hex()}')
+            if count:
+                batch.put(key, pack_balance(value, count))
+            else:
+                batch.delete(key)
+
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
         now = time.time()
@@ -375,12 +529,17 @@ class DB:
         start_time = time.time()
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
 
+        if self.change_log:
+            self.change_log.add_backup(flush_data, touched)
         self.backup_fs(flush_data.height, flush_data.tx_count)
         self.history.backup(touched, flush_data.tx_count)
         with self.utxo_db.write_batch() as batch:
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        self.refresh_read_view()
+        if self.change_log:
+            self.change_log.commit(self.db_height, self.db_tip)
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -416,6 +575,40 @@ class DB:
         # Truncate header_mc: header count is 1 more than the height.
         self.header_mc.truncate(height + 1)
 
+    def checkpoint(self, path):
+        '''Write a consistent copy of the databases and metadata as of the
+        last UTXO flush to the directory path, which must not exist.
+        Return its height.
+
+        The copy can be used as a DB_DIRECTORY.  Flushes must be
+        prevented meanwhile by holding the block processor's state
+        lock.  Raw blocks are not copied; after restoring a checkpoint
+        they are fetched from the daemon if a reorg needs them.
+        '''
+        start_time = time.monotonic()
+        height = self.db_height
+        os.makedirs(os.path.join(path, 'meta'))
+        self.utxo_db.checkpoint(os.path.join(path, 'utxo'))
+        self.history.db.checkpoint(os.path.join(path, 'hist'))
+        shutil.copy2('COIN', path)
+
+        # The metadata files are only rewritten above the reorg limit, and
+        # are written beyond our height by history-only flushes
+        fixed_height = max(0, height - self.env.reorg_limit)
+        self.headers_file.checkpoint(path, self.header_offset(height + 1),
+                                     self.header_offset(fixed_height))
+        if not self.coin.STATIC_BLOCK_HEADERS:
+            self.headers_offsets_file.checkpoint(path, (height + 2) * 8,
+                                                 fixed_height * 8)
+        self.tx_counts_file.checkpoint(path, (height + 1) * 8, fixed_height * 8)
+        fixed_tx_count = self.tx_counts[fixed_height - 1] if fixed_height else 0
+        self.hashes_file.checkpoint(path, self.db_tx_count * 32, fixed_tx_count * 32)
+
+        elapsed = time.monotonic() - start_time
+        self.logger.info(f'checkpoint at height {height:,d} written to {path} '
+                         f'in {elapsed:.1f}s')
+        return height
+
     async def raw_header(self, height):
         '''Return the binary header at the given height.'''
         header, n = await self.read_headers(height, 1)
@@ -447,17 +640,38 @@ class DB:
 
         return await run_in_thread(read_headers)
 
-    def fs_tx_hash(self, tx_num):
+    def fs_tx_hash(self, tx_num, view=None):
         '''Return a pair (tx_hash, tx_height) for the given tx number.
 
-        If the tx_height is not on disk, returns (None, tx_height).'''
-        tx_height = bisect_right(self.tx_counts, tx_num)
-        if tx_height > self.db_height:
+        If the tx_height is not on disk, returns (None, tx_height).  If
+        view is given, "on disk" means as of that view.'''
+        view = view or self
+        tx_height = bisect_right(view.tx_counts, tx_num)
+        if tx_height > view.db_height:
             tx_hash = None
         else:
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
+    def fs_tx_hashes(self, tx_nums, view=None):
+        '''Return a list of (tx_hash, tx_height) pairs for the tx numbers,
+        which must be in increasing order.
+
+        This is a batched fs_tx_hash(): heights are found in one pass
+        over tx_counts and hashes in one pass over the hashes file.  As
+        there, tx_hash is None if tx_height is not on disk.'''
+        view = view or self
+        tx_counts = view.tx_counts
+        db_height = view.db_height
+        heights = []
+        lo = 0
+        for tx_num in tx_nums:
+            lo = bisect_right(tx_counts, tx_num, lo)
+            heights.append(lo)
+        hashes = self.hashes_file.read_records([tx_num * 32 for tx_num in tx_nums], 32)
+        return [(tx_hash if height <= db_height else None, height)
+                for tx_hash, height in zip(hashes, heights)]
+
     def fs_tx_hashes_at_blockheight(self, block_height):
         '''Return a list of tx_hashes at given block height,
         in the same order as in the block.
@@ -491,25 +705,29 @@ class DB:
 
         return [self.coin.header_hash(header) for header in headers]
 
-    async def limited_history(self, hashX, *, limit=1000):
+    async def limited_history(self, hashX, *, limit=1000, reverse=False):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
         confirmed transactions that touched the address, earliest in
         the blockchain first.  Includes both spending and receiving
         transactions.  By default returns at most 1000 entries.  Set
         limit to None to get them all.
+
+        If reverse is True the list is newest first and holds the most
+        recent limit entries.
         '''
+        view = self.read_view
+
         def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
-
-        while True:
-            history = await run_in_thread(read_history)
-            if all(hash is not None for hash, height in history):
-                return history
-            self.logger.warning(f'limited_history: tx hash '
-                                f'not found (reorg?), retrying...')
-            await sleep(0.25)
+            # The history DB can be ahead of the view if it was written
+            # by another process
+            tx_nums = list(self.history.get_txnums(hashX, limit, reverse=reverse,
+                                                   snapshot=view.hist_db,
+                                                   tx_count=view.tx_count))
+            if reverse:
+                return self.fs_tx_hashes(tx_nums[::-1], view)[::-1]
+            return self.fs_tx_hashes(tx_nums, view)
+
+        return await run_in_thread(read_history)
 
     # -- Undo information
 
@@ -587,8 +805,10 @@ class DB:
 
     # -- UTXO database
 
-    def read_utxo_state(self):
-        state = self.utxo_db.get(b'state')
+    def read_utxo_state(self, snapshot=None):
+        '''Read the UTXO DB state.  If snapshot is given it is read from
+        that, and quietly, to catch up with another process's flushes.'''
+        state = (snapshot or self.utxo_db).get(b'state')
         if not state:
             self.db_height = -1
             self.db_tx_count = 0
@@ -625,8 +845,13 @@ class DB:
         self.fs_tx_count = self.db_tx_count
         self.last_flush_tx_count = self.fs_tx_count
 
+        if snapshot:
+            return
+
         # Upgrade DB
         if self.db_version != max(self.DB_VERSIONS):
+            if self.utxo_db.read_only:
+                raise self.DBError('UTXO DB must be upgraded by the indexer')
             self.upgrade_db()
 
         # Log some stats
@@ -647,6 +872,17 @@ class DB:
         self.logger.info(f'UTXO DB version: {self.db_version}')
         self.logger.info('Upgrading your DB; this can take some time...')
 
+        if self.db_version < 8:
+            self.upgrade_keys_and_tx_counts()
+        if self.db_version < 9:
+            self.build_balance_table()
+
+        self.db_version = max(self.DB_VERSIONS)
+        with self.utxo_db.write_batch() as batch:
+            self.write_utxo_state(batch)
+        self.logger.info('DB 2 of 3 upgraded successfully')
+
+    def upgrade_keys_and_tx_counts(self):
         def upgrade_u_prefix(prefix):
             count = 0
             with self.utxo_db.write_batch() as batch:
@@ -722,10 +958,40 @@ class DB:
             tx_counts = array('Q', tx_counts)
             self.tx_counts_file.write(0, tx_counts.tobytes())
 
-        self.db_version = max(self.DB_VERSIONS)
-        with self.utxo_db.write_batch() as batch:
-            self.write_utxo_state(batch)
-        self.logger.info('DB 2 of 3 upgraded successfully')
+    def build_balance_table(self):
+        '''Build the b'b' balance table from the b'u' UTXO table.'''
+        def write_balances(balances):
+            with self.utxo_db.write_batch() as batch:
+                for hashX, (value, count) in balances.items():
+                    batch.put(b'b' + hashX, pack_balance(value, count))
+            balances.clear()
+
+        last = time.monotonic()
+        count = 0
+        balances = {}
+        prior_hashX = None
+        # Key: b'u' + address_hashX + tx_idx + tx_num
+        # Keys are sorted so a hashX's UTXOs are adjacent
+        for db_key, db_value in self.utxo_db.iterator(prefix=b'u'):
+            hashX = db_key[1:1 + HASHX_LEN]
+            value, = unpack_le_uint64(db_value)
+            if hashX == prior_hashX:
+                balance = balances[hashX]
+                balance[0] += value
+                balance[1] += 1
+                continue
+            if len(balances) >= 100_000:
+                write_balances(balances)
+            balances[hashX] = [value, 1]
+            prior_hashX = hashX
+            count += 1
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'DB balance table: {count:,d} addresses, '
+                                 f'{hashX[0] * 100 / 256:.1f}% complete')
+        write_balances(balances)
+        self.logger.info(f'DB balance table built for {count:,d} addresses')
 
     def write_utxo_state(self, batch):
         '''Write (UTXO) state to the batch.'''
@@ -746,77 +1012,104 @@ class DB:
         with self.utxo_db.write_batch() as batch:
             self.write_utxo_state(batch)
 
+    def read_raw_utxos(self, hashX, view=None):
+        '''Return a (tx_nums, tx_positions, values) triple of arrays for the
+        UTXOs of an address, ordered by tx_num then tx_pos.
+
+        No tx hashes are looked up; see resolve_utxos().'''
+        utxo_db = (view or self.read_view).utxo_db
+        tx_nums = array('Q')
+        tx_positions = array('I')
+        values = array('Q')
+        txnum_padding = bytes(8-TXNUM_LEN)
+        # Key: b'u' + address_hashX + txout_idx + tx_num
+        # Value: the UTXO value as a 64-bit unsigned integer
+        prefix = b'u' + hashX
+        for db_key, db_value in utxo_db.iterator(prefix=prefix):
+            txout_idx, = unpack_le_uint32(db_key[-TXNUM_LEN-4:-TXNUM_LEN])
+            tx_num, = unpack_le_uint64(db_key[-TXNUM_LEN:] + txnum_padding)
+            value, = unpack_le_uint64(db_value)
+            tx_nums.append(tx_num)
+            tx_positions.append(txout_idx)
+            values.append(value)
+        # Keys are ordered by the little-endian bytes of txout_idx, so
+        # not numerically even within a tx
+        order = sorted(range(len(tx_nums)),
+                       key=lambda n: (tx_nums[n], tx_positions[n]))
+        return (array('Q', (tx_nums[n] for n in order)),
+                array('I', (tx_positions[n] for n in order)),
+                array('Q', (values[n] for n in order)))
+
+    async def raw_utxos(self, hashX, view=None):
+        '''Return a (tx_nums, tx_positions, values) triple of arrays for the
+        UTXOs of an address.  Cheap; use it when only values are needed.
+
+        Reads from view, by default the current read_view; pass the same
+        view to resolve_utxos().'''
+        return await run_in_thread(self.read_raw_utxos, hashX, view or self.read_view)
+
+    async def resolve_utxos(self, tx_nums, tx_positions, values, view=None):
+        '''Return a list of UTXOs, sorted by tx_num, for the raw UTXO arrays
+        returned by raw_utxos(), looking up their tx hashes and heights in
+        one batched pass.'''
+        pairs = await run_in_thread(self.fs_tx_hashes, tx_nums, view or self.read_view)
+        return [UTXO(tx_num, tx_pos, tx_hash, height, value)
+                for tx_num, tx_pos, (tx_hash, height), value
+                in zip(tx_nums, tx_positions, pairs, values)]
+
     async def all_utxos(self, hashX):
-        '''Return all UTXOs for an address sorted in no particular order.'''
-        def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
-            txnum_padding = bytes(8-TXNUM_LEN)
-            # Key: b'u' + address_hashX + txout_idx + tx_num
-            # Value: the UTXO value as a 64-bit unsigned integer
-            prefix = b'u' + hashX
-            for db_key, db_value in self.utxo_db.iterator(prefix=prefix):
-                txout_idx, = unpack_le_uint32(db_key[-TXNUM_LEN-4:-TXNUM_LEN])
-                tx_num, = unpack_le_uint64(db_key[-TXNUM_LEN:] + txnum_padding)
-                value, = unpack_le_uint64(db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, txout_idx, tx_hash, height, value))
-            return utxos
-
-        while True:
-            utxos = await run_in_thread(read_utxos)
-            if all(utxo.tx_hash is not None for utxo in utxos):
-                return utxos
-            self.logger.warning(f'all_utxos: tx hash not '
-                                f'found (reorg?), retrying...')
-            await sleep(0.25)
+        '''Return all UTXOs for an address sorted by tx_num then tx_pos.'''
+        view = self.read_view
+        return await self.resolve_utxos(*await self.raw_utxos(hashX, view), view)
+
+    async def get_balance(self, hashX):
+        '''Return a (confirmed balance, UTXO count) pair for an address.'''
+        view = self.read_view
+
+        def read_balance():
+            packed = view.utxo_db.get(b'b' + hashX)
+            return unpack_balance(packed) if packed else (0, 0)
+        return await run_in_thread(read_balance)
 
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
         value) pair or None if not found.
 
-        Used by the mempool code.
+        Used by the mempool code, which passes the prevouts sorted so
+        the lookups walk the DB in key order.
         '''
-        def lookup_hashXs():
-            '''Return (hashX, suffix) pairs, or None if not found,
-            for each prevout.
-            '''
-            def lookup_hashX(tx_hash, tx_idx):
-                idx_packed = pack_le_uint32(tx_idx)
-                txnum_padding = bytes(8-TXNUM_LEN)
+        view = self.read_view
+        txnum_padding = bytes(8-TXNUM_LEN)
+
+        def lookup_utxo(tx_hash, tx_idx):
+            idx_packed = pack_le_uint32(tx_idx)
+
+            # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+            # Value: hashX
+            prefix = b'h' + tx_hash[:COMP_TXID_LEN] + idx_packed
+
+            # Find which entry, if any, the TX_HASH matches.
+            for db_key, hashX in view.utxo_db.iterator(prefix=prefix):
+                tx_num_packed = db_key[-TXNUM_LEN:]
+                tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
+                hash, _height = self.fs_tx_hash(tx_num, view)
+                if hash == tx_hash:
+                    break
+            else:
+                # This can happen when the daemon is a block ahead
+                # of us and has mempool txs spending outputs from
+                # that new block
+                return None
 
-                # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-                # Value: hashX
-                prefix = b'h' + tx_hash[:COMP_TXID_LEN] + idx_packed
-
-                # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
-                    tx_num_packed = db_key[-TXNUM_LEN:]
-                    tx_num, = unpack_le_uint64(tx_num_packed + txnum_padding)
-                    hash, _height = self.fs_tx_hash(tx_num)
-                    if hash == tx_hash:
-                        return hashX, idx_packed + tx_num_packed
-                return None, None
-            return [lookup_hashX(*prevout) for prevout in prevouts]
-
-        def lookup_utxos(hashX_pairs):
-            def lookup_utxo(hashX, suffix):
-                if not hashX:
-                    # This can happen when the daemon is a block ahead
-                    # of us and has mempool txs spending outputs from
-                    # that new block
-                    return None
-                # Key: b'u' + address_hashX + tx_idx + tx_num
-                # Value: the UTXO value as a 64-bit unsigned integer
-                key = b'u' + hashX + suffix
-                db_value = self.utxo_db.get(key)
-                if not db_value:
-                    # This can happen if the DB was updated between
-                    # getting the hashXs and getting the UTXOs
-                    return None
-                value, = unpack_le_uint64(db_value)
-                return hashX, value
-            return [lookup_utxo(*hashX_pair) for hashX_pair in hashX_pairs]
-
-        hashX_pairs = await run_in_thread(lookup_hashXs)
-        return await run_in_thread(lookup_utxos, hashX_pairs)
+            # Key: b'u' + address_hashX + tx_idx + tx_num
+            # Value: the UTXO value as a 64-bit unsigned integer
+            db_value = view.utxo_db.get(b'u' + hashX + idx_packed + tx_num_packed)
+            if not db_value:
+                return None
+            value, = unpack_le_uint64(db_value)
+            return hashX, value
+
+        def lookup_utxos():
+            return [lookup_utxo(*prevout) for prevout in prevouts]
+
+        return await run_in_thread(lookup_utxos)
@@ -77,6 +77,18 @@ class Env(EnvBase):
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
         self.daemon_poll_interval_blocks_msec = self.integer('DAEMON_POLL_INTERVAL_BLOCKS', 5000)
         self.daemon_poll_interval_mempool_msec = self.integer('DAEMON_POLL_INTERVAL_MEMPOOL', 5000)
+        self.daemon_zmq_url = self.default('DAEMON_ZMQ_URL', None)
+        self.daemon_zmq_hashblock_url = self.default('DAEMON_ZMQ_HASHBLOCK_URL', None)
+        self.sync_processes = self.integer('SYNC_PROCESSES', 0)
+        self.mempool_processes = self.integer('MEMPOOL_PROCESSES', 0)
+        self.mempool_state_file = self.default('MEMPOOL_STATE_FILE', 'mempool')
+        self.query_workers = self.integer('QUERY_WORKERS', 0)
+        # Set by the indexer process in the environment of its query workers
+        self.query_worker_id = self.integer('QUERY_WORKER_ID', None)
+        if self.query_workers and self.db_engine.lower() != 'lmdb':
+            raise self.Error('QUERY_WORKERS requires DB_ENGINE lmdb')
+        self.change_log = self.default('CHANGE_LOG', None)
+        self.follow = self.default('FOLLOW', None)
 
         # Server limits to help prevent DoS
 
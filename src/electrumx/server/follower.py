@@ -0,0 +1,124 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Follower mode: index from a primary server's change log.'''
+
+import asyncio
+
+from aiorpcx import run_in_thread
+
+import electrumx
+import electrumx.lib.util as util
+from electrumx.lib.hash import hash_to_hex_str
+from electrumx.server.changelog import BackupStep, ChangeLogError, ChangeLogReader
+from electrumx.server.history import TXNUM_LEN
+
+
+class Follower:
+    '''Takes the place of the block processor when FOLLOW is set.
+
+    Rather than fetching blocks from the daemon, the flushes of a primary
+    server are read from its change log and repeated on our own copy of
+    its databases.  The daemon is still used to relay transactions and
+    for the mempool.
+    '''
+
+    POLL_SECS = 0.5
+
+    def __init__(self, env, db, daemon, notifications):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.env = env
+        self.db = db
+        self.notifications = notifications
+        self.reader = ChangeLogReader(env.follow)
+        self.state_lock = asyncio.Lock()
+        # Signalled after backing up during a reorg
+        self.backed_up_event = asyncio.Event()
+
+    @property
+    def height(self):
+        return self.db.db_height
+
+    @property
+    def tip(self):
+        return self.db.db_tip
+
+    def force_chain_reorg(self, count):
+        # Reorgs are the primary's business
+        return False
+
+    def apply_record(self, record):
+        '''Repeat the flushes of a change log record.  Return the touched
+        hashXs and whether the chain was backed up.'''
+        db = self.db
+        if (record.prev_height, record.prev_tip) != (db.db_height, db.db_tip):
+            raise ChangeLogError(f'change log record follows height {record.prev_height:,d} '
+                                 f'not our height {db.db_height:,d}; restart from a '
+                                 f'copy of the primary\'s databases')
+        touched = set()
+        backed_up = False
+        for step in record.steps:
+            if isinstance(step, BackupStep):
+                del db.tx_counts[step.flush_data.height + 1:]
+                db.flush_backup(step.flush_data, step.touched)
+                touched.update(step.touched)
+                backed_up = True
+            else:
+                db.tx_counts.extend(step.tx_counts)
+                history = db.history
+                for hashX, tx_nums in step.history.items():
+                    history.unflushed[hashX] += tx_nums
+                    history.unflushed_count += len(tx_nums) // TXNUM_LEN
+                db.flush_dbs(step.flush_data, step.flush_utxos, lambda: 0)
+                touched.update(step.history)
+        return touched, backed_up
+
+    async def _first_caught_up(self):
+        self.logger.info(f'caught up to height {self.height:,d}')
+        db = self.db
+        if db.first_sync:
+            # Write the state with first_sync->False
+            async with self.state_lock:
+                db.first_sync = False
+                await run_in_thread(db.flush_state, db.utxo_db)
+            self.logger.info(f'{electrumx.version} synced to height {self.height:,d}')
+
+    async def _follow(self, caught_up_event):
+        while True:
+            record = await run_in_thread(self.reader.read)
+            if record is None:
+                if not caught_up_event.is_set():
+                    await self._first_caught_up()
+                    caught_up_event.set()
+                await asyncio.sleep(self.POLL_SECS)
+                continue
+
+            async def apply_locked():
+                async with self.state_lock:
+                    return await run_in_thread(self.apply_record, record)
+
+            # Shielded so a shutdown does not interrupt a flush
+            touched, backed_up = await asyncio.shield(apply_locked())
+            if backed_up:
+                self.backed_up_event.set()
+                self.backed_up_event.clear()
+            await self.notifications.on_block(touched, self.height)
+
+    # --- External API
+
+    async def fetch_and_process_blocks(self, caught_up_event):
+        '''Apply the change log to the DB as it is written.  Sets
+        caught_up_event on first reaching its end.'''
+        db = self.db
+        await db.open_for_serving()
+        if not await run_in_thread(self.reader.locate, db.db_height, db.db_tip):
+            tip = hash_to_hex_str(db.db_tip) if db.db_tip else None
+            raise ChangeLogError(f'no change log record in {self.env.follow} follows '
+                                 f'height {db.db_height:,d} tip {tip}')
+        self.logger.info(f'following the change log in {self.env.follow} from '
+                         f'height {db.db_height:,d}')
+        await self._follow(caught_up_event)
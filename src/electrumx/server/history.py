@@ -19,6 +19,7 @@ import electrumx.lib.util as util
 from electrumx.lib.hash import HASHX_LEN, hash_to_hex_str
 from electrumx.lib.util import (pack_be_uint16, pack_le_uint64,
                                 unpack_be_uint16_from, unpack_le_uint64)
+from electrumx.server.storage import Table
 
 if TYPE_CHECKING:
     from electrumx.server.storage import Storage
@@ -56,9 +57,14 @@ class History:
             for_sync: bool,
             utxo_flush_count: int,
             compacting: bool,
+            read_only: bool = False,
     ):
-        self.db = db_class('hist', for_sync)
+        # History is only ever scanned by hashX
+        self.db = db_class('hist', for_sync, [Table(b'', point_lookups=False)],
+                           read_only=read_only)
         self.read_state()
+        if read_only:
+            return self.flush_count
         self.clear_excess(utxo_flush_count)
         # An incomplete compaction needs to be cancelled otherwise
         # restarting it will corrupt the history
@@ -95,6 +101,8 @@ class History:
             self.logger.error(msg)
             raise RuntimeError(msg)
         if self.db_version != max(self.DB_VERSIONS):
+            if self.db.read_only:
+                raise RuntimeError('history DB must be upgraded by the indexer')
             self.upgrade_db()
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info(f'flush count: {self.flush_count:,d}')
@@ -208,19 +216,38 @@ class History:
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
+    def get_txnums(self, hashX, limit=1000, *, reverse=False, snapshot=None,
+                   tx_count=None):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
         transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        limit to None to get them all.
+
+        If reverse is True the newest tx_nums are yielded first, and the
+        limit applies from that end.  Rows are walked backwards so the
+        cost is proportional to the entries returned, not the length of
+        the full history.
+
+        If snapshot is given the rows are read from it, not the live DB.
+        If tx_count is given, tx_nums from that count on are skipped.
+        '''
         limit = util.resolve_limit(limit)
-        chunks = util.chunks
         txnum_padding = bytes(8-TXNUM_LEN)
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, TXNUM_LEN):
+        db = snapshot or self.db
+        for _key, hist in db.iterator(prefix=hashX, reverse=reverse):
+            if reverse:
+                offsets = range(len(hist) - TXNUM_LEN, -1, -TXNUM_LEN)
+            else:
+                offsets = range(0, len(hist), TXNUM_LEN)
+            for offset in offsets:
                 if limit == 0:
                     return
-                tx_num, = unpack_le_uint64(tx_numb + txnum_padding)
+                tx_num, = unpack_le_uint64(hist[offset: offset + TXNUM_LEN]
+                                           + txnum_padding)
+                if tx_count is not None and tx_num >= tx_count:
+                    if reverse:
+                        continue
+                    return
                 yield tx_num
                 limit -= 1
 
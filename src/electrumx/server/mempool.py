@@ -7,18 +7,25 @@
 
 '''Mempool handling.'''
 
+import asyncio
 import itertools
+import multiprocessing
+import os
 import time
 from abc import ABC, abstractmethod
+from array import array
 from asyncio import Lock
 from collections import defaultdict
-from typing import Sequence, Tuple, TYPE_CHECKING, Type, Dict, Optional, Set
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from struct import Struct, error as struct_error
+from typing import Sequence, Tuple, TYPE_CHECKING, Type, Dict, List, Optional, Set
 import math
 
 import attr
 from aiorpcx import run_in_thread, sleep
 
-from electrumx.lib.hash import hash_to_hex_str, hex_str_to_hash
+from electrumx.lib.hash import HASHX_LEN, hash_to_hex_str, hex_str_to_hash
 from electrumx.lib.tx import SkipTxDeserialize
 from electrumx.lib.util import class_logger, chunks, OldTaskGroup
 from electrumx.server.db import UTXO
@@ -27,6 +34,16 @@ if TYPE_CHECKING:
     from electrumx.lib.coins import Coin
 
 
+# Accepted txs are stored packed; see MemPool
+PREVOUT = Struct('<32sI')           # (tx hash, output index)
+PAIR = Struct(f'<{HASHX_LEN}sQ')    # (hashX, value)
+# The saved state: a header, then each tx followed by its packed
+# prevouts and pairs
+STATE_VERSION = 1
+STATE_HEADER = Struct('<III')       # (version, height, tx count)
+STATE_TX = Struct('<32sQIII')       # (tx hash, fee, size, prevout count, pair count)
+
+
 @attr.s(slots=True)
 class MemPoolTx:
     prevouts = attr.ib()   # type: Sequence[Tuple[bytes, int]]  # (txid, txout_idx)
@@ -48,6 +65,75 @@ class DBSyncError(Exception):
     pass
 
 
+def deserialize_txs(coin, hashes, raw_txs):
+    '''Deserialize raw mempool txs and compute their output hashXs.
+
+    Return a (txs, skipped) pair: txs is a list of (hash, prevouts,
+    out_pairs, size) tuples, and skipped a list of (hash, reason) pairs
+    of txs that could not be deserialized.  This function is pure, so
+    it can run in another process.
+    '''
+    to_hashX = coin.hashX_from_script
+    deserializer = coin.DESERIALIZER
+
+    txs = []
+    skipped = []
+    for hash, raw_tx in zip(hashes, raw_txs):
+        # The daemon may have evicted the tx from its
+        # mempool or it may have gotten in a block
+        if not raw_tx:
+            continue
+        try:
+            tx, tx_size = deserializer(raw_tx).read_tx_and_vsize()
+        except SkipTxDeserialize as ex:
+            skipped.append((hash, str(ex)))
+            continue
+        # Convert the inputs and outputs into (hashX, value) pairs
+        # Drop generation-like inputs from MemPoolTx.prevouts
+        txin_pairs = tuple((txin.prev_hash, txin.prev_idx)
+                           for txin in tx.inputs
+                           if not txin.is_generation())
+        txout_pairs = tuple((to_hashX(txout.pk_script), txout.value)
+                            for txout in tx.outputs)
+        txs.append((hash, txin_pairs, txout_pairs, tx_size))
+    return txs, skipped
+
+
+class _TxView(Mapping):
+    '''A read-only view of a mempool's txs, mapping tx hash to a
+    MemPoolTx unpacked on access.'''
+
+    def __init__(self, mempool):
+        self.mempool = mempool
+
+    def __getitem__(self, tx_hash):
+        return self.mempool._tx(self.mempool.tx_nums[tx_hash])
+
+    def __iter__(self):
+        return iter(self.mempool.tx_nums)
+
+    def __len__(self):
+        return len(self.mempool.tx_nums)
+
+
+class _HashXView(Mapping):
+    '''A read-only view of a mempool's postings, mapping hashX to the
+    set of hashes of the txs touching it.'''
+
+    def __init__(self, mempool):
+        self.mempool = mempool
+
+    def __getitem__(self, hashX):
+        tx_hashes = self.mempool.tx_hashes
+        return {tx_hashes[tx_num] for tx_num in self.mempool.postings[hashX]}
+
+    def __iter__(self):
+        return iter(self.mempool.postings)
+
+    def __len__(self):
+        return len(self.mempool.postings)
+
+
 class MemPoolAPI(ABC):
     '''A concrete instance of this class is passed to the MemPool object
     and used by it to query DB and blockchain state.'''
@@ -98,13 +184,33 @@ class MemPool:
 
         coin - a coin class from coins.py
         api - an object implementing MemPoolAPI
+        feed - optionally, a MempoolFeed of the daemon's mempool changes,
+               followed instead of polling for its hashes
+        state_file - optionally, a file the txs are saved to on shutdown
+               and loaded from on startup
+        processes - the number of processes to deserialize txs in until
+               first synchronized; if zero a thread of this process is used
 
     Updated regularly in caught-up state.  Goal is to enable efficient
     response to the calls in the external interface.  To that end we
     maintain the following maps:
 
-       tx:     tx_hash -> MemPoolTx
-       hashXs: hashX   -> set of all hashes of txs touching the hashX
+       tx_nums:  tx_hash -> tx_num
+       postings: hashX   -> array of the tx_nums of all txs touching it
+       balances: hashX   -> the net amount the txs pay to it
+       fee_histogram: fee rate -> total size of the txs paying it
+
+    Accepted txs are numbered, and kept in columns indexed by tx_num:
+    their hashes, their prevouts and (hashX, value) pairs packed into
+    bytes, and arrays of their fees and sizes.  The numbers of removed
+    txs are reused.  This takes a fraction of the memory of an object
+    per tx, prevout and pair, and leaves the GC almost nothing to
+    track.  txs and hashXs are read-only views of them as maps of
+    tx_hash -> MemPoolTx and hashX -> set of tx hashes.
+
+    The results of the other per-hashX queries are cached when first
+    asked for, and dropped when a tx touching the hashX is added or
+    removed, so a busy hashX is not rescanned for every request.
     '''
 
     def __init__(
@@ -114,17 +220,43 @@ class MemPool:
             *,
             refresh_secs=5.0,
             log_status_secs=60.0,
+            feed=None,
+            state_file=None,
+            processes=0,
     ):
         assert isinstance(api, MemPoolAPI)
         self.coin = coin
         self.api = api
         self.logger = class_logger(__name__, self.__class__.__name__)
-        self.txs = {}  # type: Dict[bytes, MemPoolTx]
-        self.hashXs = defaultdict(set)  # None can be a key
+        self.tx_nums = {}  # type: Dict[bytes, int]
+        self.tx_hashes = []  # type: List[Optional[bytes]]  # None if free
+        self.tx_prevouts = []  # type: List[bytes]  # packed PREVOUTs
+        self.tx_pairs = []  # type: List[bytes]  # packed in_pairs, out_pairs
+        self.tx_fees = array('Q')
+        self.tx_sizes = array('I')  # 0 if free
+        self.free_tx_nums = []
+        self.postings = {}  # type: Dict[bytes, array]
+        self.balances = {}  # type: Dict[bytes, int]
+        self.cached_spends = {}  # type: Dict[bytes, Set[Tuple[bytes, int]]]
+        self.cached_summaries = {}  # type: Dict[bytes, List[MemPoolTxSummary]]
+        self.cached_utxos = {}  # type: Dict[bytes, List[UTXO]]
+        # prevout -> (hashX, value) of UTXOs found for txs not accepted by
+        # the last refresh.  The hashX and value of an outpoint are fixed
+        # by its tx hash, so they stay correct
+        self.prevout_cache = {}  # type: Dict[Tuple[bytes, int], Tuple[bytes, int]]
+        self.txs = _TxView(self)
+        self.hashXs = _HashXView(self)
+        self.fee_histogram = defaultdict(int)
         self.cached_compact_histogram = []
         self.refresh_secs = refresh_secs
         self.log_status_secs = log_status_secs
-        # Prevents mempool refreshes during fee histogram calculation
+        self.feed = feed
+        self.state_file = state_file
+        self.processes = processes
+        self.executor = None
+        # The height of the last sync with the daemon, or None
+        self.height = None
+        # Serializes changes to the mempool
         self.lock = Lock()
 
     async def _logging(self, synchronized_event):
@@ -136,36 +268,27 @@ class MemPool:
         elapsed = time.monotonic() - start
         self.logger.info(f'synced in {elapsed:.2f}s')
         while True:
-            mempool_size = sum(tx.size for tx in self.txs.values()) / 1_000_000
-            self.logger.info(f'{len(self.txs):,d} txs {mempool_size:.2f} MB '
-                             f'touching {len(self.hashXs):,d} addresses')
+            mempool_size = sum(self.tx_sizes) / 1_000_000
+            self.logger.info(f'{len(self.tx_nums):,d} txs {mempool_size:.2f} MB '
+                             f'touching {len(self.postings):,d} addresses')
+            self.logger.info(f'compact fee histogram: {self.cached_compact_histogram}')
             await sleep(self.log_status_secs)
             await synchronized_event.wait()
 
-    async def _refresh_histogram(self, synchronized_event):
-        while True:
-            await synchronized_event.wait()
-            async with self.lock:
-                # Threaded as can be expensive
-                bin_size = self.coin.MEMPOOL_COMPACT_HISTOGRAM_BINSIZE
-                await run_in_thread(self._update_histogram, bin_size)
-            await sleep(self.coin.MEMPOOL_HISTOGRAM_REFRESH_SECS)
+    @staticmethod
+    def _fee_rate(fee, size):
+        '''Return the fee histogram bucket of a tx.'''
+        # use 0.1 sat/byte resolution
+        # note: rounding *down* is intentional. This ensures txs
+        #       with a given fee rate will end up counted in the expected
+        #       bucket/interval of the compact histogram.
+        return math.floor(10 * (fee / size)) / 10
 
     def _update_histogram(self, bin_size):
-        # Build a histogram by fee rate
-        histogram = defaultdict(int)
-        for tx in self.txs.values():
-            fee_rate = tx.fee / tx.size
-            # use 0.1 sat/byte resolution
-            # note: rounding *down* is intentional. This ensures txs
-            #       with a given fee rate will end up counted in the expected
-            #       bucket/interval of the compact histogram.
-            fee_rate = math.floor(10 * fee_rate) / 10
-            histogram[fee_rate] += tx.size
-
-        compact = self._compress_histogram(histogram, bin_size=bin_size)
-        self.logger.info(f'compact fee histogram: {compact}')
-        self.cached_compact_histogram = compact
+        '''Compact the fee histogram, kept up to date as txs are added
+        and removed.'''
+        self.cached_compact_histogram = self._compress_histogram(
+            self.fee_histogram, bin_size=bin_size)
 
     @classmethod
     def _compress_histogram(
@@ -210,23 +333,41 @@ class MemPool:
         can be found in the existing mempool or a utxo_map from the
         DB.
 
+        Transactions are accepted in topological order in a single
+        pass, each after any parents it has in tx_map, so unconfirmed
+        chains of any depth need no further passes.
+
         Returns an (unprocessed tx_map, unspent utxo_map) pair.
         '''
-        hashXs = self.hashXs
-        txs = self.txs
+        tx_nums = self.tx_nums
+
+        # Index the txs by their parents in tx_map
+        children = defaultdict(list)
+        waiting = {}  # tx_hash -> count of parents not yet accepted
+        ready = []
+        for hash, tx in tx_map.items():
+            parents = {prev_hash for prev_hash, _ in tx.prevouts if prev_hash in tx_map}
+            if parents:
+                waiting[hash] = len(parents)
+                for prev_hash in parents:
+                    children[prev_hash].append(hash)
+            else:
+                ready.append(hash)
 
         deferred = {}
         unspent = set(utxo_map)
         # Try to find all prevouts so we can accept the TX
-        for hash, tx in tx_map.items():
+        while ready:
+            hash = ready.pop()
+            tx = tx_map[hash]
             in_pairs = []
             try:
                 for prevout in tx.prevouts:
                     utxo = utxo_map.get(prevout)
                     if not utxo:  # i.e. parent also unconfirmed
                         prev_hash, prev_index = prevout
-                        # Raises KeyError if prev_hash is not in txs
-                        utxo = txs[prev_hash].out_pairs[prev_index]
+                        # Raises KeyError if prev_hash is not in the mempool
+                        utxo = self._out_pair(tx_nums[prev_hash], prev_index)
                     in_pairs.append(utxo)
             except KeyError:
                 deferred[hash] = tx
@@ -235,25 +376,27 @@ class MemPool:
             # Spend the prevouts
             unspent.difference_update(tx.prevouts)
 
-            # Save the in_pairs, compute the fee and accept the TX
-            tx.in_pairs = tuple(in_pairs)
+            # Compute the fee and accept the TX
             # Avoid negative fees if dealing with generation-like transactions
             # because some in_parts would be missing
-            tx.fee = max(0, (sum(v for _, v in tx.in_pairs) -
-                             sum(v for _, v in tx.out_pairs)))
-            txs[hash] = tx
-
-            for hashX, _value in itertools.chain(tx.in_pairs, tx.out_pairs):
-                touched.add(hashX)
-                hashXs[hashX].add(hash)
-
+            fee = max(0, (sum(v for _, v in in_pairs) -
+                          sum(v for _, v in tx.out_pairs)))
+            self._add_tx(hash, tx.prevouts, in_pairs, tx.out_pairs, fee, tx.size, touched)
+
+            for child in children.pop(hash, ()):
+                waiting[child] -= 1
+                if not waiting[child]:
+                    del waiting[child]
+                    ready.append(child)
+
+        # Descendants of deferred txs are deferred too
+        deferred.update((hash, tx_map[hash]) for hash in waiting)
         return deferred, {prevout: utxo_map[prevout] for prevout in unspent}
 
-    async def _refresh_hashes(self, synchronized_event):
+    async def _refresh_hashes(self, synchronized_event, touched):
         '''Refresh our view of the daemon's mempool.'''
         # Touched accumulates between calls to on_mempool and each
         # call transfers ownership
-        touched = set()
         while True:
             height = self.api.cached_height()
             hex_hashes = await self.api.mempool_hashes()
@@ -268,111 +411,357 @@ class MemPool:
                 # mempool; wait and try again
                 self.logger.debug('waiting for DB to sync')
             else:
+                self.height = height
                 synchronized_event.set()
                 synchronized_event.clear()
                 await self.api.on_mempool(touched, height)
                 touched = set()
             await sleep(self.refresh_secs)
 
-    async def _process_mempool(self, all_hashes: Set[bytes], touched, mempool_height):
-        # Re-sync with the new set of hashes
-        txs = self.txs
-        hashXs = self.hashXs
+    async def _follow_feed(self, synchronized_event, touched):
+        '''Keep our view of the daemon's mempool up to date by applying
+        the changes from the feed, resyncing with all its hashes when
+        the feed needs it.'''
+        all_hashes = None
+        try:
+            while True:
+                changes = None
+                if all_hashes is None:
+                    height = self.api.cached_height()
+                    hex_hashes = await self.feed.resync()
+                    if height != await self.api.height():
+                        continue
+                    all_hashes = {hex_str_to_hash(hh) for hh in hex_hashes}
+                else:
+                    changes = await self.feed.changes()
+                    if changes is None:
+                        all_hashes = None
+                        continue
+                    height = self.api.cached_height()
+                    added, removed = changes
+                    all_hashes.difference_update(removed)
+                    all_hashes.update(added)
+                try:
+                    async with self.lock:
+                        await self._process_mempool(all_hashes, touched, height, changes)
+                except DBSyncError:
+                    self.logger.debug('waiting for DB to sync')
+                    # The changes may be partly applied
+                    all_hashes = None
+                    await sleep(self.refresh_secs)
+                else:
+                    self.height = height
+                    synchronized_event.set()
+                    synchronized_event.clear()
+                    await self.api.on_mempool(touched, height)
+                    touched = set()
+        finally:
+            self.feed.close()
+
+    async def _process_mempool(self, all_hashes: Set[bytes], touched, mempool_height,
+                               changes=None):
+        '''Re-sync with the new set of hashes.  changes, if given, is an
+        (added, removed) pair of sets of hashes that took the mempool to
+        all_hashes, saving a comparison of the two.'''
+        tx_nums = self.tx_nums
 
         if mempool_height != self.api.db_height():
             raise DBSyncError
 
+        if changes is not None:
+            added, removed = changes
+            gone = [tx_hash for tx_hash in removed if tx_hash in tx_nums]
+            new_hashes = [tx_hash for tx_hash in added if tx_hash not in tx_nums]
+        else:
+            gone = tx_nums.keys() - all_hashes
+            new_hashes = list(all_hashes.difference(tx_nums))
+
         # First handle txs that have disappeared
-        for tx_hash in (set(txs) - all_hashes):
-            tx = txs.pop(tx_hash)
-            tx_hashXs = {hashX for hashX, value in tx.in_pairs}
-            tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
-            for hashX in tx_hashXs:
-                hashXs[hashX].remove(tx_hash)
-                if not hashXs[hashX]:
-                    del hashXs[hashX]
-            touched |= tx_hashXs
-
-        # Process new transactions
-        new_hashes = list(all_hashes.difference(txs))
+        self._remove_txs(gone, touched)
+
+        # Process new transactions: fetch them in chunks, then look up
+        # the prevouts of them all at once, and accept them
         if new_hashes:
-            group = OldTaskGroup()
-            for hashes in chunks(new_hashes, 200):
-                coro = self._fetch_and_accept(hashes, all_hashes, touched)
-                await group.spawn(coro)
+            tx_map = {}
+            async with OldTaskGroup() as group:
+                for hashes in chunks(new_hashes, 200):
+                    await group.spawn(self._fetch_transactions(hashes))
+                async for task in group:
+                    tx_map.update(task.result())
+
+            utxo_map = await self._lookup_utxos(tx_map, all_hashes)
             if mempool_height != self.api.db_height():
+                # The txs are fetched again on retry, but found UTXOs
+                # need not be looked up again
+                self.prevout_cache = {prevout: utxo for prevout, utxo in utxo_map.items()
+                                      if utxo}
                 raise DBSyncError
 
-            tx_map = {}
-            utxo_map = {}
-            async for task in group:
-                deferred, unspent = task.result()
-                tx_map.update(deferred)
-                utxo_map.update(unspent)
-
-            prior_count = 0
-            # FIXME: this is not particularly efficient
-            while tx_map and len(tx_map) != prior_count:
-                prior_count = len(tx_map)
-                tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map,
-                                                             touched)
+            # Any txs not accepted have inputs that cannot be found
+            tx_map, unspent = self._accept_transactions(tx_map, utxo_map, touched)
             if tx_map:
                 self.logger.error(f'{len(tx_map)} txs dropped')
+            # Those txs are fetched again next refresh
+            self.prevout_cache = {prevout: utxo for prevout, utxo in unspent.items() if utxo}
 
+        self._update_histogram(self.coin.MEMPOOL_COMPACT_HISTOGRAM_BINSIZE)
         return touched
 
-    async def _fetch_and_accept(self, hashes: Sequence[bytes], all_hashes: Set[bytes], touched):
-        '''Fetch a list of mempool transactions.'''
+    def _add_tx(self, tx_hash, prevouts, in_pairs, out_pairs, fee, size, touched):
+        '''Add an accepted tx to the mempool, adding the hashXs it touches
+        to touched.'''
+        if self.free_tx_nums:
+            tx_num = self.free_tx_nums.pop()
+        else:
+            tx_num = len(self.tx_hashes)
+            self.tx_hashes.append(None)
+            self.tx_prevouts.append(b'')
+            self.tx_pairs.append(b'')
+            self.tx_fees.append(0)
+            self.tx_sizes.append(0)
+        pairs = tuple(itertools.chain(in_pairs, out_pairs))
+        self.tx_nums[tx_hash] = tx_num
+        self.tx_hashes[tx_num] = tx_hash
+        self.tx_prevouts[tx_num] = b''.join(itertools.starmap(PREVOUT.pack, prevouts))
+        self.tx_pairs[tx_num] = b''.join(itertools.starmap(PAIR.pack, pairs))
+        self.tx_fees[tx_num] = fee
+        self.tx_sizes[tx_num] = size
+        self.fee_histogram[self._fee_rate(fee, size)] += size
+
+        balances = self.balances
+        for hashX, value in in_pairs:
+            balances[hashX] = balances.get(hashX, 0) - value
+        for hashX, value in out_pairs:
+            balances[hashX] = balances.get(hashX, 0) + value
+
+        postings = self.postings
+        tx_hashXs = {hashX for hashX, _value in pairs}
+        for hashX in tx_hashXs:
+            posting = postings.get(hashX)
+            if posting is None:
+                postings[hashX] = array('I', (tx_num, ))
+            else:
+                posting.append(tx_num)
+        self._invalidate(tx_hashXs)
+        touched |= tx_hashXs
+
+    def _remove_txs(self, tx_hashes, touched):
+        '''Remove txs from the mempool, adding the hashXs they touched to
+        touched.'''
+        gone = defaultdict(set)  # hashX -> tx_nums
+        paid_hashXs = set()  # touched by any children of the txs
+        balances = self.balances
+        fee_histogram = self.fee_histogram
+        for tx_hash in tx_hashes:
+            tx_num = self.tx_nums.pop(tx_hash)
+            size = self.tx_sizes[tx_num]
+            fee_rate = self._fee_rate(self.tx_fees[tx_num], size)
+            fee_histogram[fee_rate] -= size
+            if not fee_histogram[fee_rate]:
+                del fee_histogram[fee_rate]
+            in_pairs, out_pairs = self._pairs(tx_num)
+            for hashX, value in in_pairs:
+                balances[hashX] += value
+                gone[hashX].add(tx_num)
+            for hashX, value in out_pairs:
+                balances[hashX] -= value
+                gone[hashX].add(tx_num)
+                paid_hashXs.add(hashX)
+            self.tx_hashes[tx_num] = None
+            self.tx_prevouts[tx_num] = self.tx_pairs[tx_num] = b''
+            self.tx_fees[tx_num] = self.tx_sizes[tx_num] = 0
+            self.free_tx_nums.append(tx_num)
+
+        # Rebuild the postings once per hashX rather than once per tx
+        postings = self.postings
+        for hashX, tx_nums in gone.items():
+            posting = array('I', (tx_num for tx_num in postings[hashX]
+                                  if tx_num not in tx_nums))
+            if posting:
+                postings[hashX] = posting
+            else:
+                del postings[hashX]
+                del balances[hashX]
+        self._invalidate(gone)
+
+        # Children of the txs may no longer have unconfirmed inputs
+        if self.cached_summaries:
+            removed = set(tx_hashes)
+            for hashX in paid_hashXs:
+                for tx_num in postings.get(hashX, ()):
+                    if any(prev_hash in removed for prev_hash, _ in self._prevouts(tx_num)):
+                        for pair_hashX, _value in PAIR.iter_unpack(self.tx_pairs[tx_num]):
+                            self.cached_summaries.pop(pair_hashX, None)
+        touched.update(gone)
+
+    def _invalidate(self, hashXs):
+        '''Drop the cached query results of hashXs.'''
+        if self.cached_spends or self.cached_summaries or self.cached_utxos:
+            for hashX in hashXs:
+                self.cached_spends.pop(hashX, None)
+                self.cached_summaries.pop(hashX, None)
+                self.cached_utxos.pop(hashX, None)
+
+    def _prevouts(self, tx_num):
+        '''Return an iterator of the prevouts of an accepted tx.'''
+        return PREVOUT.iter_unpack(self.tx_prevouts[tx_num])
+
+    def _pairs(self, tx_num):
+        '''Return iterators of the in_pairs and out_pairs of an accepted tx.'''
+        pairs = memoryview(self.tx_pairs[tx_num])
+        split = len(self.tx_prevouts[tx_num]) // PREVOUT.size * PAIR.size
+        return PAIR.iter_unpack(pairs[:split]), PAIR.iter_unpack(pairs[split:])
+
+    def _out_pair(self, tx_num, index):
+        '''Return the (hashX, value) pair of an output of an accepted tx.
+        Raises KeyError if it has no such output.'''
+        pairs = self.tx_pairs[tx_num]
+        offset = (len(self.tx_prevouts[tx_num]) // PREVOUT.size + index) * PAIR.size
+        if offset + PAIR.size > len(pairs):
+            raise KeyError(index)
+        return PAIR.unpack_from(pairs, offset)
+
+    def _tx(self, tx_num):
+        '''Return an accepted tx as a MemPoolTx.'''
+        in_pairs, out_pairs = self._pairs(tx_num)
+        return MemPoolTx(
+            prevouts=tuple(self._prevouts(tx_num)),
+            in_pairs=tuple(in_pairs),
+            out_pairs=tuple(out_pairs),
+            fee=self.tx_fees[tx_num],
+            size=self.tx_sizes[tx_num],
+        )
+
+    def _save_state(self):
+        '''Save the txs to the state file, to be loaded by _load_state
+        on the next start.'''
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(STATE_HEADER.pack(STATE_VERSION, self.height, len(self.tx_nums)))
+            for tx_hash, tx_num in self.tx_nums.items():
+                prevouts = self.tx_prevouts[tx_num]
+                pairs = self.tx_pairs[tx_num]
+                f.write(STATE_TX.pack(tx_hash, self.tx_fees[tx_num], self.tx_sizes[tx_num],
+                                      len(prevouts) // PREVOUT.size, len(pairs) // PAIR.size))
+                f.write(prevouts)
+                f.write(pairs)
+        os.replace(tmp_file, self.state_file)
+        self.logger.info(f'saved {len(self.tx_nums):,d} txs at height {self.height:,d}')
+
+    @staticmethod
+    def _read_state(data):
+        '''Return a (height, txs) pair from the contents of a state file,
+        txs being a list of (tx_hash, prevouts, in_pairs, out_pairs, fee,
+        size) tuples.'''
+        version, height, count = STATE_HEADER.unpack_from(data)
+        if version != STATE_VERSION:
+            raise ValueError(f'unknown version {version}')
+        offset = STATE_HEADER.size
+        txs = []
+        for _ in range(count):
+            tx_hash, fee, size, prevout_count, pair_count = STATE_TX.unpack_from(data, offset)
+            offset += STATE_TX.size
+            end = offset + prevout_count * PREVOUT.size
+            prevouts = tuple(PREVOUT.iter_unpack(data[offset:end]))
+            offset, end = end, end + pair_count * PAIR.size
+            pairs = tuple(PAIR.iter_unpack(data[offset:end]))
+            offset = end
+            txs.append((tx_hash, prevouts, pairs[:prevout_count], pairs[prevout_count:],
+                        fee, size))
+        if offset != len(data):
+            raise ValueError('trailing data')
+        return height, txs
+
+    def _load_state(self, touched):
+        '''Load the txs saved by _save_state, adding the hashXs they touch
+        to touched.
+
+        A tx's prevouts, and the hashXs and values they pay, are fixed by
+        its hash, so the saved txs stay valid while the daemon has them.
+        The first sync removes those it no longer has, and fetches only
+        the txs not saved.
+        '''
+        try:
+            with open(self.state_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        try:
+            height, txs = self._read_state(data)
+        except (struct_error, ValueError) as e:
+            self.logger.warning(f'ignoring the saved mempool: {e}')
+            return
+        db_height = self.api.db_height()
+        if height > db_height:
+            # Saved ahead of the DB, so not by this DB
+            self.logger.warning(f'ignoring the mempool saved at height {height:,d} '
+                                f'ahead of the DB at height {db_height:,d}')
+            return
+        for tx in txs:
+            self._add_tx(*tx, touched)
+        self.logger.info(f'loaded {len(txs):,d} txs saved at height {height:,d}')
+
+    async def _fetch_transactions(self, hashes: Sequence[bytes]) -> Dict[bytes, MemPoolTx]:
+        '''Fetch and deserialize a list of mempool transactions.'''
         hex_hashes_iter = (hash_to_hex_str(hash) for hash in hashes)
         raw_txs = await self.api.raw_transactions(hex_hashes_iter)
 
-        def deserialize_txs() -> Dict[bytes, MemPoolTx]:
-            """This function is pure"""
-            to_hashX = self.coin.hashX_from_script
-            deserializer = self.coin.DESERIALIZER
-
-            txs = {}  # type: Dict[bytes, MemPoolTx]
-            for hash, raw_tx in zip(hashes, raw_txs):
-                # The daemon may have evicted the tx from its
-                # mempool or it may have gotten in a block
-                if not raw_tx:
-                    continue
-                try:
-                    tx, tx_size = deserializer(raw_tx).read_tx_and_vsize()
-                except SkipTxDeserialize as ex:
-                    self.logger.debug(f'skipping tx {hash_to_hex_str(hash)}: {ex}')
+        if self.executor:
+            loop = asyncio.get_running_loop()
+            txs, skipped = await loop.run_in_executor(
+                self.executor, deserialize_txs, self.coin, hashes, raw_txs)
+        else:
+            # Thread this potentially slow operation so as not to block
+            txs, skipped = await run_in_thread(deserialize_txs, self.coin, hashes, raw_txs)
+        for hash, reason in skipped:
+            self.logger.debug(f'skipping tx {hash_to_hex_str(hash)}: {reason}')
+        return {hash: MemPoolTx(prevouts=prevouts, in_pairs=None, out_pairs=out_pairs,
+                                fee=0, size=size)
+                for hash, prevouts, out_pairs, size in txs}
+
+    async def _lookup_utxos(self, tx_map: Dict[bytes, MemPoolTx], all_hashes: Set[bytes]):
+        '''Return a map from the prevouts of the txs in tx_map that are not
+        in the mempool to their (hashX, value) pairs in the DB.
+
+        Each prevout is looked up once, in sorted order, unless in the
+        prevout cache.  Failed prevout lookups return None - concurrent
+        database updates happen - which is relied upon by
+        _accept_transactions.
+        '''
+        cache = self.prevout_cache
+        utxo_map = {}
+        prevouts = set()
+        for tx in tx_map.values():
+            for prevout in tx.prevouts:
+                if prevout[0] in all_hashes:
                     continue
-                # Convert the inputs and outputs into (hashX, value) pairs
-                # Drop generation-like inputs from MemPoolTx.prevouts
-                txin_pairs = tuple((txin.prev_hash, txin.prev_idx)
-                                   for txin in tx.inputs
-                                   if not txin.is_generation())
-                txout_pairs = tuple((to_hashX(txout.pk_script), txout.value)
-                                    for txout in tx.outputs)
-                txs[hash] = MemPoolTx(
-                    prevouts=txin_pairs,
-                    in_pairs=None,
-                    out_pairs=txout_pairs,
-                    fee=0,
-                    size=tx_size,
-                )
-            return txs
-
-        # Thread this potentially slow operation so as not to block
-        tx_map = await run_in_thread(deserialize_txs)  # type: Dict[bytes, MemPoolTx]
-
-        # Determine all prevouts not in the mempool, and fetch the
-        # UTXO information from the database.  Failed prevout lookups
-        # return None - concurrent database updates happen - which is
-        # relied upon by _accept_transactions. Ignore prevouts that are
-        # generation-like.
-        prevouts = tuple(prevout for tx in tx_map.values()
-                         for prevout in tx.prevouts
-                         if prevout[0] not in all_hashes)
+                utxo = cache.get(prevout)
+                if utxo:
+                    utxo_map[prevout] = utxo
+                else:
+                    prevouts.add(prevout)
+        prevouts = sorted(prevouts)
         utxos = await self.api.lookup_utxos(prevouts)
-        utxo_map = {prevout: utxo for prevout, utxo in zip(prevouts, utxos)}
-
-        return self._accept_transactions(tx_map, utxo_map, touched)
+        utxo_map.update(zip(prevouts, utxos))
+        return utxo_map
+
+    def _start_processes(self):
+        if not self.processes:
+            return
+        self.logger.info(f'deserializing txs in {self.processes:,d} processes '
+                         f'until synchronized')
+        self.executor = ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def _stop_processes(self):
+        if self.executor:
+            # Waiting for the processes to exit would block the event loop
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def _stop_processes_when_synchronized(self, synchronized_event):
+        await synchronized_event.wait()
+        self._stop_processes()
 
     #
     # External interface
@@ -380,23 +769,76 @@ class MemPool:
 
     async def keep_synchronized(self, synchronized_event):
         '''Keep the mempool synchronized with the daemon.'''
-        async with OldTaskGroup() as group:
-            await group.spawn(self._refresh_hashes(synchronized_event))
-            await group.spawn(self._refresh_histogram(synchronized_event))
-            await group.spawn(self._logging(synchronized_event))
+        touched = set()
+        if self.state_file:
+            self._load_state(touched)
+        self._start_processes()
+        try:
+            async with OldTaskGroup() as group:
+                if self.executor:
+                    await group.spawn(self._stop_processes_when_synchronized(synchronized_event))
+                if self.feed:
+                    await group.spawn(self._follow_feed(synchronized_event, touched))
+                else:
+                    await group.spawn(self._refresh_hashes(synchronized_event, touched))
+                await group.spawn(self._logging(synchronized_event))
+        finally:
+            self._stop_processes()
+            # Save the txs if synced since they were loaded
+            if self.state_file and self.height is not None:
+                try:
+                    self._save_state()
+                except OSError as e:
+                    self.logger.error(f'failed to save the mempool: {e}')
+
+    async def remove_confirmed(self, tx_hashes, spends, block_touched, height):
+        '''Remove the txs confirmed by a new block, and those spending
+        the same outpoints with their descendants, without waiting to
+        next sync with the daemon.  Then pass the hashXs touched to the
+        API's on_mempool.
+
+          tx_hashes - the set of hashes of the block's txs
+          spends - the set of (prev_hash, prev_idx) outpoints it spends
+          block_touched - the hashXs it touched, including those of the
+                          outputs it spends
+          height - its height
+        '''
+        async with self.lock:
+            if self.height is None:
+                # Not yet synced
+                return
+            tx_nums = self.tx_nums
+            hashes = self.tx_hashes
+            postings = self.postings
+            removed = {tx_hash for tx_hash in tx_hashes if tx_hash in tx_nums}
+            # A conflicting tx spends an output of one of the hashXs
+            conflicts = [hashes[tx_num] for hashX in block_touched
+                         for tx_num in postings.get(hashX, ())
+                         if hashes[tx_num] not in removed
+                         and not spends.isdisjoint(self._prevouts(tx_num))]
+            # Conflicts and their descendants are invalid
+            while conflicts:
+                tx_hash = conflicts.pop()
+                if tx_hash in removed:
+                    continue
+                removed.add(tx_hash)
+                _in_pairs, out_pairs = self._pairs(tx_nums[tx_hash])
+                for hashX, _value in out_pairs:
+                    conflicts.extend(hashes[child] for child in postings.get(hashX, ())
+                                     if any(prev_hash == tx_hash
+                                            for prev_hash, _ in self._prevouts(child)))
+            touched = set()
+            self._remove_txs(removed, touched)
+            self._update_histogram(self.coin.MEMPOOL_COMPACT_HISTOGRAM_BINSIZE)
+            self.height = height
+        await self.api.on_mempool(touched, height)
 
     async def balance_delta(self, hashX):
         '''Return the unconfirmed amount in the mempool for hashX.
 
         Can be positive or negative.
         '''
-        value = 0
-        if hashX in self.hashXs:
-            for hash in self.hashXs[hashX]:
-                tx = self.txs[hash]
-                value -= sum(v for h168, v in tx.in_pairs if h168 == hashX)
-                value += sum(v for h168, v in tx.out_pairs if h168 == hashX)
-        return value
+        return self.balances.get(hashX, 0)
 
     async def compact_fee_histogram(self):
         '''Return a compact fee histogram of the current mempool.'''
@@ -409,23 +851,33 @@ class MemPool:
         None, some or all of these may be spends of the hashX, but all
         actual spends of it (in the DB or mempool) will be included.
         '''
-        result = set()
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            result.update(tx.prevouts)
-        return result
+        if hashX not in self.postings:
+            return set()
+        result = self.cached_spends.get(hashX)
+        if result is None:
+            result = set()
+            for tx_num in self.postings[hashX]:
+                result.update(self._prevouts(tx_num))
+            self.cached_spends[hashX] = result
+        return set(result)
 
     async def transaction_summaries(self, hashX):
         '''Return a list of MemPoolTxSummary objects for the hashX,
         sorted as expected by protocol methods.
         '''
-        result = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            has_ui = any(hash in self.txs for hash, idx in tx.prevouts)
-            result.append(MemPoolTxSummary(tx_hash, tx.fee, has_ui))
-        result.sort(key=lambda x: (x.has_unconfirmed_inputs, x.hash[::-1]))
-        return result
+        if hashX not in self.postings:
+            return []
+        result = self.cached_summaries.get(hashX)
+        if result is None:
+            result = []
+            tx_nums = self.tx_nums
+            for tx_num in self.postings[hashX]:
+                has_ui = any(hash in tx_nums for hash, idx in self._prevouts(tx_num))
+                result.append(MemPoolTxSummary(self.tx_hashes[tx_num],
+                                               self.tx_fees[tx_num], has_ui))
+            result.sort(key=lambda x: (x.has_unconfirmed_inputs, x.hash[::-1]))
+            self.cached_summaries[hashX] = result
+        return list(result)
 
     async def unordered_UTXOs(self, hashX):
         '''Return an unordered list of UTXO named tuples from mempool
@@ -434,10 +886,16 @@ class MemPool:
         This does not consider if any other mempool transactions spend
         the outputs.
         '''
-        utxos = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs.get(tx_hash)
-            for pos, (hX, value) in enumerate(tx.out_pairs):
-                if hX == hashX:
-                    utxos.append(UTXO(-1, pos, tx_hash, 0, value))
-        return utxos
+        if hashX not in self.postings:
+            return []
+        utxos = self.cached_utxos.get(hashX)
+        if utxos is None:
+            utxos = []
+            for tx_num in self.postings[hashX]:
+                tx_hash = self.tx_hashes[tx_num]
+                _in_pairs, out_pairs = self._pairs(tx_num)
+                for pos, (hX, value) in enumerate(out_pairs):
+                    if hX == hashX:
+                        utxos.append(UTXO(-1, pos, tx_hash, 0, value))
+            self.cached_utxos[hashX] = utxos
+        return list(utxos)
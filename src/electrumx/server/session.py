@@ -139,6 +139,7 @@ class SessionManager:
             daemon: 'Daemon',
             mempool: 'MemPool',
             shutdown_event: asyncio.Event,
+            peer_mgr: Optional['PeerManager'] = None,
     ):
         env.max_send = max(350000, env.max_send)
         self.env = env
@@ -146,8 +147,10 @@ class SessionManager:
         self.bp = block_processor
         self.daemon = daemon
         self.mempool = mempool
-        from electrumx.server.peers import PeerManager
-        self.peer_mgr = PeerManager(env, db)
+        if peer_mgr is None:
+            from electrumx.server.peers import PeerManager
+            peer_mgr = PeerManager(env, db)
+        self.peer_mgr = peer_mgr
         self.shutdown_event = shutdown_event
         self.logger = util.class_logger(__name__, self.__class__.__name__)
         self.servers = {}           # service->server
@@ -172,7 +175,7 @@ class SessionManager:
         self.session_event = Event()
 
         # Set up the RPC request handlers
-        cmds = ('add_peer daemon_url disconnect getinfo groups log peers '
+        cmds = ('add_peer checkpoint daemon_url disconnect getinfo groups log peers '
                 'query reorg sessions stop debug_memusage_list_all_objects '
                 'debug_memusage_get_random_backref_chain'.split())
         LocalRPC.request_handlers = {cmd: getattr(self, 'rpc_' + cmd)
@@ -203,6 +206,10 @@ class SessionManager:
                     serve = serve_ws
                 else:
                     serve = partial(serve_rs, transport=PaddedRSTransport)
+            kwargs = {}
+            if self.env.query_workers and service.protocol != 'rpc':
+                # Query workers all listen on the same ports
+                kwargs['reuse_port'] = True
             # FIXME: pass the service not the kind
             session_factory = partial(
                 session_class,
@@ -215,7 +222,7 @@ class SessionManager:
             host = None if service.host == 'all_interfaces' else str(service.host)
             try:
                 self.servers[service] = await serve(session_factory, host,
-                                                    service.port, ssl=sslc)
+                                                    service.port, ssl=sslc, **kwargs)
             except OSError as e:    # don't suppress CancelledError
                 self.logger.error(f'{kind} server failed to listen on {service.address}: {e}')
             else:
@@ -510,6 +517,21 @@ class SessionManager:
         result.extend(f'unknown: {item}' for item in refs.unknown)
         return result
 
+    async def rpc_checkpoint(self, path):
+        '''Write a consistent copy of the databases to a new directory.
+
+        path: the directory, relative to DB_DIRECTORY if not absolute
+        '''
+        if os.path.exists(path):
+            raise RPCError(BAD_REQUEST, f'{path} already exists')
+        # Hold off flushes; queries are served from the read view meanwhile
+        async with self.bp.state_lock:
+            try:
+                height = await run_in_thread(self.db.checkpoint, path)
+            except OSError as e:
+                raise RPCError(BAD_REQUEST, f'an error occurred: {e!r}')
+        return f'checkpoint at height {height:,d} written to {path}'
+
     async def rpc_daemon_url(self, daemon_url):
         '''Replace the daemon URL.'''
         daemon_url = daemon_url or self.env.daemon_url
@@ -579,18 +601,21 @@ class SessionManager:
             if n is None:
                 lines.append('No history found')
             n = None
-            utxos = await db.all_utxos(hashX)
+            view = db.read_view
+            tx_nums, tx_positions, values = await db.raw_utxos(hashX, view)
+            # Only resolve the tx hashes of the UTXOs shown
+            shown = slice(None) if limit is None or limit < 0 else slice(limit)
+            utxos = await db.resolve_utxos(tx_nums[shown], tx_positions[shown],
+                                           values[shown], view)
             for n, utxo in enumerate(utxos, start=1):
                 lines.append(f'UTXO #{n:,d}: tx_hash '
                              f'{hash_to_hex_str(utxo.tx_hash)} '
                              f'tx_pos {utxo.tx_pos:,d} height '
                              f'{utxo.height:,d} value {utxo.value:,d}')
-                if n == limit:
-                    break
             if n is None:
                 lines.append('No UTXOs found')
 
-            balance = sum(utxo.value for utxo in utxos)
+            balance = sum(values)
             lines.append(f'Balance: {coin.decimal_value(balance):,f} '
                          f'{coin.SHORTNAME}')
 
@@ -838,6 +863,22 @@ class SessionManager:
             raise result
         return result, cost
 
+    async def recent_history(self, hashX, limit):
+        '''Returns a pair (history, cost).
+
+        History is a list of the most recent limit (tx_hash, height) tuples,
+        newest first.  It is taken from the history cache if the full history
+        is there, otherwise the DB history is read backwards from its tip.'''
+        cost = 0.1
+        self._history_cache.num_lookups += 1
+        cached = self._history_cache.get(hashX)
+        if isinstance(cached, list):
+            self._history_cache.num_hits += 1
+            return cached[::-1][:limit], cost
+        result = await self.db.limited_history(hashX, limit=limit, reverse=True)
+        cost += 0.1 + len(result) * 0.001
+        return result, cost
+
     async def _notify_sessions(self, height, touched):
         '''Notify sessions about height changes and touched addresses.'''
         height_changed = height != self.notified_height
@@ -1067,7 +1108,12 @@ class ElectrumX(SessionBase):
 
     PROTOCOL_MIN = (1, 4)
     # consider bumping Coin.MIN_REQUIRED_DAEMON_VERSION too when releasing a new protocol version
-    PROTOCOL_MAX = (1, 6, 0)
+    PROTOCOL_MAX = (1, 6)
+    # Methods beyond the Electrum protocol, served whatever version was
+    # negotiated and listed in server.features
+    EXTENSIONS = {
+        'electrumx.scripthash.get_recent_history': 'scripthash_get_recent_history',
+    }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1104,6 +1150,7 @@ class ElectrumX(SessionBase):
             'genesis_hash': env.coin.GENESIS_HASH,
             'hash_function': 'sha256',
             'services': [str(service) for service in env.report_services],
+            'extensions': sorted(cls.EXTENSIONS),
         }
 
     async def server_features_async(self):
@@ -1247,8 +1294,9 @@ class ElectrumX(SessionBase):
     async def hashX_listunspent(self, hashX):
         '''Return the list of UTXOs of a script hash, including mempool
         effects.'''
+        # Spends are only known by tx hash, so resolve every confirmed UTXO,
+        # but in a single batched pass
         utxos = await self.db.all_utxos(hashX)
-        utxos = sorted(utxos)
         utxos.extend(await self.mempool.unordered_UTXOs(hashX))
         self.bump_cost(1.0 + len(utxos) / 50)
         spends = await self.mempool.potential_spends(hashX)
@@ -1266,10 +1314,9 @@ class ElectrumX(SessionBase):
         return result
 
     async def get_balance(self, hashX):
-        utxos = await self.db.all_utxos(hashX)
-        confirmed = sum(utxo.value for utxo in utxos)
+        confirmed, _utxo_count = await self.db.get_balance(hashX)
         unconfirmed = await self.mempool.balance_delta(hashX)
-        self.bump_cost(1.0 + len(utxos) / 50)
+        self.bump_cost(1.0)
         return {'confirmed': confirmed, 'unconfirmed': unconfirmed}
 
     async def scripthash_get_balance(self, scripthash):
@@ -1300,6 +1347,29 @@ class ElectrumX(SessionBase):
         hashX = scripthash_to_hashX(scripthash)
         return await self.confirmed_and_unconfirmed_history(hashX)
 
+    async def scripthash_get_recent_history(self, scripthash, limit=100):
+        '''Return the most recent confirmed and unconfirmed history of a
+        scripthash, newest first.
+
+        scripthash: the SHA256 hash of the script
+        limit: the maximum number of entries to return
+        '''
+        hashX = scripthash_to_hashX(scripthash)
+        limit = non_negative_integer(limit)
+        max_limit = self.env.max_send // 99
+        if limit > max_limit:
+            raise RPCError(BAD_REQUEST, f'limit {limit:,d} exceeds the maximum '
+                           f'of {max_limit:,d}')
+        # Mempool transactions are newer than anything confirmed
+        result = (await self.unconfirmed_history(hashX))[::-1][:limit]
+        if len(result) < limit:
+            history, cost = await self.session_mgr.recent_history(
+                hashX, limit - len(result))
+            self.bump_cost(cost)
+            result.extend({'tx_hash': hash_to_hex_str(tx_hash), 'height': height}
+                          for tx_hash, height in history)
+        return result
+
     async def scripthash_get_mempool(self, scripthash):
         '''Return the mempool transactions touching a scripthash.'''
         hashX = scripthash_to_hashX(scripthash)
@@ -1737,6 +1807,9 @@ class ElectrumX(SessionBase):
         else:
             handlers['blockchain.relayfee'] = self.relayfee  # removed in 1.6
 
+        for method, name in self.EXTENSIONS.items():
+            handlers[method] = getattr(self, name)
+
         self.request_handlers = handlers
 
 
@@ -8,8 +8,14 @@
 '''Backend database abstraction.'''
 
 import os
+import shutil
+import sys
 from functools import partial
-from typing import Type
+from heapq import merge
+from threading import Lock, local
+from typing import Sequence, Type
+
+import attr
 
 import electrumx.lib.util as util
 
@@ -23,13 +29,36 @@ def db_class(name) -> Type['Storage']:
     raise RuntimeError(f'unrecognised DB engine "{name}"')
 
 
+@attr.s(slots=True, frozen=True)
+class Table:
+    '''A logical table of a database: the keys starting with key_prefix.
+
+    Tables are addressed through the usual Storage methods by their
+    key prefix.  Backends with a flat keyspace ignore them; others may
+    store and tune each table separately.  A table with an empty
+    key_prefix describes the keys belonging to no other table.
+    '''
+    key_prefix = attr.ib()  # type: bytes
+    # False if keys are only ever found by prefix scans, never get()
+    point_lookups = attr.ib(default=True)  # type: bool
+
+
 class Storage:
     '''Abstract base class of the DB backend abstraction.'''
 
-    def __init__(self, name, for_sync):
+    # True if other processes can read the database while it is written
+    shared_readers = False
+
+    def __init__(self, name, for_sync, tables: Sequence[Table] = (), read_only=False):
+        if read_only and not self.shared_readers:
+            raise RuntimeError(f'{self.__class__.__name__} databases cannot '
+                               f'be read while another process writes them')
         self.is_new = not os.path.exists(name)
         self.for_sync = for_sync or self.is_new
-        self.open(name, create=self.is_new)
+        self.tables = tables
+        self.read_only = read_only
+        self.name = name
+        self.open(name, create=self.is_new and not read_only)
 
     @classmethod
     def import_module(cls):
@@ -68,6 +97,56 @@ class Storage:
         '''
         raise NotImplementedError
 
+    def snapshot(self):
+        '''Return a read-only, point-in-time view of the database.
+
+        The view provides `get` and `iterator` as above, and does not
+        see writes made after it was taken.  It is released when it is
+        garbage collected.
+        '''
+        raise NotImplementedError
+
+    def checkpoint(self, path):
+        '''Write a copy of the database to the directory path, which must
+        not exist, as of the last committed write.  The database must not
+        be written meanwhile.'''
+        raise NotImplementedError
+
+
+def checkpoint_table_files(name, path):
+    '''Checkpoint a LevelDB or RocksDB database directory.
+
+    Table files are immutable so are hard-linked; the manifest, the
+    write-ahead log and the rest are copied.  A background compaction
+    can replace table files meanwhile, which shows as a change to the
+    manifest, so the copy is retried until it has none.
+    '''
+    while True:
+        os.mkdir(path)
+        try:
+            with open(os.path.join(name, 'CURRENT')) as f:
+                current = f.read()
+            manifest = os.path.join(name, current.strip())
+            manifest_size = os.path.getsize(manifest)
+            # Copy the manifest before linking the table files it names
+            filenames = sorted(os.listdir(name),
+                               key=lambda filename: not filename.startswith('MANIFEST'))
+            for filename in filenames:
+                src = os.path.join(name, filename)
+                dest = os.path.join(path, filename)
+                if filename.startswith(('LOCK', 'LOG')) or not os.path.isfile(src):
+                    continue
+                if filename.endswith(('.ldb', '.sst')):
+                    util.link_or_copy(src, dest)
+                else:
+                    shutil.copy2(src, dest)
+            with open(os.path.join(name, 'CURRENT')) as f:
+                if f.read() == current and os.path.getsize(manifest) == manifest_size:
+                    return
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(path)
+
 
 class LevelDB(Storage):
     '''LevelDB database engine.'''
@@ -86,12 +165,22 @@ class LevelDB(Storage):
         self.get = self.db.get
         self.put = self.db.put
         self.iterator = self.db.iterator
+        self.snapshot = self.db.snapshot
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
+    def checkpoint(self, path):
+        checkpoint_table_files(self.name, path)
+
 
 class RocksDB(Storage):
-    '''RocksDB database engine.'''
+    '''RocksDB database engine.
+
+    Each table is kept in its own column family, with a bloom filter
+    so point lookups can skip SST files not holding the key.  Databases
+    created before column families were used keep their single flat
+    keyspace.
+    '''
 
     @classmethod
     def import_module(cls):
@@ -102,48 +191,130 @@ class RocksDB(Storage):
         mof = 512 if self.for_sync else 128
         # Use snappy compression (the default)
         options = self.module.Options(create_if_missing=create,
+                                      create_missing_column_families=create,
                                       use_fsync=True,
                                       target_file_size_base=33554432,
                                       max_open_files=mof)
-        self.db = self.module.DB(name, options)
-        self.get = self.db.get
-        self.put = self.db.put
+        self.default_table = Table(b'')
+        for table in self.tables:
+            if not table.key_prefix:
+                self.default_table = table
+                self._tune_family(options, table)
+        tables = [table for table in self.tables if table.key_prefix]
+        self.families = []
+        if not create:
+            try:
+                self.db = self.module.DB(name, options)
+                return
+            except self.module.errors.InvalidArgument:
+                # It has column families, which must all be opened
+                pass
+        column_families = {table.key_prefix: self._tune_family(
+            self.module.ColumnFamilyOptions(), table) for table in tables}
+        self.db = self.module.DB(name, options, column_families=column_families)
+        self.families = [(table, self.db.get_column_family(table.key_prefix))
+                         for table in tables]
+
+    def _tune_family(self, options, table):
+        '''Set up the bloom filter of a column family.'''
+        options.table_factory = self.module.BlockBasedTableFactory(
+            filter_policy=self.module.BloomFilterPolicy(10),
+            whole_key_filtering=table.point_lookups)
+        return options
+
+    def _family(self, key):
+        '''Return a (table, column family handle) pair for the table holding
+        key.  The handle is None for the default column family.'''
+        for table, family in self.families:
+            if key.startswith(table.key_prefix):
+                return table, family
+        return self.default_table, None
+
+    def _key(self, key):
+        _table, family = self._family(key)
+        return key if family is None else (family, key)
 
     def close(self):
         # PyRocksDB doesn't provide a close method; hopefully this is enough
-        self.db = self.get = self.put = None
+        self.db = self.families = None
         import gc
         gc.collect()
 
+    def get(self, key):
+        return self.db.get(self._key(key))
+
+    def put(self, key, value):
+        self.db.put(self._key(key), value)
+
     def write_batch(self):
-        return RocksDBWriteBatch(self.db)
+        return RocksDBWriteBatch(self)
+
+    def iterator(self, prefix=b'', reverse=False):
+        return self._iterator(prefix, reverse, None)
+
+    def _iterator(self, prefix, reverse, snapshot):
+        _table, family = self._family(prefix)
+        if family or not self.families:
+            return RocksDBIterator(self.db, prefix, reverse, snapshot, family)
+        # The prefix can span several column families; merge them
+        families = [None] + [family for table, family in self.families
+                             if table.key_prefix.startswith(prefix)]
+        return merge(*(RocksDBIterator(self.db, prefix, reverse, snapshot, family)
+                       for family in families), reverse=reverse)
+
+    def snapshot(self):
+        return RocksDBSnapshot(self)
+
+    def checkpoint(self, path):
+        checkpoint_table_files(self.name, path)
+
+
+class RocksDBSnapshot:
+    '''A point-in-time view of a RocksDB database.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.snapshot = storage.db.snapshot()
+
+    def get(self, key):
+        return self.storage.db.get(self.storage._key(key), snapshot=self.snapshot)
 
     def iterator(self, prefix=b'', reverse=False):
-        return RocksDBIterator(self.db, prefix, reverse)
+        return self.storage._iterator(prefix, reverse, self.snapshot)
 
 
 class RocksDBWriteBatch:
     '''A write batch for RocksDB.'''
 
-    def __init__(self, db):
+    def __init__(self, storage):
         self.batch = RocksDB.module.WriteBatch()
-        self.db = db
+        self.storage = storage
 
     def __enter__(self):
-        return self.batch
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not exc_val:
-            self.db.write(self.batch)
+            self.storage.db.write(self.batch)
+
+    def put(self, key, value):
+        self.batch.put(self.storage._key(key), value)
+
+    def delete(self, key):
+        self.batch.delete(self.storage._key(key))
 
 
 class RocksDBIterator:
-    '''An iterator for RocksDB.'''
+    '''An iterator for RocksDB, over one column family.'''
 
-    def __init__(self, db, prefix, reverse):
+    def __init__(self, db, prefix, reverse, snapshot=None, family=None):
         self.prefix = prefix
+        if family is None:
+            items = db.iteritems(snapshot=snapshot)
+        else:
+            items = db.iteritems(family, snapshot=snapshot)
         if reverse:
-            self.iterator = reversed(db.iteritems())
+            self.iterator = reversed(items)
             nxt_prefix = util.increment_byte_string(prefix)
             if nxt_prefix:
                 self.iterator.seek(nxt_prefix)
@@ -154,7 +325,7 @@ class RocksDBIterator:
             else:
                 self.iterator.seek_to_last()
         else:
-            self.iterator = db.iteritems()
+            self.iterator = items
             self.iterator.seek(prefix)
 
     def __iter__(self):
@@ -162,6 +333,150 @@ class RocksDBIterator:
 
     def __next__(self):
         k, v = next(self.iterator)
+        if isinstance(k, tuple):
+            # Column family iterators yield (family, key) pairs
+            k = k[1]
         if not k.startswith(self.prefix):
             raise StopIteration
         return k, v
+
+
+class LMDB(Storage):
+    '''LMDB database engine.
+
+    Reads come straight out of the memory map with no block cache or
+    decompression, and any number of threads can read concurrently
+    while a single writer commits.  Keys and values are returned as
+    bytes; buffers into the map are only valid for the life of their
+    read transaction, which callers could not be trusted to respect.
+    '''
+
+    # The map is sparse, so reserve address space generously up front
+    MAP_SIZE = 1 << 40 if sys.maxsize > 2**32 else 1 << 30
+    MAX_READERS = 1024
+    shared_readers = True
+
+    @classmethod
+    def import_module(cls):
+        import lmdb
+        cls.module = lmdb
+
+    def open(self, name, create):
+        # During sync writes dominate; when serving, reads are random so
+        # readahead only pollutes the page cache
+        self.env = self.module.open(name, create=create, map_size=self.MAP_SIZE,
+                                    max_readers=self.MAX_READERS,
+                                    readahead=self.for_sync,
+                                    readonly=self.read_only)
+        self.close = self.env.close
+
+    def get(self, key):
+        with self.env.begin() as txn:
+            return txn.get(key)
+
+    def put(self, key, value):
+        with self.env.begin(write=True) as txn:
+            txn.put(key, value)
+
+    def write_batch(self):
+        # A write transaction commits on a clean exit and aborts otherwise
+        return self.env.begin(write=True)
+
+    def iterator(self, prefix=b'', reverse=False):
+        with self.env.begin() as txn:
+            yield from lmdb_iterator(txn, prefix, reverse)
+
+    def snapshot(self):
+        return LMDBSnapshot(self.env)
+
+    def checkpoint(self, path):
+        # A copy is taken through a read transaction so is consistent
+        os.mkdir(path)
+        self.env.copy(path)
+
+
+class LMDBSnapshot:
+    '''A point-in-time view of an LMDB database.
+
+    LMDB transactions must not be used by two threads at once, so each
+    thread reads through its own read transaction, begun on its first
+    read.  That only sees the snapshot's data if nothing was committed
+    since the snapshot was taken; a thread that finds something was
+    falls back to the transaction begun with the snapshot, shared under
+    a lock.  The transactions are aborted when the snapshot is garbage
+    collected.  Iterators must be consumed on the thread that created
+    them.'''
+
+    def __init__(self, env):
+        self.env = env
+        self.txn = env.begin()
+        self.lock = Lock()
+        self.local = local()
+        self.txns = [self.txn]
+
+    def __del__(self):
+        for txn in self.txns:
+            txn.abort()
+
+    def _thread_txn(self):
+        '''Return this thread's read transaction, or None if it must use
+        the shared one.'''
+        try:
+            return self.local.txn
+        except AttributeError:
+            pass
+        txn = self.env.begin()
+        if txn.id() == self.txn.id():
+            self.txns.append(txn)
+        else:
+            txn.abort()
+            txn = None
+        self.local.txn = txn
+        return txn
+
+    def get(self, key):
+        txn = self._thread_txn()
+        if txn:
+            return txn.get(key)
+        with self.lock:
+            return self.txn.get(key)
+
+    def iterator(self, prefix=b'', reverse=False):
+        txn = self._thread_txn()
+        if txn:
+            return lmdb_iterator(txn, prefix, reverse)
+        return LockedIterator(lmdb_iterator(self.txn, prefix, reverse), self.lock)
+
+
+class LockedIterator:
+    '''Wraps an iterator so each step holds a lock.'''
+
+    def __init__(self, iterator, lock):
+        self.iterator = iterator
+        self.lock = lock
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.iterator)
+
+
+def lmdb_iterator(txn, prefix, reverse):
+    '''Yield the (key, value) pairs of txn whose keys start with prefix,
+    in key order or reverse key order.'''
+    with txn.cursor() as cursor:
+        if reverse:
+            nxt_prefix = util.increment_byte_string(prefix)
+            if nxt_prefix and cursor.set_range(nxt_prefix):
+                found = cursor.prev()
+            else:
+                found = cursor.last()
+            items = cursor.iterprev() if found else ()
+        else:
+            items = cursor.iternext() if cursor.set_range(prefix) else ()
+        for key, value in items:
+            if not key.startswith(prefix):
+                return
+            yield key, value
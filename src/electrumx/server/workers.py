@@ -0,0 +1,329 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Query workers: processes serving client sessions for an indexer.
+
+With QUERY_WORKERS set, the process running the block processor and
+mempool - the indexer - serves no clients itself.  It starts that many
+worker processes, which listen on the client ports together and read
+the databases read-only.  They talk to the indexer over a local socket:
+the indexer announces each block and mempool refresh, and answers the
+workers' mempool queries.  Only the indexer discovers peers; workers
+pass add_peer requests on to it, and serve its list of peers.
+'''
+
+import asyncio
+import os
+import sys
+from functools import partial
+
+from aiorpcx import (Event, NetAddress, NewlineFramer, Request, RPCError, RPCSession,
+                     connect_us, handler_invocation, serve_us, sleep)
+
+import electrumx.lib.util as util
+from electrumx.lib.server_base import ServerBase
+from electrumx.lib.util import OldTaskGroup
+from electrumx.server.db import DB, UTXO
+from electrumx.server.mempool import MemPoolTxSummary
+from electrumx.server.session import SessionManager
+
+
+# The indexer's socket, relative to DB_DIRECTORY
+INDEXER_SOCKET = 'indexer.sock'
+
+
+class LinkSession(RPCSession):
+    '''A session between the indexer and a query worker.  The other end is
+    trusted, so neither cost nor message size is limited.'''
+
+    cost_hard_limit = 0
+    cost_soft_limit = 0
+    initial_concurrent = 1000
+
+    def default_framer(self):
+        return NewlineFramer(max_size=0)
+
+
+class IndexerSession(LinkSession):
+    '''The indexer's end of its link with a query worker.'''
+
+    def __init__(self, *args, indexer, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.indexer = indexer
+        mempool = indexer.mempool
+        self.request_handlers = {
+            'add_peer': self.add_peer,
+            'balance_delta': self.balance_delta,
+            'compact_fee_histogram': mempool.compact_fee_histogram,
+            'peers': self.peers,
+            'potential_spends': self.potential_spends,
+            'transaction_summaries': self.transaction_summaries,
+            'unordered_UTXOs': self.unordered_UTXOs,
+        }
+        indexer.sessions.add(self)
+
+    async def connection_lost(self):
+        await super().connection_lost()
+        self.indexer.sessions.discard(self)
+
+    async def handle_request(self, request):
+        handler = None
+        if isinstance(request, Request):
+            handler = self.request_handlers.get(request.method)
+        return await handler_invocation(handler, request)()
+
+    async def add_peer(self, features, source):
+        source_addr = NetAddress.from_string(source) if source else None
+        return await self.indexer.peer_mgr.on_add_peer(features, source_addr)
+
+    async def balance_delta(self, hashX):
+        return await self.indexer.mempool.balance_delta(bytes.fromhex(hashX))
+
+    async def peers(self):
+        peer_mgr = self.indexer.peer_mgr
+        proxy_address = peer_mgr.proxy_address()
+        return {
+            'peers': peer_mgr.on_peers_subscribe(False),
+            'tor_peers': peer_mgr.on_peers_subscribe(True),
+            'proxy': str(proxy_address) if proxy_address else None,
+        }
+
+    async def potential_spends(self, hashX):
+        spends = await self.indexer.mempool.potential_spends(bytes.fromhex(hashX))
+        return [(tx_hash.hex(), tx_pos) for tx_hash, tx_pos in spends]
+
+    async def transaction_summaries(self, hashX):
+        summaries = await self.indexer.mempool.transaction_summaries(bytes.fromhex(hashX))
+        return [(summary.hash.hex(), summary.fee, summary.has_unconfirmed_inputs)
+                for summary in summaries]
+
+    async def unordered_UTXOs(self, hashX):
+        utxos = await self.indexer.mempool.unordered_UTXOs(bytes.fromhex(hashX))
+        return [(utxo.tx_pos, utxo.tx_hash.hex(), utxo.value) for utxo in utxos]
+
+
+class Indexer:
+    '''Runs the query workers of the indexer process, answers their
+    mempool and peer queries and passes notifications on to them.'''
+
+    def __init__(self, env, mempool, peer_mgr):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.env = env
+        self.mempool = mempool
+        self.peer_mgr = peer_mgr
+        self.sessions = set()
+
+    async def notify(self, height, touched):
+        touched = [hashX.hex() for hashX in touched]
+        for session in list(self.sessions):
+            try:
+                await session.send_notification('notify', (height, touched))
+            except OSError:
+                # The worker is gone; it will be restarted
+                pass
+
+    async def _run_worker(self, worker_id):
+        '''Run a query worker process, restarting it if it dies.'''
+        environ = dict(os.environ)
+        environ['QUERY_WORKER_ID'] = str(worker_id)
+        # So the worker can import us however we were started
+        environ['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'electrumx.cli.electrumx_server', env=environ)
+            self.logger.info(f'started query worker {worker_id} pid {process.pid}')
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.terminate()
+                    await process.wait()
+                raise
+            self.logger.error(f'query worker {worker_id} exited with code {code}; '
+                              f'restarting it')
+            await asyncio.sleep(1)
+
+    async def serve(self):
+        '''Listen for query workers, and run them.'''
+        if os.path.exists(INDEXER_SOCKET):
+            os.remove(INDEXER_SOCKET)
+        session_factory = partial(IndexerSession, indexer=self)
+        server = await serve_us(session_factory, INDEXER_SOCKET)
+        self.logger.info(f'running {self.env.query_workers:,d} query workers')
+        try:
+            async with OldTaskGroup() as group:
+                for worker_id in range(self.env.query_workers):
+                    await group.spawn(self._run_worker(worker_id))
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+class WorkerSession(LinkSession):
+    '''A query worker's end of its link with the indexer.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.notifications = None
+        self.lost_event = Event()
+
+    async def connection_lost(self):
+        await super().connection_lost()
+        self.lost_event.set()
+
+    async def handle_request(self, request):
+        if request.method == 'notify' and self.notifications:
+            height, touched = request.args
+            await self.notifications.on_indexer(height, {bytes.fromhex(hashX)
+                                                         for hashX in touched})
+
+
+class IndexerClient:
+    '''Base class of the query worker's stand-ins for the indexer's
+    objects.'''
+
+    def __init__(self, session):
+        self.session = session
+
+    async def _request(self, method, *args):
+        try:
+            return await self.session.send_request(method, args)
+        except RPCError as e:
+            raise RuntimeError(f'indexer failed {method} request: {e.message}') from None
+
+
+class MemPoolClient(IndexerClient):
+    '''The mempool as seen by a query worker: queries are answered by the
+    indexer.  Provides the MemPool methods that sessions use.'''
+
+    async def balance_delta(self, hashX):
+        return await self._request('balance_delta', hashX.hex())
+
+    async def compact_fee_histogram(self):
+        return await self._request('compact_fee_histogram')
+
+    async def potential_spends(self, hashX):
+        spends = await self._request('potential_spends', hashX.hex())
+        return {(bytes.fromhex(tx_hash), tx_pos) for tx_hash, tx_pos in spends}
+
+    async def transaction_summaries(self, hashX):
+        summaries = await self._request('transaction_summaries', hashX.hex())
+        return [MemPoolTxSummary(bytes.fromhex(tx_hash), fee, has_ui)
+                for tx_hash, fee, has_ui in summaries]
+
+    async def unordered_UTXOs(self, hashX):
+        utxos = await self._request('unordered_UTXOs', hashX.hex())
+        return [UTXO(-1, tx_pos, bytes.fromhex(tx_hash), 0, value)
+                for tx_pos, tx_hash, value in utxos]
+
+
+class PeerManagerClient(IndexerClient):
+    '''The peer manager as seen by a query worker: the indexer discovers
+    peers, and its peer lists are refreshed periodically.  Provides the
+    PeerManager methods that sessions use.'''
+
+    REFRESH_SECS = 60
+
+    def __init__(self, session):
+        super().__init__(session)
+        self.peers = {False: [], True: []}
+        self.proxy = None
+
+    async def _refresh(self):
+        result = await self._request('peers')
+        self.peers = {False: result['peers'], True: result['tor_peers']}
+        proxy = result['proxy']
+        self.proxy = NetAddress.from_string(proxy) if proxy else None
+
+    async def discover_peers(self):
+        while True:
+            await self._refresh()
+            await sleep(self.REFRESH_SECS)
+
+    async def on_add_peer(self, features, source_addr):
+        source = str(source_addr) if source_addr else None
+        return await self._request('add_peer', features, source)
+
+    def on_peers_subscribe(self, is_tor):
+        return self.peers[is_tor]
+
+    def proxy_address(self):
+        return self.proxy
+
+
+class IndexerState:
+    '''Stands in for the block processor in a query worker.'''
+
+    def __init__(self, db):
+        self.db = db
+        self.backed_up_event = asyncio.Event()
+
+    @property
+    def tip(self):
+        return self.db.db_tip
+
+    def force_chain_reorg(self, count):
+        # Only the indexer can do this
+        return False
+
+
+class WorkerNotifications:
+    '''Passes the indexer's notifications on to the session manager, having
+    first caught the DB up with the flushes they follow.'''
+
+    def __init__(self, db, state):
+        self.db = db
+        self.state = state
+        self.notify = None
+
+    async def start(self, height, notify_func):
+        self.notify = notify_func
+        await notify_func(height, set())
+
+    async def on_indexer(self, height, touched):
+        if await self.db.catch_up():
+            self.state.backed_up_event.set()
+            self.state.backed_up_event.clear()
+        if self.notify:
+            await self.notify(height, touched)
+
+
+class QueryWorker(ServerBase):
+    '''A process serving client sessions for the indexer process.'''
+
+    async def serve(self, shutdown_event):
+        env = self.env
+        # The indexer serves the admin RPC
+        env.services = [service for service in env.services if service.protocol != 'rpc']
+        self.logger.info(f'query worker {env.query_worker_id}')
+
+        Daemon = env.coin.DAEMON
+        async with Daemon(env.coin, env.daemon_url) as daemon:
+            db = DB(env)
+            await db.open_for_reading()
+            async with connect_us(INDEXER_SOCKET, session_factory=WorkerSession) as session:
+                state = IndexerState(db)
+                notifications = WorkerNotifications(db, state)
+                session.notifications = notifications
+                session_mgr = SessionManager(
+                    env=env,
+                    db=db,
+                    block_processor=state,
+                    daemon=daemon,
+                    mempool=MemPoolClient(session),
+                    shutdown_event=shutdown_event,
+                    peer_mgr=PeerManagerClient(session),
+                )
+                await db.populate_header_merkle_cache()
+                # The indexer only starts us once its mempool is synchronized
+                synchronized_event = Event()
+                synchronized_event.set()
+                # Without the indexer there is nothing to serve
+                async with OldTaskGroup(wait=any) as group:
+                    await group.spawn(session_mgr.serve(notifications, synchronized_event))
+                    await group.spawn(session.lost_event.wait())
+                self.logger.info('lost the indexer; shutting down')
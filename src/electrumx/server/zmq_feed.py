@@ -0,0 +1,118 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Following the daemon through its ZMQ notifications.'''
+
+from struct import unpack_from
+
+from electrumx.lib.util import class_logger
+
+
+class ZMQSubscriber:
+    '''Receives the messages a daemon publishes on a ZMQ topic.
+
+    Each message of bitcoind has three parts: the topic, the body, and
+    a 4-byte little-endian count of the messages of the topic, from
+    which missed messages are detected.
+    '''
+
+    def __init__(self, url, topic):
+        import zmq
+        import zmq.asyncio
+
+        self.url = url
+        self.socket = zmq.asyncio.Context.instance().socket(zmq.SUB)
+        # Never drop messages; the daemon's messages are small
+        self.socket.setsockopt(zmq.RCVHWM, 0)
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.socket.connect(url)
+        self.count = None
+
+    async def receive(self, timeout=None):
+        '''Return a (body, missed) pair for the next message, or None if
+        none arrives within timeout seconds.  missed is True if messages
+        were missed since the previous one.'''
+        if timeout is not None:
+            if not await self.socket.poll(timeout * 1000):
+                return None
+        _topic, body, count = await self.socket.recv_multipart()
+        count, = unpack_from('<I', count)
+        missed = self.count is not None and count != (self.count + 1) & 0xffffffff
+        self.count = count
+        return body, missed
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+class MempoolFeed:
+    '''Follows the daemon's mempool through its ZMQ "sequence"
+    notifications, so that only its changes need be fetched.
+
+    A body is a 32-byte hash in display order and a label: "A" and "R"
+    for a transaction added to and removed from the mempool, followed
+    by the mempool's 8-byte sequence number, and "C" and "D" for a
+    block connected and disconnected.  The transactions of a connected
+    block are removed without notifications, and any gap in the
+    sequence numbers means changes were missed; either needs a resync.
+
+    The sequence number getrawmempool returns is that of the next
+    change, so changes with lower numbers predate the resync.
+
+        url - the daemon's zmqpubsequence endpoint
+        mempool_sequence - async function returning the hex hashes of
+        the daemon's mempool and its sequence number
+    '''
+
+    def __init__(self, url, mempool_sequence):
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.subscriber = ZMQSubscriber(url, b'sequence')
+        self.mempool_sequence = mempool_sequence
+        # The sequence number of the next change
+        self.sequence = None
+
+    async def resync(self):
+        '''Return the hex hashes of the daemon's mempool.  Later changes
+        are relative to it.'''
+        hex_hashes, self.sequence = await self.mempool_sequence()
+        return hex_hashes
+
+    async def changes(self):
+        '''Wait for the mempool to change, and return an (added, removed)
+        pair of sets of tx hashes, or None if a resync is needed.
+
+        Changes already received are returned together.'''
+        added = set()
+        removed = set()
+        message = await self.subscriber.receive()
+        while message:
+            body, missed = message
+            if missed:
+                self.logger.info('ZMQ messages missed; resyncing')
+                return None
+            label = body[32:33]
+            if label not in (b'A', b'R'):
+                # A block was connected or disconnected
+                return None
+            sequence, = unpack_from('<Q', body, 33)
+            if sequence >= self.sequence:
+                if sequence != self.sequence:
+                    return None
+                self.sequence = sequence + 1
+                tx_hash = body[31::-1]
+                if label == b'A':
+                    added.add(tx_hash)
+                    removed.discard(tx_hash)
+                else:
+                    added.discard(tx_hash)
+                    removed.add(tx_hash)
+            # Otherwise the change predates the last resync
+            message = await self.subscriber.receive(timeout=0)
+        return added, removed
+
+    def close(self):
+        self.subscriber.close()
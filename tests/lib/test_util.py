@@ -111,6 +111,27 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+    # Batched reads, including across a file boundary and past the end
+    assert L.read_records([0, 3, 5, 16, 18], 2) == [b'95', b'95', b'79', b'57', b'']
+
+
+def test_LogicalFile_checkpoint(tmpdir):
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    try:
+        L = util.LogicalFile('log', 2, 6)
+        L.write(0, b'0123456789abcdefghij')
+        os.mkdir('ckpt')
+        L.checkpoint('ckpt', 15, fixed_size=7)
+        # Files before the fixed size are linked, the rest truncated copies
+        assert os.path.samefile('log00', 'ckpt/log00')
+        assert not os.path.samefile('log01', 'ckpt/log01')
+        assert sorted(os.listdir('ckpt')) == ['log00', 'log01', 'log02']
+        assert util.LogicalFile('ckpt/log', 2, 6).read(0) == b'0123456789abcde'
+    finally:
+        os.chdir(cwd)
+
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -0,0 +1,167 @@
+'''Tests of server/block_processor.py'''
+import asyncio
+import json
+import os
+from os import environ
+from struct import pack
+
+import pytest
+from aiorpcx import ignore_after
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.script import is_unspendable_legacy
+from electrumx.lib.util import pack_le_uint32, pack_le_uint64
+from electrumx.lib.coins import BitcoinSV
+from electrumx.server.block_processor import BlockProcessor, Prefetcher, prepare_blocks
+from electrumx.server.db import DB
+from electrumx.server.env import Env
+from electrumx.server.history import TXNUM_LEN
+
+BLOCK_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'blocks',
+                          'bitcoinsv_mainnet_100000.json')
+
+
+def read_block():
+    with open(BLOCK_FILE) as f:
+        info = json.load(f)
+    return bytes.fromhex(info['block']), info['height']
+
+
+def make_env(tmpdir, **kwargs):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(tmpdir)
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    environ.update(kwargs)
+    return Env()
+
+
+def close_db(db):
+    # LevelDB locks are per-process and keyed by the relative DB path
+    db.read_view = None
+    db.utxo_db.close()
+    db.history.close_db()
+
+
+def spent_utxos(block):
+    '''Return UTXO cache entries for the outputs spent by a block.'''
+    utxos = {}
+    for n, tx in enumerate(block.transactions):
+        for txin in tx.inputs:
+            if not txin.is_generation():
+                utxos[txin.prev_hash + pack_le_uint32(txin.prev_idx)] = (
+                    bytes([n]) * HASHX_LEN + pack_le_uint64(n)[:TXNUM_LEN]
+                    + pack_le_uint64(n * 1000))
+    return utxos
+
+
+def indexed_state(bp):
+    return (bp.utxo_cache, dict(bp.db.history.unflushed), bp.touched, bp.tx_hashes,
+            bp.tx_count, bp.db.tx_counts)
+
+
+@pytest.mark.asyncio
+async def test_advance_prepared_txs(tmpdir):
+    raw_block, height = read_block()
+    env = make_env(tmpdir)
+    coin = env.coin
+    block = coin.block(raw_block, height)
+
+    results = []
+    for prepared in (False, True):
+        db = DB(env)
+        await db.open_for_serving()
+        bp = BlockProcessor(env, db, None, None)
+        bp.utxo_cache.update(spent_utxos(block))
+        if prepared:
+            prepared_block, = prepare_blocks(coin, [raw_block], height)
+            undo_info = bp.advance_prepared_txs(prepared_block.transactions)
+        else:
+            undo_info = bp.advance_txs(block.transactions, is_unspendable_legacy)
+        results.append((undo_info, indexed_state(bp)))
+        close_db(db)
+
+    assert results[0] == results[1]
+    assert results[0][1][0]
+
+
+@pytest.mark.asyncio
+async def test_prepare_in_processes(tmpdir):
+    raw_block, height = read_block()
+    env = make_env(tmpdir, SYNC_PROCESSES='2')
+    bp = BlockProcessor(env, DB(env), None, None)
+    bp._start_sync_processes()
+    try:
+        # Each process takes a run of heights; they need not connect
+        raw_blocks = [raw_block] * 3
+        blocks = await bp.prepare_in_processes(raw_blocks, height)
+    finally:
+        bp._stop_sync_processes()
+    assert bp.sync_executor is None
+
+    expected = prepare_blocks(env.coin, raw_blocks, height)
+    assert [block.raw for block in blocks] == raw_blocks
+    assert ([(block.header, block.transactions) for block in blocks]
+            == [(block.header, block.transactions) for block in expected])
+
+
+def test_block_spends():
+    raw_block, height = read_block()
+    coin = BitcoinSV
+    block = coin.block(raw_block, height)
+    tx_hashes, spends = BlockProcessor.block_spends([block])
+    assert tx_hashes == {tx.txid for tx in block.transactions}
+    # The coinbase spends nothing
+    assert spends == {(txin.prev_hash, txin.prev_idx)
+                      for tx in block.transactions[1:] for txin in tx.inputs}
+    assert BlockProcessor.block_spends(prepare_blocks(coin, [raw_block], height)) == (
+        tx_hashes, spends)
+
+
+class BlocksDaemon:
+    '''Serves raw blocks by height.'''
+
+    def __init__(self, height):
+        self._height = height
+
+    async def height(self):
+        return self._height
+
+    async def block_hex_hashes(self, first, count):
+        return [f'{height:064x}' for height in range(first, first + count)]
+
+    async def raw_blocks(self, hex_hashes):
+        return [bytes.fromhex(hex_hash) for hex_hash in hex_hashes]
+
+
+@pytest.mark.asyncio
+async def test_block_announcements():
+    zmq = pytest.importorskip('zmq')
+    import zmq.asyncio
+
+    publisher = zmq.asyncio.Context.instance().socket(zmq.XPUB)
+    port = publisher.bind_to_random_port('tcp://127.0.0.1')
+    daemon = BlocksDaemon(100)
+    blocks_event = asyncio.Event()
+    # Without an announcement nothing is fetched for a minute
+    prefetcher = Prefetcher(daemon, BitcoinSV, blocks_event, polling_delay_secs=60)
+    tasks = [asyncio.create_task(prefetcher.main_loop(100)),
+             asyncio.create_task(prefetcher.follow_block_announcements(
+                 f'tcp://127.0.0.1:{port}'))]
+    try:
+        # The subscription
+        await publisher.recv()
+        async with ignore_after(0.1):
+            await blocks_event.wait()
+        assert prefetcher.caught_up and not blocks_event.is_set()
+
+        daemon._height = 101
+        await publisher.send_multipart([b'hashblock', bytes(32), pack('<I', 0)])
+        async with ignore_after(5):
+            await blocks_event.wait()
+        assert prefetcher.get_prefetched_blocks() == [bytes.fromhex(f'{101:064x}')]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        publisher.close(linger=0)
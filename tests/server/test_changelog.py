@@ -0,0 +1,307 @@
+'''Tests of server/changelog.py and server/follower.py'''
+import ast
+import asyncio
+import os
+import random
+from os import environ, urandom
+
+import pytest
+
+from electrumx.lib.hash import HASHX_LEN, double_sha256
+from electrumx.lib.util import pack_le_uint32, pack_le_uint64
+from electrumx.server.changelog import (ChangeLog, ChangeLogError, ChangeLogReader,
+                                        RECORD_HEADER, read_headers, unpack_record)
+from electrumx.server.db import DB, FlushData, COMP_TXID_LEN
+from electrumx.server.env import Env
+from electrumx.server.follower import Follower
+from electrumx.server.history import TXNUM_LEN
+
+
+def make_env(db_dir):
+    environ.clear()
+    environ['DB_DIRECTORY'] = db_dir
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    return Env()
+
+
+def close_db(db):
+    # LevelDB locks are per-process and keyed by the relative DB path
+    db.read_view = None
+    db.utxo_db.close()
+    db.history.close_db()
+
+
+class Chain:
+    '''Plays the block processor: makes random blocks and flushes them.'''
+
+    def __init__(self, db):
+        self.db = db
+        self.hashXs = [urandom(HASHX_LEN) for n in range(20)]
+        self.height = db.db_height
+        self.tx_count = db.db_tx_count
+        self.tip = db.db_tip
+        self.tips = []
+        self.headers = []
+        self.tx_hashes = []
+        self.undo_infos = []
+        self.adds = {}
+        self.deletes = []
+        self.balance_spends = {}
+        # The UTXOs created by each block, by height
+        self.block_utxos = {}
+
+    def flush_data(self):
+        return FlushData(self.height, self.tx_count, self.headers, self.tx_hashes,
+                         self.undo_infos, self.adds, self.deletes, self.balance_spends,
+                         self.tip)
+
+    def advance(self, count):
+        for _ in range(count):
+            self.height += 1
+            tx_hashes = [urandom(32) for n in range(random.randrange(1, 5))]
+            hashXs_by_tx = []
+            utxos = self.block_utxos[self.height] = {}
+            for tx_num, tx_hash in enumerate(tx_hashes, start=self.tx_count):
+                hashXs = random.sample(self.hashXs, 2)
+                hashXs_by_tx.append(hashXs)
+                for idx, hashX in enumerate(hashXs):
+                    value = (hashX + pack_le_uint64(tx_num)[:TXNUM_LEN]
+                             + pack_le_uint64(random.randrange(1, 10**8)))
+                    utxos[tx_hash + pack_le_uint32(idx)] = value
+            self.adds.update(utxos)
+            self.db.history.add_unflushed(hashXs_by_tx, self.tx_count)
+            self.tx_count += len(tx_hashes)
+            self.db.tx_counts.append(self.tx_count)
+            self.tx_hashes.append(b''.join(tx_hashes))
+            header = urandom(80)
+            self.headers.append(header)
+            self.undo_infos.append(([urandom(20)], self.height))
+            self.tips.append(self.tip)
+            self.tip = double_sha256(header)
+
+    def flush(self, flush_utxos):
+        self.db.flush_dbs(self.flush_data(), flush_utxos, lambda: 0)
+
+    def backup(self):
+        '''Back up a block, spending the UTXOs it created.'''
+        touched = set()
+        for key, value in self.block_utxos.pop(self.height).items():
+            hashX = value[:HASHX_LEN]
+            suffix = key[-4:] + value[HASHX_LEN:HASHX_LEN + TXNUM_LEN]
+            self.deletes += [b'h' + key[:COMP_TXID_LEN] + suffix, b'u' + hashX + suffix]
+            spent = self.balance_spends.setdefault(hashX, [0, 0])
+            spent[0] += int.from_bytes(value[-8:], 'little')
+            spent[1] += 1
+            touched.add(hashX)
+        self.height -= 1
+        self.db.tx_counts.pop()
+        self.tx_count = self.db.tx_counts[-1]
+        self.tip = self.tips.pop()
+        self.db.flush_backup(self.flush_data(), touched)
+
+
+def dump(db):
+    '''Return the contents of the databases, less their wall times.'''
+    utxos = dict(db.utxo_db.iterator(prefix=b''))
+    del utxos[b'state']
+    history = dict(db.history.db.iterator(prefix=b''))
+    del history[b'state\0\0']
+    files = (db.headers_file.read(0, 80 * (db.db_height + 1)),
+             db.tx_counts_file.read(0, 8 * (db.db_height + 1)),
+             db.hashes_file.read(0, 32 * db.db_tx_count))
+    return utxos, history, files, db.db_height, db.db_tip, db.history.flush_count
+
+
+async def run_primary(tmpdir, log_dir):
+    db_dir = os.path.join(tmpdir, 'primary')
+    os.mkdir(db_dir)
+    db = DB(make_env(db_dir))
+    db.change_log = ChangeLog(log_dir)
+    await db.open_for_serving()
+    chain = Chain(db)
+    chain.advance(3)
+    chain.flush(True)
+    # A history-only flush is logged with the next UTXO flush
+    chain.advance(2)
+    chain.flush(False)
+    chain.advance(1)
+    chain.flush(True)
+    chain.backup()
+    chain.advance(2)
+    chain.flush(True)
+    result = dump(db)
+    db.change_log.close()
+    close_db(db)
+    return result
+
+
+class Notifications:
+
+    def __init__(self):
+        self.blocks = []
+
+    async def on_block(self, touched, height):
+        self.blocks.append((height, touched))
+
+
+@pytest.mark.asyncio
+async def test_follower(tmpdir):
+    tmpdir = str(tmpdir)
+    log_dir = os.path.join(tmpdir, 'changelog')
+    expected = await run_primary(tmpdir, log_dir)
+
+    # One record per UTXO flush or backup
+    reader = ChangeLogReader(log_dir)
+    assert reader.locate(-1, bytes(32))
+    records = [reader.read() for n in range(5)]
+    assert records[-1] is None
+    assert [len(record.steps) for record in records[:4]] == [1, 2, 1, 1]
+
+    db_dir = os.path.join(tmpdir, 'follower')
+    os.mkdir(db_dir)
+    make_env(db_dir)
+    environ['FOLLOW'] = log_dir
+    env = Env()
+    db = DB(env)
+    notifications = Notifications()
+    follower = Follower(env, db, None, notifications)
+    caught_up_event = asyncio.Event()
+    task = asyncio.ensure_future(follower.fetch_and_process_blocks(caught_up_event))
+    await asyncio.wait_for(caught_up_event.wait(), 10)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    assert dump(db) == expected
+    assert [height for height, touched in notifications.blocks] == [2, 5, 4, 6]
+    assert all(notifications.blocks)
+    # Catching up ends the first sync
+    assert not db.first_sync
+    assert not ast.literal_eval(db.utxo_db.get(b'state').decode())['first_sync']
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_log_behind_db(tmpdir):
+    tmpdir = str(tmpdir)
+    log_dir = os.path.join(tmpdir, 'changelog')
+    db_dir = os.path.join(tmpdir, 'primary')
+    os.mkdir(db_dir)
+    env = make_env(db_dir)
+    db = DB(env)
+    db.change_log = ChangeLog(log_dir)
+    await db.open_for_serving()
+    chain = Chain(db)
+    chain.advance(2)
+    chain.flush(True)
+    db.change_log.close()
+    close_db(db)
+
+    # Restarting starts a new segment after the last record
+    db = DB(env)
+    db.change_log = ChangeLog(log_dir)
+    await db.open_for_serving()
+    assert len(os.listdir(log_dir)) == 2
+    # A crash between committing a flush and logging it
+    db.change_log.close()
+    db.change_log = None
+    chain = Chain(db)
+    chain.advance(1)
+    chain.flush(True)
+    close_db(db)
+
+    db = DB(env)
+    db.change_log = ChangeLog(log_dir)
+    with pytest.raises(ChangeLogError, match='stops at height 1 '):
+        await db.open_for_serving()
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_torn_record(tmpdir):
+    tmpdir = str(tmpdir)
+    log_dir = os.path.join(tmpdir, 'changelog')
+    await run_primary(tmpdir, log_dir)
+    (path, ) = [os.path.join(log_dir, name) for name in os.listdir(log_dir)]
+
+    reader = ChangeLogReader(log_dir)
+    assert reader.locate(-1, bytes(32))
+    first = reader.read()
+    # A partial record is not read until complete, unless the writer has
+    # moved to a new segment
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:reader.offset + 10])
+    assert reader.read() is None
+    with open(os.path.join(log_dir, '00000001.log'), 'wb') as f:
+        f.write(data[reader.offset:size])
+    assert reader.read().prev_height == first.height
+
+
+@pytest.mark.asyncio
+async def test_truncated_record(tmpdir):
+    tmpdir = str(tmpdir)
+    log_dir = os.path.join(tmpdir, 'changelog')
+    await run_primary(tmpdir, log_dir)
+    (path, ) = [os.path.join(log_dir, name) for name in os.listdir(log_dir)]
+
+    offset, header = read_headers(path)[1]
+    with open(path, 'rb') as f:
+        f.seek(offset + RECORD_HEADER.size)
+        payload = f.read(RECORD_HEADER.unpack(header)[0])
+    assert len(unpack_record(header, payload).steps) == 2
+    # Every field, including a varint, checks the payload holds it
+    for length in range(len(payload)):
+        with pytest.raises(ChangeLogError, match='truncated'):
+            unpack_record(header, payload[:length])
+
+
+@pytest.mark.asyncio
+async def test_follow_checkpoint(tmpdir):
+    tmpdir = str(tmpdir)
+    log_dir = os.path.join(tmpdir, 'changelog')
+    ckpt_dir = os.path.join(tmpdir, 'follower')
+    db_dir = os.path.join(tmpdir, 'primary')
+    os.mkdir(db_dir)
+    db = DB(make_env(db_dir))
+    db.change_log = ChangeLog(log_dir)
+    await db.open_for_serving()
+    chain = Chain(db)
+    chain.advance(3)
+    chain.flush(True)
+    at_checkpoint = dump(db)
+    # Blocks flushed only to history are not in the checkpoint
+    chain.advance(2)
+    chain.flush(False)
+    assert db.checkpoint(ckpt_dir) == 2
+    chain.advance(2)
+    chain.flush(True)
+    expected = dump(db)
+    db.change_log.close()
+    close_db(db)
+
+    make_env(ckpt_dir)
+    environ['FOLLOW'] = log_dir
+    env = Env()
+    db = DB(env)
+    await db.open_for_serving()
+    assert dump(db) == at_checkpoint
+    close_db(db)
+
+    db = DB(env)
+    follower = Follower(env, db, None, Notifications())
+    caught_up_event = asyncio.Event()
+    task = asyncio.ensure_future(follower.fetch_and_process_blocks(caught_up_event))
+    await asyncio.wait_for(caught_up_event.wait(), 10)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    assert dump(db) == expected
+    close_db(db)
@@ -4,6 +4,7 @@ import random
 from os import environ, urandom
 
 import pytest
+import pytest_asyncio
 
 from electrumx.lib.hash import HASHX_LEN
 from electrumx.lib.util import pack_be_uint16, pack_le_uint64
@@ -97,6 +98,9 @@ def check_written(history, histories):
     for hashX, hist in histories.items():
         db_hist = array.array('I', history.get_txnums(hashX, limit=None))
         assert hist == db_hist
+        # Reverse reads yield the newest entries first
+        db_hist = array.array('I', history.get_txnums(hashX, limit=3, reverse=True))
+        assert hist[::-1][:3] == db_hist
 
 
 def compact_history(history):
@@ -112,8 +116,8 @@ def compact_history(history):
     assert write_size != 0
 
 
-@pytest.mark.asyncio
-async def test_compaction(tmpdir):
+@pytest_asyncio.fixture
+async def db(tmpdir):
     db_dir = str(tmpdir)
     print(f'Temp dir: {db_dir}')
     environ.clear()
@@ -122,6 +126,15 @@ async def test_compaction(tmpdir):
     environ['COIN'] = 'BitcoinSV'
     db = DB(Env())
     await db.open_for_serving()
+    yield db
+    # LevelDB locks are per-process and keyed by the relative DB path
+    db.read_view = None
+    db.utxo_db.close()
+    db.history.close_db()
+
+
+@pytest.mark.asyncio
+async def test_compaction(db):
     history = db.history
 
     # Test abstract compaction
@@ -277,6 +277,14 @@ async def test_mempool_hashes(daemon):
     assert await daemon.mempool_hashes() == hashes
 
 
+@pytest.mark.asyncio
+async def test_mempool_sequence(daemon):
+    hashes = ['hex_hash1', 'hex_hash2']
+    result = {'txids': hashes, 'mempool_sequence': 7}
+    daemon.session = ClientSessionGood(('getrawmempool', [False, True], result))
+    assert await daemon.mempool_sequence() == (hashes, 7)
+
+
 @pytest.mark.asyncio
 async def test_deserialised_block(daemon):
     block_hash = 'block_hash'
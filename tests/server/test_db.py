@@ -0,0 +1,250 @@
+'''Tests of the UTXO tables in server/db.py'''
+import random
+from array import array
+from os import environ, urandom
+
+import pytest
+from aiorpcx import run_in_thread
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_le_uint32, pack_le_uint64
+from electrumx.server.db import DB, FlushData, COMP_TXID_LEN
+from electrumx.server.env import Env
+from electrumx.server.history import TXNUM_LEN
+from tests.server.test_changelog import Chain
+
+
+async def open_db(tmpdir, **env):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(tmpdir)
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    environ.update(env)
+    db = DB(Env())
+    await db.open_for_serving()
+    return db
+
+
+def close_db(db):
+    # LevelDB locks are per-process and keyed by the relative DB path
+    db.read_view = None
+    db.utxo_db.close()
+    db.history.close_db()
+
+
+def flush_utxos(db, adds, deletes=(), balance_spends=None):
+    flush_data = FlushData(db.db_height, db.db_tx_count, [], [], [],
+                           dict(adds), list(deletes),
+                           balance_spends or {}, db.db_tip)
+    with db.utxo_db.write_batch() as batch:
+        db.flush_utxo_db(batch, flush_data)
+    db.refresh_read_view()
+
+
+def random_utxos(hashXs, count):
+    '''Return a map of UTXO cache entries paying randomly to hashXs.'''
+    adds = {}
+    for tx_num in range(count):
+        key = urandom(32) + pack_le_uint32(random.randrange(4))
+        value = random.randrange(1, 10**10)
+        adds[key] = (random.choice(hashXs) + pack_le_uint64(tx_num)[:TXNUM_LEN]
+                     + pack_le_uint64(value))
+    return adds
+
+
+def spend(adds, key):
+    '''Return the (h key, u key) pair and hashX and value of a flushed UTXO.'''
+    value = adds.pop(key)
+    hashX = value[:HASHX_LEN]
+    suffix = key[-4:] + value[HASHX_LEN:HASHX_LEN + TXNUM_LEN]
+    return ([b'h' + key[:COMP_TXID_LEN] + suffix, b'u' + hashX + suffix],
+            hashX, int.from_bytes(value[-8:], 'little'))
+
+
+def balances(adds):
+    result = {}
+    for value in adds.values():
+        hashX = value[:HASHX_LEN]
+        sats, count = result.get(hashX, (0, 0))
+        result[hashX] = (sats + int.from_bytes(value[-8:], 'little'), count + 1)
+    return result
+
+
+@pytest.mark.asyncio
+async def test_balance_table(tmpdir):
+    db = await open_db(tmpdir)
+    hashXs = [urandom(HASHX_LEN) for n in range(10)]
+    adds = random_utxos(hashXs, 200)
+    flush_utxos(db, adds)
+
+    expected = balances(adds)
+    for hashX in hashXs:
+        assert await db.get_balance(hashX) == expected.get(hashX, (0, 0))
+
+    # Spend half the UTXOs, and add some new ones, in one flush
+    deletes = []
+    balance_spends = {}
+    for key in random.sample(sorted(adds), len(adds) // 2):
+        keys, hashX, value = spend(adds, key)
+        deletes.extend(keys)
+        spent = balance_spends.setdefault(hashX, [0, 0])
+        spent[0] += value
+        spent[1] += 1
+    new_adds = random_utxos(hashXs, 50)
+    flush_utxos(db, new_adds, deletes, balance_spends)
+    adds.update(new_adds)
+
+    expected = balances(adds)
+    for hashX in hashXs:
+        assert await db.get_balance(hashX) == expected.get(hashX, (0, 0))
+
+    # Spending everything removes the rows
+    deletes = []
+    balance_spends = {}
+    for key in list(adds):
+        keys, hashX, value = spend(adds, key)
+        deletes.extend(keys)
+        spent = balance_spends.setdefault(hashX, [0, 0])
+        spent[0] += value
+        spent[1] += 1
+    flush_utxos(db, {}, deletes, balance_spends)
+    for hashX in hashXs:
+        assert await db.get_balance(hashX) == (0, 0)
+    assert not list(db.utxo_db.iterator(prefix=b'b'))
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_build_balance_table(tmpdir):
+    db = await open_db(tmpdir)
+    hashXs = [urandom(HASHX_LEN) for n in range(10)]
+    adds = random_utxos(hashXs, 100)
+    flush_utxos(db, adds)
+    expected = {hashX: await db.get_balance(hashX) for hashX in hashXs}
+
+    # Rebuilding from the UTXO table gives the same rows
+    with db.utxo_db.write_batch() as batch:
+        for key, _value in db.utxo_db.iterator(prefix=b'b'):
+            batch.delete(key)
+    db.build_balance_table()
+    db.refresh_read_view()
+    for hashX in hashXs:
+        assert await db.get_balance(hashX) == expected[hashX]
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_raw_and_resolved_utxos(tmpdir):
+    db = await open_db(tmpdir)
+    hashXs = [urandom(HASHX_LEN) for n in range(5)]
+    adds = random_utxos(hashXs, 100)
+    flush_utxos(db, adds)
+
+    # Put 100 tx hashes on disk, 10 per block
+    tx_hashes = [urandom(32) for n in range(100)]
+    db.hashes_file.write(0, b''.join(tx_hashes))
+    db.tx_counts = array('Q', range(10, 101, 10))
+    db.db_height = 9
+    db.refresh_read_view()
+
+    for hashX in hashXs:
+        entries = sorted((int.from_bytes(value[HASHX_LEN:-8], 'little'),
+                          int.from_bytes(key[-4:], 'little'),
+                          int.from_bytes(value[-8:], 'little'))
+                         for key, value in adds.items() if value.startswith(hashX))
+        tx_nums, tx_positions, values = await db.raw_utxos(hashX)
+        assert list(zip(tx_nums, tx_positions, values)) == entries
+
+        utxos = await db.all_utxos(hashX)
+        assert [(utxo.tx_num, utxo.tx_pos, utxo.value) for utxo in utxos] == entries
+        for utxo in utxos:
+            assert utxo.tx_hash == tx_hashes[utxo.tx_num]
+            assert utxo.height == utxo.tx_num // 10
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_utxo_order(tmpdir):
+    db = await open_db(tmpdir)
+    hashX = urandom(HASHX_LEN)
+    # UTXO keys hold txout_idx little-endian, so 256 sorts before 1 on disk
+    entries = [(tx_num, tx_pos, tx_num * 1000 + tx_pos)
+               for tx_num in (3, 7) for tx_pos in (0, 1, 2, 255, 256, 257, 65536)]
+    adds = {}
+    for tx_num, tx_pos, value in entries:
+        tx_hash = tx_num.to_bytes(32, 'little')
+        adds[tx_hash + pack_le_uint32(tx_pos)] = (
+            hashX + pack_le_uint64(tx_num)[:TXNUM_LEN] + pack_le_uint64(value))
+    flush_utxos(db, adds)
+    tx_nums, tx_positions, values = await db.raw_utxos(hashX)
+    assert list(zip(tx_nums, tx_positions, values)) == entries
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_read_view(tmpdir):
+    db = await open_db(tmpdir)
+    hashXs = [urandom(HASHX_LEN) for n in range(3)]
+    adds = random_utxos(hashXs, 30)
+    flush_utxos(db, adds)
+    view = db.read_view
+    before = {hashX: await db.raw_utxos(hashX, view) for hashX in hashXs}
+    balances_before = {hashX: await db.get_balance(hashX) for hashX in hashXs}
+
+    # Spend everything; the old view is unaffected until refreshed
+    deletes = []
+    balance_spends = {}
+    for key in list(adds):
+        keys, hashX, value = spend(adds, key)
+        deletes.extend(keys)
+        spent = balance_spends.setdefault(hashX, [0, 0])
+        spent[0] += value
+        spent[1] += 1
+    with db.utxo_db.write_batch() as batch:
+        db.flush_utxo_db(batch, FlushData(db.db_height, db.db_tx_count, [], [], [],
+                                          {}, deletes, balance_spends, db.db_tip))
+    for hashX in hashXs:
+        assert await db.raw_utxos(hashX, view) == before[hashX]
+        assert await db.get_balance(hashX) == balances_before[hashX]
+
+    db.refresh_read_view()
+    for hashX in hashXs:
+        assert not any(await db.raw_utxos(hashX))
+        assert await db.get_balance(hashX) == (0, 0)
+    close_db(db)
+
+
+@pytest.mark.asyncio
+async def test_read_view_history_flush(tmpdir):
+    """
+    History-only flushes refresh the read view, so LMDB readers keep
+    their own transactions, but its history stops at the UTXO flush.
+    """
+    pytest.importorskip('lmdb')
+    db = await open_db(tmpdir, DB_ENGINE='lmdb')
+    chain = Chain(db)
+    chain.advance(3)
+    chain.flush(True)
+
+    async def histories():
+        return [await db.limited_history(hashX, limit=None) for hashX in chain.hashXs]
+
+    before = await histories()
+    view = db.read_view
+    chain.advance(2)
+    chain.flush(False)
+    assert db.read_view is not view
+    assert await histories() == before
+
+    def own_txns():
+        view = db.read_view
+        return (view.utxo_db._thread_txn() is not None,
+                view.hist_db._thread_txn() is not None)
+    assert await run_in_thread(own_txns) == (True, True)
+
+    chain.advance(1)
+    chain.flush(True)
+    after = await histories()
+    assert sum(map(len, after)) > sum(map(len, before))
+    assert [history[:len(old)] for history, old in zip(after, before)] == before
+    close_db(db)
@@ -276,6 +276,39 @@ def test_REORG_LIMIT():
                    lib_coins.BitcoinSV.REORG_LIMIT)
 
 
+def test_SYNC_PROCESSES():
+    assert_integer('SYNC_PROCESSES', 'sync_processes', 0)
+
+
+def test_MEMPOOL_PROCESSES():
+    assert_integer('MEMPOOL_PROCESSES', 'mempool_processes', 0)
+
+
+def test_MEMPOOL_STATE_FILE():
+    assert_default('MEMPOOL_STATE_FILE', 'mempool_state_file', 'mempool')
+    os.environ['MEMPOOL_STATE_FILE'] = ''
+    e = Env()
+    assert e.mempool_state_file == ''
+
+
+def test_DAEMON_ZMQ_URL():
+    assert_default('DAEMON_ZMQ_URL', 'daemon_zmq_url', None)
+
+
+def test_DAEMON_ZMQ_HASHBLOCK_URL():
+    assert_default('DAEMON_ZMQ_HASHBLOCK_URL', 'daemon_zmq_hashblock_url', None)
+
+
+def test_QUERY_WORKERS():
+    setup_base_env()
+    assert Env().query_workers == 0
+    os.environ['QUERY_WORKERS'] = '4'
+    with pytest.raises(Env.Error):
+        Env()
+    os.environ['DB_ENGINE'] = 'lmdb'
+    assert Env().query_workers == 4
+
+
 def test_COST_HARD_LIMIT():
     assert_integer(
         'COST_HARD_LIMIT',
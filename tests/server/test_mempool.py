@@ -2,6 +2,7 @@ import dataclasses
 import datetime
 import logging
 import os
+from asyncio import Queue
 from collections import defaultdict
 from functools import partial
 from random import randrange, choice, seed
@@ -9,7 +10,7 @@ from random import randrange, choice, seed
 import pytest
 from aiorpcx import Event, sleep, ignore_after
 
-from electrumx.server.mempool import MemPool, MemPoolAPI
+from electrumx.server.mempool import DBSyncError, MemPool, MemPoolAPI, MemPoolTx
 from electrumx.lib.coins import BitcoinCash
 from electrumx.lib.hash import HASHX_LEN, hex_str_to_hash, hash_to_hex_str
 from electrumx.lib.tx import Tx, TxInput, TxOutput
@@ -326,8 +327,20 @@ async def test_compact_fee_histogram():
         await event.wait()
         await group.cancel_remaining()
 
+    def scanned_histogram():
+        histogram = defaultdict(int)
+        for tx in mempool.txs.values():
+            histogram[MemPool._fee_rate(tx.fee, tx.size)] += tx.size
+        return histogram
+
+    # Fresh after the sync, from buckets kept as txs come and go
+    bin_size = coin.MEMPOOL_COMPACT_HISTOGRAM_BINSIZE
+    assert mempool.fee_histogram == scanned_histogram()
     histogram = await mempool.compact_fee_histogram()
-    assert histogram == []
+    assert histogram == MemPool._compress_histogram(scanned_histogram(), bin_size=bin_size)
+    mempool._remove_txs(api.ordered_adds[:10], set())
+    assert mempool.fee_histogram == scanned_histogram()
+
     bin_size = 1000
     mempool._update_histogram(bin_size)
     histogram = await mempool.compact_fee_histogram()
@@ -581,3 +594,367 @@ async def test_dropped_txs(caplog):
             await group.cancel_remaining()
 
     assert in_caplog(caplog, 'txs dropped')
+
+
+def test_accept_transactions_chain():
+    # A chain of unconfirmed txs, given children first, is accepted in
+    # one call; one spending a missing parent is deferred with its
+    # descendants
+    mempool = MemPool(coin, API())
+    hashX = os.urandom(HASHX_LEN)
+    root = (os.urandom(32), 0)
+    utxo_map = {root: (hashX, 1_000_000)}
+    tx_map = {}
+    prevout = root
+    value = 1_000_000
+    for n in range(100):
+        tx_hash = os.urandom(32)
+        value -= 100
+        tx_map[tx_hash] = MemPoolTx(prevouts=(prevout, ), in_pairs=None,
+                                    out_pairs=((hashX, value), ), fee=0, size=200)
+        prevout = (tx_hash, 0)
+    orphans = {}
+    prevout = (os.urandom(32), 0)
+    for n in range(3):
+        tx_hash = os.urandom(32)
+        orphans[tx_hash] = MemPoolTx(prevouts=(prevout, ), in_pairs=None,
+                                     out_pairs=((hashX, 10), ), fee=0, size=200)
+        prevout = (tx_hash, 0)
+    tx_map.update(orphans)
+    tx_map = dict(reversed(tx_map.items()))
+
+    touched = set()
+    deferred, unspent = mempool._accept_transactions(tx_map, utxo_map, touched)
+    assert deferred == orphans
+    assert not unspent
+    assert touched == {hashX}
+    assert len(mempool.txs) == 100
+    assert all(tx.fee == 100 for tx in mempool.txs.values())
+    assert len(mempool.hashXs[hashX]) == 100
+
+
+def test_tx_nums_reused():
+    # The numbers of removed txs are reused, and the postings of the
+    # hashXs they touched forget them
+    mempool = MemPool(coin, API())
+    hashX, other = os.urandom(HASHX_LEN), os.urandom(HASHX_LEN)
+    utxo_map = {}
+    tx_map = {}
+    for n in range(3):
+        prevout = (os.urandom(32), 0)
+        utxo_map[prevout] = (hashX, 1000)
+        tx_map[os.urandom(32)] = MemPoolTx(prevouts=(prevout, ), in_pairs=None,
+                                           out_pairs=((other, 900), ), fee=0, size=200)
+    mempool._accept_transactions(tx_map, utxo_map, set())
+    first, second, third = tx_map
+
+    touched = set()
+    mempool._remove_txs([first, second], touched)
+    assert touched == {hashX, other}
+    assert mempool.hashXs[hashX] == {third}
+
+    child_hash = os.urandom(32)
+    child = MemPoolTx(prevouts=((third, 0), ), in_pairs=None,
+                      out_pairs=((hashX, 800), ), fee=0, size=200)
+    mempool._accept_transactions({child_hash: child}, {}, set())
+    assert len(mempool.tx_hashes) == 3
+    assert mempool.txs[child_hash] == MemPoolTx(
+        prevouts=((third, 0), ), in_pairs=((other, 900), ),
+        out_pairs=((hashX, 800), ), fee=100, size=200)
+    assert mempool.hashXs[other] == {third, child_hash}
+
+    # A tx spending an output its parent does not have is deferred
+    bad_hash = os.urandom(32)
+    bad = MemPoolTx(prevouts=((child_hash, 1), ), in_pairs=None,
+                    out_pairs=((hashX, 10), ), fee=0, size=200)
+    deferred, _unspent = mempool._accept_transactions({bad_hash: bad}, {}, set())
+    assert deferred == {bad_hash: bad}
+
+
+@pytest.mark.asyncio
+async def test_cached_queries():
+    # Cached query results follow the txs added and removed, including
+    # the unconfirmed inputs of children of a removed tx
+    mempool = MemPool(coin, API())
+    hashX, child_hashX = os.urandom(HASHX_LEN), os.urandom(HASHX_LEN)
+    prevout = (os.urandom(32), 0)
+    parent_hash, child_hash = os.urandom(32), os.urandom(32)
+    parent = MemPoolTx(prevouts=(prevout, ), in_pairs=None,
+                       out_pairs=((hashX, 900), ), fee=0, size=200)
+    child = MemPoolTx(prevouts=((parent_hash, 0), ), in_pairs=None,
+                      out_pairs=((child_hashX, 800), ), fee=0, size=200)
+    mempool._accept_transactions({parent_hash: parent, child_hash: child},
+                                 {prevout: (hashX, 1000)}, set())
+
+    assert await mempool.balance_delta(hashX) == -1000 + 900 - 900
+    assert await mempool.balance_delta(child_hashX) == 800
+    summaries = await mempool.transaction_summaries(child_hashX)
+    assert [(s.hash, s.has_unconfirmed_inputs) for s in summaries] == [(child_hash, True)]
+    assert await mempool.potential_spends(child_hashX) == {(parent_hash, 0)}
+    utxos = await mempool.unordered_UTXOs(child_hashX)
+    assert [(utxo.tx_hash, utxo.value) for utxo in utxos] == [(child_hash, 800)]
+
+    touched = set()
+    mempool._remove_txs([parent_hash], touched)
+    assert touched == {hashX}
+    assert await mempool.balance_delta(hashX) == -900
+    summaries = await mempool.transaction_summaries(child_hashX)
+    assert [(s.hash, s.has_unconfirmed_inputs) for s in summaries] == [(child_hash, False)]
+
+    mempool._remove_txs([child_hash], set())
+    assert await mempool.balance_delta(child_hashX) == 0
+    assert await mempool.transaction_summaries(child_hashX) == []
+    assert await mempool.unordered_UTXOs(child_hashX) == []
+    assert not mempool.balances
+    assert not mempool.cached_summaries and not mempool.cached_utxos
+
+
+@pytest.mark.asyncio
+async def test_lookup_utxos():
+    # The DB prevouts of a refresh are looked up once, sorted, and
+    # those found are remembered for txs to be retried
+    api = API()
+    api.initialize()
+    lookups = []
+
+    async def lookup_utxos(prevouts):
+        lookups.append(list(prevouts))
+        return await API.lookup_utxos(api, prevouts)
+
+    api.lookup_utxos = lookup_utxos
+    mempool = MemPool(coin, api)
+    touched = set()
+    txs = api.txs.copy()
+    first_hashes = api.ordered_adds[:-1]
+    last_hash = api.ordered_adds[-1]
+    db_spends = [prevout for prevout in api.mempool_spends() if prevout[0] not in txs]
+
+    api.txs = {hash: txs[hash] for hash in first_hashes}
+    await mempool._process_mempool(set(first_hashes), touched, 0)
+    assert len(lookups) == 1
+    assert lookups[0] == sorted(set(lookups[0]))
+
+    # Only the DB prevouts of the new tx are looked up
+    last_spends = {(txin.prev_hash, txin.prev_idx) for txin in txs[last_hash].inputs
+                   if not txin.is_generation() and txin.prev_hash not in txs}
+    api.txs = txs
+    await mempool._process_mempool(set(txs), touched, 0)
+    assert set(lookups[1]) == last_spends
+    assert set(mempool.txs) == set(txs)
+
+    assert sorted(lookups[0] + lookups[1]) == sorted(db_spends)
+    assert not mempool.prevout_cache
+
+    # A refresh failing for a DB flush during its lookup is retried
+    # without looking up the same prevouts
+    async def lookup_and_flush(prevouts):
+        api._db_height += 1
+        return await lookup_utxos(prevouts)
+
+    # The first tx spends DB prevouts; its descendants go with it
+    evicted = {api.ordered_adds[0]}
+    for hash in api.ordered_adds:
+        if any(txin.prev_hash in evicted for txin in txs[hash].inputs):
+            evicted.add(hash)
+    api.txs = {hash: tx for hash, tx in txs.items() if hash not in evicted}
+    await mempool._process_mempool(set(api.txs), touched, 0)
+    api.txs = txs
+    api.lookup_utxos = lookup_and_flush
+    with pytest.raises(DBSyncError):
+        await mempool._process_mempool(set(txs), touched, 0)
+    assert lookups[-1]
+    api.lookup_utxos = lookup_utxos
+    await mempool._process_mempool(set(txs), touched, 1)
+    assert set(mempool.txs) == set(txs)
+    assert lookups[-1] == []
+
+
+@pytest.mark.asyncio
+async def test_processes():
+    api = API()
+    api.initialize()
+    mempool = MemPool(coin, api, processes=2)
+    event = Event()
+    async with OldTaskGroup() as group:
+        await group.spawn(mempool.keep_synchronized, event)
+        await event.wait()
+        await _test_summaries(mempool, api)
+        # The processes are stopped once synchronized
+        await sleep(0)
+        assert mempool.executor is None
+        await group.cancel_remaining()
+
+
+@pytest.mark.asyncio
+async def test_saved_state(tmp_path, caplog):
+    api = API()
+    api.initialize()
+    api._height = api._db_height = 5
+    state_file = str(tmp_path / 'mempool')
+
+    async def sync(mempool):
+        event = Event()
+        async with OldTaskGroup() as group:
+            await group.spawn(mempool.keep_synchronized, event)
+            await event.wait()
+            await group.cancel_remaining()
+
+    n = len(api.ordered_adds) // 2
+    raw_txs = api.raw_txs.copy()
+    txs = api.txs.copy()
+    first_hashes = api.ordered_adds[:n]
+    second_hashes = api.ordered_adds[n:]
+    api.raw_txs = {hash: raw_txs[hash] for hash in first_hashes}
+    api.txs = {hash: txs[hash] for hash in first_hashes}
+    await sync(MemPool(coin, api, state_file=state_file))
+
+    # On restart a saved tx has gone, and the second batch arrived
+    api.raw_txs = raw_txs
+    api.txs = txs
+    spent = {prev_hash for prev_hash, _ in api.mempool_spends()}
+    evicted = next(hash for hash in first_hashes if hash not in spent)
+    api.txs = {hash: tx for hash, tx in txs.items() if hash != evicted}
+    fetched = []
+
+    async def raw_transactions(hex_hashes):
+        hex_hashes = list(hex_hashes)
+        fetched.extend(hex_str_to_hash(hex_hash) for hex_hash in hex_hashes)
+        return await API.raw_transactions(api, hex_hashes)
+
+    api.raw_transactions = raw_transactions
+    mempool = MemPool(coin, api, state_file=state_file)
+    with caplog.at_level(logging.INFO):
+        await sync(mempool)
+    assert in_caplog(caplog, f'loaded {len(first_hashes)} txs saved at height 5')
+    assert sorted(fetched) == sorted(second_hashes)
+    assert set(mempool.txs) == set(api.txs)
+    assert api.on_mempool_calls[-1][0] >= api.touched(api.txs)
+    await _test_summaries(mempool, api)
+
+    # Saved ahead of the DB, or corrupted, the state is ignored
+    api._db_height = 4
+    mempool = MemPool(coin, api, state_file=state_file)
+    mempool._load_state(set())
+    assert not mempool.txs
+    api._db_height = 5
+    with open(state_file, 'r+b') as f:
+        f.truncate(100)
+    mempool._load_state(set())
+    assert not mempool.txs
+    assert in_caplog(caplog, 'ignoring the saved mempool')
+
+
+class Feed:
+    '''Stands in for a MempoolFeed, serving the changes put in it.'''
+
+    def __init__(self, api):
+        self.api = api
+        self.queue = Queue()
+        self.resyncs = 0
+        self.closed = False
+
+    async def resync(self):
+        self.resyncs += 1
+        return await self.api.mempool_hashes()
+
+    async def changes(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_follow_feed():
+    api = API()
+    api.initialize()
+    feed = Feed(api)
+    mempool = MemPool(coin, api, feed=feed)
+    event = Event()
+
+    n = len(api.ordered_adds) // 2
+    raw_txs = api.raw_txs.copy()
+    txs = api.txs.copy()
+    first_hashes = api.ordered_adds[:n]
+    second_hashes = api.ordered_adds[n:]
+
+    async with OldTaskGroup() as group:
+        # The first batch is there when the feed starts
+        api.raw_txs = {hash: raw_txs[hash] for hash in first_hashes}
+        api.txs = {hash: txs[hash] for hash in first_hashes}
+        await group.spawn(mempool.keep_synchronized, event)
+        await event.wait()
+        assert feed.resyncs == 1
+        await _test_summaries(mempool, api)
+        # The second batch is added by changes, without a resync
+        api.raw_txs = raw_txs
+        api.txs = txs
+        await feed.queue.put((set(second_hashes), set()))
+        await event.wait()
+        assert api.on_mempool_calls[-1][0] == api.touched(second_hashes)
+        await _test_summaries(mempool, api)
+        # And removed
+        api.txs = {hash: txs[hash] for hash in first_hashes}
+        await feed.queue.put((set(), set(second_hashes)))
+        await event.wait()
+        await _test_summaries(mempool, api)
+        assert len(mempool.txs) == len(first_hashes)
+        assert feed.resyncs == 1
+        # The feed asks for a resync
+        api.txs = txs
+        await feed.queue.put(None)
+        await event.wait()
+        assert feed.resyncs == 2
+        await _test_summaries(mempool, api)
+        await group.cancel_remaining()
+    assert feed.closed
+
+
+@pytest.mark.asyncio
+async def test_remove_confirmed():
+    api = API()
+    api.initialize(mempool_size=100)
+    mempool = MemPool(coin, api)
+    event = Event()
+
+    def descendants(tx_hash):
+        result = {tx_hash}
+        for child_hash in api.ordered_adds:
+            child = api.txs[child_hash]
+            if any(txin.prev_hash in result for txin in child.inputs):
+                result.add(child_hash)
+        return result
+
+    # Nothing happens before the first sync
+    await mempool.remove_confirmed(set(api.txs), set(), set(api.hashXs), 1)
+    assert not api.on_mempool_calls
+
+    async with OldTaskGroup() as group:
+        await group.spawn(mempool.keep_synchronized, event)
+        await event.wait()
+        await group.cancel_remaining()
+    calls = len(api.on_mempool_calls)
+
+    # A block confirms the first tx, and spends the first DB UTXO spent
+    # by a later mempool tx, which with its descendants is removed
+    confirmed = api.ordered_adds[0]
+    for conflict in api.ordered_adds[1:]:
+        prevouts = [(txin.prev_hash, txin.prev_idx) for txin in api.txs[conflict].inputs
+                    if txin.prev_hash not in api.txs and not txin.is_generation()]
+        if prevouts and conflict not in descendants(confirmed):
+            break
+    conflict_spend = prevouts[0]
+    removed = {confirmed} | descendants(conflict)
+    block_spends = {(txin.prev_hash, txin.prev_idx)
+                    for txin in api.txs[confirmed].inputs} | {conflict_spend}
+    block_touched = api.touched([confirmed]) | {api.db_utxos[conflict_spend][0]}
+
+    await mempool.remove_confirmed({confirmed, os.urandom(32)}, block_spends,
+                                   block_touched, 1)
+    assert set(mempool.txs) == set(api.txs) - removed
+    assert all(tx_hash not in removed for hashes in mempool.hashXs.values()
+               for tx_hash in hashes)
+    assert len(api.on_mempool_calls) == calls + 1
+    touched, height = api.on_mempool_calls[-1]
+    assert height == mempool.height == 1
+    assert touched == api.touched(removed)
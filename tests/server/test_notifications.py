@@ -43,3 +43,24 @@ async def test_enter_mempool_quick_blocks_2():
     # Now mempool refreshes
     await n.on_mempool(set(), 8)
     assert notified == [(5, set()), (5, {'a'}), (8, {'a', 'b', 'c'})]
+
+
+@pytest.mark.asyncio
+async def test_listener():
+    n = Notifications()
+    notified = []
+    heard = []
+
+    async def notify(height, touched):
+        notified.append((height, touched))
+
+    async def listener(height, touched):
+        heard.append((height, touched))
+
+    n.add_listener(listener)
+    await n.start(5, notify)
+
+    await n.on_block({'a'}, 6)
+    await n.on_mempool({'b'}, 6)
+    assert notified == [(5, set()), (6, {'a', 'b'})]
+    assert heard == notified[1:]
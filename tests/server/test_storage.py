@@ -1,7 +1,8 @@
 import pytest
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from electrumx.server.storage import Storage, db_class
+from electrumx.server.storage import Storage, Table, db_class
 from electrumx.lib.util import subclasses
 
 # Find out which db engines to test
@@ -31,6 +32,10 @@ def test_put_get(db):
     assert db.get(b"x") == b"y"
 
 
+def test_get_missing(db):
+    assert db.get(b"x") is None
+
+
 def test_batch(db):
     db.put(b"a", b"1")
     with db.write_batch() as b:
@@ -39,6 +44,30 @@ def test_batch(db):
     assert db.get(b"a") == b"2"
 
 
+def test_batch_delete(db):
+    db.put(b"a", b"1")
+    db.put(b"b", b"2")
+    with db.write_batch() as b:
+        b.delete(b"a")
+        b.put(b"c", b"3")
+    assert db.get(b"a") is None
+    assert list(db.iterator()) == [(b"b", b"2"), (b"c", b"3")]
+
+
+def test_batch_exception(db):
+    """
+    A batch should not be committed if its block raises.
+    """
+    db.put(b"a", b"1")
+    with pytest.raises(ValueError):
+        with db.write_batch() as b:
+            b.put(b"a", b"2")
+            b.put(b"b", b"3")
+            raise ValueError
+    assert db.get(b"a") == b"1"
+    assert db.get(b"b") is None
+
+
 def test_iterator(db):
     """
     The iterator should contain all key/value pairs starting with prefix
@@ -66,8 +95,134 @@ def test_iterator_reverse(db):
         ]
 
 
+def test_iterator_reverse_edges(db):
+    assert list(db.iterator(prefix=b"a", reverse=True)) == []
+    db.put(b"\xff\x01", b"1")
+    db.put(b"\xff\xff", b"2")
+    db.put(b"\x00\x01", b"3")
+    assert list(db.iterator(prefix=b"\xff", reverse=True)) == [
+        (b"\xff\xff", b"2"), (b"\xff\x01", b"1")]
+    assert list(db.iterator(prefix=b"\x00", reverse=True)) == [(b"\x00\x01", b"3")]
+    assert list(db.iterator(prefix=b"\x01", reverse=True)) == []
+    assert [k for k, v in db.iterator(reverse=True)] == [
+        b"\xff\xff", b"\xff\x01", b"\x00\x01"]
+
+
+def test_snapshot(db):
+    """
+    A snapshot should not see writes made after it was taken.
+    """
+    db.put(b"a1", b"x")
+    snapshot = db.snapshot()
+    db.put(b"a1", b"y")
+    db.put(b"a2", b"z")
+    with db.write_batch() as b:
+        b.delete(b"a1")
+    assert snapshot.get(b"a1") == b"x"
+    assert snapshot.get(b"a2") is None
+    assert list(snapshot.iterator(prefix=b"a")) == [(b"a1", b"x")]
+    assert list(snapshot.iterator(prefix=b"a", reverse=True)) == [(b"a1", b"x")]
+    assert list(db.iterator(prefix=b"a")) == [(b"a2", b"z")]
+
+
+def test_checkpoint(db):
+    """
+    A checkpoint is a copy of the database as it was when taken.
+    """
+    for i in range(1000):
+        db.put(b"k%04d" % i, b"%d" % i)
+    expected = list(db.iterator())
+    db.checkpoint("ckpt")
+    db.put(b"k0000", b"changed")
+    db.put(b"z", b"new")
+    copy = type(db)("ckpt", False)
+    try:
+        assert list(copy.iterator()) == expected
+    finally:
+        copy.close()
+
+
+def test_concurrent_reads(db):
+    """
+    Many threads should be able to read a snapshot at once.
+    """
+    for i in range(100):
+        db.put(b"k%03d" % i, b"%d" % i)
+    snapshot = db.snapshot()
+    expected = list(db.iterator(prefix=b"k"))
+
+    def read(i):
+        assert snapshot.get(b"k%03d" % i) == b"%d" % i
+        assert db.get(b"k%03d" % i) == b"%d" % i
+        return list(snapshot.iterator(prefix=b"k", reverse=bool(i % 2)))
+
+    with ThreadPoolExecutor(8) as executor:
+        for i, items in enumerate(executor.map(read, range(100))):
+            assert items == (expected[::-1] if i % 2 else expected)
+
+
+def test_lmdb_snapshot_readers(tmpdir):
+    """
+    LMDB snapshot readers should not wait on each other, and should see
+    the snapshot even if they start reading after a later commit.
+    """
+    pytest.importorskip("lmdb")
+    db = db_class("LMDB")(str(tmpdir.join("db")), False)
+    try:
+        db.put(b"a", b"1")
+        snapshot = db.snapshot()
+
+        def read(i):
+            return snapshot.get(b"a"), list(snapshot.iterator())
+
+        with ThreadPoolExecutor(4) as executor:
+            # Holding the lock of the snapshot's shared transaction
+            with snapshot.lock:
+                results = executor.map(read, range(8), timeout=10)
+                assert list(results) == [(b"1", [(b"a", b"1")])] * 8
+        db.put(b"a", b"2")
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(read, 0).result() == (b"1", [(b"a", b"1")])
+        assert read(0) == (b"1", [(b"a", b"1")])
+        del snapshot
+        assert db.get(b"a") == b"2"
+    finally:
+        db.close()
+
+
 def test_close(db):
     db.put(b"a", b"b")
     db.close()
     db = db_class(db.__class__.__name__)("db", False)
     assert db.get(b"a") == b"b"
+
+
+def test_tables(tmpdir, db):
+    """
+    Keys should be routed to their tables transparently.
+    """
+    tables = [Table(b"u"), Table(b"h", point_lookups=False), Table(b"U")]
+    db.close()
+    db = db_class(db.__class__.__name__)("tables", False, tables)
+    items = [(b"U1", b"1"), (b"a", b"2"), (b"h12", b"3"), (b"h12x", b"4"),
+             (b"h13", b"5"), (b"u12", b"6"), (b"u12y", b"7"), (b"z", b"8")]
+    with db.write_batch() as b:
+        for key, value in items:
+            b.put(key, value)
+        b.put(b"u99", b"9")
+    db.put(b"h99", b"10")
+    with db.write_batch() as b:
+        b.delete(b"u99")
+        b.delete(b"h99")
+    assert db.get(b"u12") == b"6"
+    assert db.get(b"u99") is None
+    assert list(db.iterator()) == items
+    assert list(db.iterator(reverse=True)) == items[::-1]
+    assert list(db.iterator(prefix=b"h12")) == items[2:4]
+    assert list(db.iterator(prefix=b"h12", reverse=True)) == items[3:1:-1]
+    assert list(db.iterator(prefix=b"u")) == items[5:7]
+    snapshot = db.snapshot()
+    db.put(b"u12z", b"11")
+    assert list(snapshot.iterator(prefix=b"u12", reverse=True)) == items[6:4:-1]
+    del snapshot
+    db.close()
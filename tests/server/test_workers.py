@@ -0,0 +1,228 @@
+'''Tests of the link between the indexer and its query workers.'''
+import asyncio
+import multiprocessing
+import os
+from functools import partial
+from os import environ
+from types import SimpleNamespace
+
+import pytest
+from aiorpcx import NetAddress, connect_us, serve_us
+
+from electrumx.server.db import DB, UTXO
+from electrumx.server.env import Env
+from electrumx.server.mempool import MemPoolTxSummary
+from electrumx.server.workers import (IndexerSession, MemPoolClient, PeerManagerClient,
+                                      WorkerSession, WorkerNotifications)
+from tests.server.test_changelog import Chain, close_db
+
+
+class FakeMemPool:
+
+    def __init__(self, hashX):
+        self.hashX = hashX
+        self.tx_hash = os.urandom(32)
+
+    async def balance_delta(self, hashX):
+        return -5 if hashX == self.hashX else 0
+
+    async def compact_fee_histogram(self):
+        return [(10.5, 1000), (2, 20000)]
+
+    async def potential_spends(self, hashX):
+        return {(self.tx_hash, 3)} if hashX == self.hashX else set()
+
+    async def transaction_summaries(self, hashX):
+        if hashX != self.hashX:
+            return []
+        return [MemPoolTxSummary(self.tx_hash, 250, True)]
+
+    async def unordered_UTXOs(self, hashX):
+        if hashX != self.hashX:
+            return []
+        return [UTXO(-1, 1, self.tx_hash, 0, 12345)]
+
+
+class FakePeerManager:
+
+    def __init__(self):
+        self.peers = [['1.2.3.4', 'a.com', ['v1.4', 's50002']]]
+        self.tor_peers = self.peers + [['x.onion', 'x.onion', ['v1.4', 't50001']]]
+        self.adds = []
+
+    async def on_add_peer(self, features, source_addr):
+        self.adds.append((features, source_addr))
+        return True
+
+    def on_peers_subscribe(self, is_tor):
+        return self.tor_peers if is_tor else self.peers
+
+    def proxy_address(self):
+        return NetAddress('127.0.0.1', 9050)
+
+
+class FakeDB:
+
+    def __init__(self):
+        self.catch_ups = 0
+        self.reorged = False
+
+    async def catch_up(self):
+        self.catch_ups += 1
+        return self.reorged
+
+
+@pytest.mark.asyncio
+async def test_worker_link(tmpdir):
+    hashX = os.urandom(11)
+    mempool = FakeMemPool(hashX)
+    indexer = SimpleNamespace(mempool=mempool, peer_mgr=None, sessions=set())
+    path = os.path.join(str(tmpdir), 'indexer.sock')
+    server = await serve_us(partial(IndexerSession, indexer=indexer), path)
+    try:
+        async with connect_us(path, session_factory=WorkerSession) as session:
+            client = MemPoolClient(session)
+            assert await client.balance_delta(hashX) == -5
+            assert await client.balance_delta(os.urandom(11)) == 0
+            assert await client.compact_fee_histogram() == [[10.5, 1000], [2, 20000]]
+            assert await client.potential_spends(hashX) == {(mempool.tx_hash, 3)}
+            assert await client.transaction_summaries(hashX) == [
+                MemPoolTxSummary(mempool.tx_hash, 250, True)]
+            assert await client.unordered_UTXOs(hashX) == [
+                UTXO(-1, 1, mempool.tx_hash, 0, 12345)]
+
+            # Notifications catch the worker's DB up, then reach its sessions
+            db = FakeDB()
+            notified = []
+            state = SimpleNamespace(backed_up_event=SimpleNamespace(
+                set=lambda: notified.append('backed up'), clear=lambda: None))
+            notifications = WorkerNotifications(db, state)
+            session.notifications = notifications
+
+            async def notify(height, touched):
+                notified.append((height, touched))
+
+            await notifications.start(7, notify)
+            (indexer_session, ) = indexer.sessions
+            await indexer_session.send_notification('notify', (8, [hashX.hex()]))
+            while len(notified) < 2:
+                await asyncio.sleep(0.01)
+            assert db.catch_ups == 1
+            assert notified == [(7, set()), (8, {hashX})]
+
+            db.reorged = True
+            await notifications.on_indexer(9, set())
+            assert notified[2:] == ['backed up', (9, set())]
+        await session.lost_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_worker_peers(tmpdir):
+    peer_mgr = FakePeerManager()
+    indexer = SimpleNamespace(mempool=FakeMemPool(os.urandom(11)), peer_mgr=peer_mgr,
+                              sessions=set())
+    path = os.path.join(str(tmpdir), 'indexer.sock')
+    server = await serve_us(partial(IndexerSession, indexer=indexer), path)
+    try:
+        async with connect_us(path, session_factory=WorkerSession) as session:
+            client = PeerManagerClient(session)
+            assert client.on_peers_subscribe(False) == []
+            assert client.proxy_address() is None
+            # Workers do not discover peers; they refresh the indexer's
+            await client._refresh()
+            assert client.on_peers_subscribe(False) == peer_mgr.peers
+            assert client.on_peers_subscribe(True) == peer_mgr.tor_peers
+            assert client.proxy_address() == NetAddress('127.0.0.1', 9050)
+
+            features = {'hosts': {'a.com': {'tcp_port': 50001}}}
+            source_addr = NetAddress('::1', 40000)
+            assert await client.on_add_peer(features, source_addr) is True
+            assert await client.on_add_peer(features, None) is True
+            assert peer_mgr.adds == [(features, source_addr), (features, None)]
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def lmdb_env(db_dir):
+    environ.clear()
+    environ['DB_DIRECTORY'] = db_dir
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinSV'
+    environ['DB_ENGINE'] = 'lmdb'
+    return Env()
+
+
+async def query_results(db, hashXs):
+    return (db.db_height, db.db_tip, db.db_tx_count,
+            [(await db.all_utxos(hashX), await db.limited_history(hashX, limit=None),
+              await db.get_balance(hashX)) for hashX in hashXs])
+
+
+async def write_chain(db_dir, conn):
+    db = DB(lmdb_env(db_dir))
+    await db.open_for_serving()
+    chain = Chain(db)
+    while True:
+        step = conn.recv()
+        if step is None:
+            break
+        if step == 'backup':
+            chain.backup()
+        else:
+            count, flush_utxos = step
+            chain.advance(count)
+            chain.flush(flush_utxos)
+        conn.send((chain.hashXs, await query_results(db, chain.hashXs)))
+    close_db(db)
+
+
+def run_writer(db_dir, conn):
+    asyncio.run(write_chain(db_dir, conn))
+
+
+def writer_results(conn, step):
+    conn.send(step)
+    assert conn.poll(30), 'the writer process died'
+    return conn.recv()
+
+
+@pytest.mark.asyncio
+async def test_reader_catch_up(tmpdir):
+    """
+    A DB opened for reading should catch up with the flushes and backups
+    of the indexer process writing it, and answer queries as the indexer
+    does.
+    """
+    pytest.importorskip('lmdb')
+    db_dir = str(tmpdir)
+    conn, writer_conn = multiprocessing.Pipe()
+    writer = multiprocessing.get_context('spawn').Process(
+        target=run_writer, args=(db_dir, writer_conn))
+    writer.start()
+    db = None
+    try:
+        hashXs, expected = writer_results(conn, (3, True))
+        db = DB(lmdb_env(db_dir))
+        await db.open_for_reading()
+        assert db.utxo_db.read_only
+        assert any(history for _, history, _ in expected[-1])
+        assert await query_results(db, hashXs) == expected
+
+        # A history-only flush is not seen until the next UTXO flush; a
+        # backup is a reorg
+        for step, reorged in (((2, False), False), ((1, True), False),
+                              ('backup', True), ((2, True), False)):
+            hashXs, expected = writer_results(conn, step)
+            assert await db.catch_up() is reorged
+            assert await query_results(db, hashXs) == expected
+        assert db.db_height == 6
+    finally:
+        conn.send(None)
+        writer.join(10)
+        if db:
+            close_db(db)
+    assert writer.exitcode == 0
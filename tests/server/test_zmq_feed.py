@@ -0,0 +1,129 @@
+import os
+from struct import pack
+
+import pytest
+from aiorpcx import sleep
+
+from electrumx.lib.hash import hash_to_hex_str
+
+zmq = pytest.importorskip('zmq')
+import zmq.asyncio  # noqa: E402
+
+from electrumx.server.zmq_feed import MempoolFeed, ZMQSubscriber  # noqa: E402
+
+
+class Publisher:
+    '''Stands in for the daemon's ZMQ publisher.'''
+
+    def __init__(self):
+        # An XPUB socket sees subscriptions, so messages are not
+        # published before the subscriber can receive them
+        self.socket = zmq.asyncio.Context.instance().socket(zmq.XPUB)
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.url = f'tcp://127.0.0.1:{port}'
+        self.count = 0
+
+    async def subscribed(self):
+        await self.socket.recv()
+
+    async def send(self, body, topic=b'sequence', skip=0):
+        self.count += skip
+        await self.socket.send_multipart([topic, body, pack('<I', self.count)])
+        self.count += 1
+
+    async def send_tx(self, tx_hash, label, sequence):
+        await self.send(tx_hash[::-1] + label + pack('<Q', sequence))
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+@pytest.fixture
+def publisher():
+    publisher = Publisher()
+    yield publisher
+    publisher.close()
+
+
+async def make_feed(publisher, hashes, sequence):
+    async def mempool_sequence():
+        return [hash_to_hex_str(tx_hash) for tx_hash in hashes], sequence
+
+    feed = MempoolFeed(publisher.url, mempool_sequence)
+    await publisher.subscribed()
+    return feed
+
+
+async def all_changes(feed):
+    '''Return the changes of all the messages sent.'''
+    # Let them all arrive to be returned together
+    await sleep(0.1)
+    return await feed.changes()
+
+
+@pytest.mark.asyncio
+async def test_subscriber(publisher):
+    subscriber = ZMQSubscriber(publisher.url, b'hashblock')
+    await publisher.subscribed()
+    assert await subscriber.receive(timeout=0.01) is None
+    await publisher.send(b'block', topic=b'hashblock')
+    assert await subscriber.receive() == (b'block', False)
+    await publisher.send(b'block2', topic=b'hashblock')
+    assert await subscriber.receive() == (b'block2', False)
+    await publisher.send(b'block3', topic=b'hashblock', skip=2)
+    assert await subscriber.receive() == (b'block3', True)
+    subscriber.close()
+
+
+@pytest.mark.asyncio
+async def test_changes(publisher):
+    hashes = [os.urandom(32) for _ in range(4)]
+    feed = await make_feed(publisher, hashes[:2], 10)
+    assert await feed.resync() == [hash_to_hex_str(tx_hash) for tx_hash in hashes[:2]]
+
+    # The resync's sequence number is that of the next change; changes
+    # before it are ignored
+    await publisher.send_tx(hashes[0], b'R', 9)
+    await publisher.send_tx(hashes[2], b'A', 10)
+    await publisher.send_tx(hashes[3], b'A', 11)
+    await publisher.send_tx(hashes[1], b'R', 12)
+    await publisher.send_tx(hashes[3], b'R', 13)
+    assert await all_changes(feed) == ({hashes[2]}, {hashes[1], hashes[3]})
+
+    await publisher.send_tx(hashes[3], b'A', 14)
+    assert await feed.changes() == ({hashes[3]}, set())
+    feed.close()
+
+
+@pytest.mark.asyncio
+async def test_sequence_gap(publisher):
+    tx_hash = os.urandom(32)
+    feed = await make_feed(publisher, [], 10)
+    await feed.resync()
+    await publisher.send_tx(tx_hash, b'A', 11)
+    assert await feed.changes() is None
+    feed.close()
+
+
+@pytest.mark.asyncio
+async def test_missed_messages(publisher):
+    tx_hash = os.urandom(32)
+    feed = await make_feed(publisher, [], 10)
+    await feed.resync()
+    await publisher.send_tx(tx_hash, b'A', 10)
+    assert await feed.changes() == ({tx_hash}, set())
+    await publisher.send_tx(tx_hash, b'R', 11)
+    publisher.count += 1
+    await publisher.send_tx(tx_hash, b'A', 12)
+    assert await all_changes(feed) is None
+    feed.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('label', (b'C', b'D'))
+async def test_block(publisher, label):
+    feed = await make_feed(publisher, [], 10)
+    await feed.resync()
+    await publisher.send(os.urandom(32) + label)
+    assert await feed.changes() is None
+    feed.close()